@@ -0,0 +1,490 @@
+"""
+Benchmarks for the geodesic, zone, distance cache, state, proximity, trip
+and scanner hot paths.
+
+Usage:
+    python benchmarks/bench.py [-o results.json] [-c baseline.json]
+                               [-t 0.2] [-k pattern] [--quick]
+
+Results are written as JSON. With --compare, each benchmark is checked
+against a previous results file. The exit status is 1 if any benchmark got
+slower by more than the threshold.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+BENCHMARKS: dict[str, Callable[[], Callable[[], None]]] = {}
+
+DEFAULT_THRESHOLD = 0.2  # fractional slowdown reported as a regression
+DEFAULT_REPEATS = 5
+MIN_REPEAT_TIME = 0.2  # s
+QUICK_REPEAT_TIME = 0.02  # s
+
+HOME = (51.5007, -0.1246)
+
+
+def benchmark(name: str):
+    """
+    Register a benchmark. The decorated function does any setup and returns
+    the callable to be timed.
+    """
+    def wrap(setup: Callable[[], Callable[[], None]]):
+        BENCHMARKS[name] = setup
+        return setup
+    return wrap
+
+
+# Geodesic
+
+@benchmark("inverse_vincenty.short")
+def _vincenty_short():
+    from libtracker.zone import inverse_vincenty
+    return lambda: inverse_vincenty(HOME, (51.5014, -0.1419))
+
+
+@benchmark("inverse_vincenty.long")
+def _vincenty_long():
+    from libtracker.zone import inverse_vincenty
+    return lambda: inverse_vincenty(HOME, (-33.8568, 151.2153))
+
+
+@benchmark("inverse_vincenty.near_antipodal")
+def _vincenty_near_antipodal():
+    from libtracker.zone import inverse_vincenty
+    return lambda: inverse_vincenty((0.0, 0.0), (0.5, 179.7))
+
+
+# Zones
+
+def _home_zone():
+    from libtracker.state import StateMachine
+    from libtracker.zone import setup_home_zone
+
+    sm = StateMachine()
+    setup_home_zone(sm, {"home_name": "Home", "latitude": HOME[0],
+                         "longitude": HOME[1]})
+    return sm.get("zone.home")
+
+
+@benchmark("in_zone.inside")
+def _in_zone_inside():
+    from libtracker.zone import in_zone
+    zone = _home_zone()
+    return lambda: in_zone(zone, HOME[0] + 0.0001, HOME[1], 7)
+
+
+@benchmark("in_zone.outside")
+def _in_zone_outside():
+    from libtracker.zone import in_zone
+    zone = _home_zone()
+    return lambda: in_zone(zone, 48.8584, 2.2945, 7)
+
+
+@benchmark("in_zone.prepared.inside")
+def _in_zone_prepared_inside():
+    from libtracker.zone import in_zone, prepare_zone
+    zone = prepare_zone(_home_zone())
+    return lambda: in_zone(zone, HOME[0] + 0.0001, HOME[1], 7)
+
+
+@benchmark("in_zone.prepared.outside")
+def _in_zone_prepared_outside():
+    from libtracker.zone import in_zone, prepare_zone
+    zone = prepare_zone(_home_zone())
+    return lambda: in_zone(zone, 48.8584, 2.2945, 7)
+
+
+@benchmark("zone_membership.tiered.boundary")
+def _zone_membership_boundary():
+    from libtracker.distance import zone_membership
+    from libtracker.zone import prepare_zone
+    zone = prepare_zone(_home_zone())
+    # Within the haversine error of the edge, so Vincenty decides it.
+    return lambda: zone_membership(zone, HOME[0] + 0.0009, HOME[1], 0)
+
+
+def _stationary_cache(precision: int):
+    import math
+    import random
+    from libtracker.cache import DistanceCache
+    from libtracker.zone import prepare_zone
+
+    # 100 parked devices whose fixes jitter by about 3 m, as a phone's do,
+    # checked against one zone every cycle.
+    rng = random.Random(0)
+    zone = prepare_zone(_home_zone())
+    cache = DistanceCache(precision=precision)
+    devices = []
+    for _ in range(100):
+        latitude = HOME[0] + rng.uniform(-0.02, 0.02)
+        longitude = HOME[1] + rng.uniform(-0.03, 0.03)
+        devices.append((latitude, longitude, 3 / 111_000,
+                        3 / 111_000 / math.cos(math.radians(latitude))))
+
+    def run():
+        # Fresh jitter every cycle, so the hit rate isn't flattered by
+        # replaying the same fixes.
+        for latitude, longitude, lat_jitter, lon_jitter in devices:
+            cache.zone_distance(zone,
+                                latitude + rng.gauss(0, lat_jitter),
+                                longitude + rng.gauss(0, lon_jitter))
+
+    def stats():
+        total = cache.hits + cache.misses
+        return {"hit_rate": cache.hits / total if total else 0.0}
+
+    run.stats = stats
+    return run
+
+
+for _precision in (4, 5, 6):
+    benchmark(f"distance_cache.stationary.{_precision}")(
+        lambda precision=_precision: _stationary_cache(precision)
+    )
+
+
+# State machine
+
+def _filled_state_machine(n: int):
+    from libtracker.state import StateMachine
+
+    sm = StateMachine()
+    for i in range(n):
+        sm.set(f"device.d{i}", "away", {"latitude": HOME[0] + i * 1e-6,
+                                        "longitude": HOME[1]})
+    return sm
+
+
+def _state_set(n: int):
+    sm = _filled_state_machine(n)
+    counter = iter(range(sys.maxsize))
+
+    def run():
+        i = next(counter)
+        sm.set(f"device.d{i % n}", "away", {"latitude": float(i),
+                                            "longitude": HOME[1]})
+    return run
+
+
+def _state_all(n: int):
+    sm = _filled_state_machine(n)
+    counter = iter(range(sys.maxsize))
+
+    def run():
+        # Change one entity first so all() can't be served from its cache.
+        sm.set("device.d0", "away", {"latitude": float(next(counter)),
+                                     "longitude": HOME[1]})
+        sm.all()
+    return run
+
+
+for _n, _label in ((10, "10"), (1000, "1k"), (100_000, "100k")):
+    benchmark(f"state.set.{_label}")(lambda n=_n: _state_set(n))
+    benchmark(f"state.all.{_label}")(lambda n=_n: _state_all(n))
+
+
+# Proximity
+
+def _proximity_tracker(n: int):
+    import random
+    from libtracker.proximity import ProximityTracker
+    from libtracker.state import StateMachine
+
+    # n devices spread over about 40 x 40 km, many of them in groups.
+    rng = random.Random(0)
+    tracker = ProximityTracker(StateMachine(), 50)
+    for i in range(n):
+        tracker.update(f"device.d{i}", HOME[0] + rng.uniform(-0.2, 0.2),
+                       HOME[1] + rng.uniform(-0.3, 0.3))
+    return tracker, rng
+
+
+def _proximity_update(n: int):
+    tracker, rng = _proximity_tracker(n)
+    counter = iter(range(sys.maxsize))
+
+    def run():
+        tracker.update(f"device.d{next(counter) % n}",
+                       HOME[0] + rng.uniform(-0.2, 0.2),
+                       HOME[1] + rng.uniform(-0.3, 0.3))
+    return run
+
+
+def _proximity_within(n: int):
+    tracker, _ = _proximity_tracker(n)
+    return lambda: tracker.within(HOME[0], HOME[1], 200)
+
+
+def _proximity_dense(n: int):
+    import math
+    import random
+    from libtracker.proximity import ProximityTracker
+    from libtracker.state import StateMachine
+
+    # n devices parked within 50 m of each other, e.g. a depot, all in one
+    # group. Each update moves one by about 3 m of GPS jitter, which makes
+    # links at the edge of the radius come and go.
+    rng = random.Random(0)
+    tracker = ProximityTracker(StateMachine(), 50)
+    scale = math.cos(math.radians(HOME[0]))
+    positions = []
+    for i in range(n):
+        distance = 25 * math.sqrt(rng.random())
+        bearing = rng.uniform(0, 2 * math.pi)
+        positions.append((
+            HOME[0] + distance * math.cos(bearing) / 111_000,
+            HOME[1] + distance * math.sin(bearing) / 111_000 / scale
+        ))
+        tracker.update(f"device.d{i}", *positions[i])
+    counter = iter(range(sys.maxsize))
+
+    def run():
+        i = next(counter) % n
+        tracker.update(f"device.d{i}",
+                       positions[i][0] + rng.gauss(0, 3) / 111_000,
+                       positions[i][1] + rng.gauss(0, 3) / 111_000 / scale)
+    return run
+
+
+for _n, _label in ((1000, "1k"), (10_000, "10k")):
+    benchmark(f"proximity.update.{_label}")(lambda n=_n: _proximity_update(n))
+    benchmark(f"proximity.within.{_label}")(lambda n=_n: _proximity_within(n))
+for _n in (100, 200):
+    benchmark(f"proximity.update.dense.{_n}")(
+        lambda n=_n: _proximity_dense(n)
+    )
+
+
+# Trips
+
+def _trips_update(step: float):
+    from libtracker.state import StateMachine
+    from libtracker.trips import TripTracker
+
+    tracker = TripTracker(StateMachine())
+    counter = iter(range(sys.maxsize))
+
+    def run():
+        i = next(counter)
+        # step degrees of latitude every 15s: 0 for a stop, 0.002 (about
+        # 15 m/s) for a trip.
+        tracker.update("device.d0", i * 15.0, HOME[0] + (i % 1000) * step,
+                       HOME[1])
+    return run
+
+
+benchmark("trips.update.stop")(lambda: _trips_update(0))
+benchmark("trips.update.trip")(lambda: _trips_update(0.002))
+
+
+# Scanner
+
+def _scanner(n_devices: int):
+    import fake_icloud
+    import libtracker.scanner
+    from libtracker.state import StateMachine
+    from libtracker.zone import setup_zones
+
+    config = {"home_name": "Home", "latitude": HOME[0], "longitude": HOME[1],
+              "apple_username": "bench@example.com",
+              "apple_password": "bench"}
+    sm = StateMachine()
+    zones = setup_zones(sm, config)
+
+    fake_icloud.FakePyiCloudService.n_devices = n_devices
+    fake_icloud.FakePyiCloudService.home = HOME
+    real_service = libtracker.scanner.PyiCloudService
+    libtracker.scanner.PyiCloudService = fake_icloud.FakePyiCloudService
+    try:
+        scanner = libtracker.scanner.ICloudDeviceScanner(sm, config, zones)
+    finally:
+        libtracker.scanner.PyiCloudService = real_service
+    scanner.add_devices()
+    return scanner
+
+
+def _scanner_cycle(n_devices: int):
+    scanner = _scanner(n_devices)
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            scanner.update_all()
+    return run
+
+
+def _scanner_static_cycle(n_devices: int):
+    # Devices which haven't moved since the last scan.
+    scanner = _scanner(n_devices)
+    snapshot = scanner.fetch_snapshot()
+    scanner._process_snapshot(snapshot)
+    return lambda: scanner._process_snapshot(snapshot)
+
+
+def _read_statuses(n_devices: int, full: bool):
+    import fake_icloud
+    from libtracker.scanner import DEVICE_STATUS_SET, STATUS_FIELDS, \
+        _read_status
+
+    manager = fake_icloud.FakeDeviceManager(n_devices, HOME, 0)
+    fields = DEVICE_STATUS_SET if full else STATUS_FIELDS
+    return lambda: [_read_status(device, fields) for device in manager]
+
+
+benchmark("scanner.read_status.full.100")(lambda: _read_statuses(100, True))
+benchmark("scanner.read_status.lean.100")(lambda: _read_statuses(100, False))
+benchmark("scanner.cycle.10")(lambda: _scanner_cycle(10))
+benchmark("scanner.cycle.100")(lambda: _scanner_cycle(100))
+benchmark("scanner.cycle.static.100")(lambda: _scanner_static_cycle(100))
+
+
+def measure(setup: Callable[[], Callable[[], None]],
+            min_time: float = MIN_REPEAT_TIME,
+            repeats: int = DEFAULT_REPEATS) -> dict:
+    """
+    Time a benchmark. The number of calls per repeat is doubled until one
+    repeat takes at least min_time.
+    :return: Dictionary of timings in seconds per call, plus anything
+        returned by the stats() attribute of the timed callable.
+    """
+    fn = setup()
+    timer = time.perf_counter
+
+    number = 1
+    while True:
+        start = timer()
+        for _ in range(number):
+            fn()
+        elapsed = timer() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    times = [elapsed / number]
+    for _ in range(repeats - 1):
+        start = timer()
+        for _ in range(number):
+            fn()
+        times.append((timer() - start) / number)
+
+    result = {
+        "median": statistics.median(times),
+        "min": min(times),
+        "max": max(times),
+        "number": number,
+        "repeats": repeats,
+    }
+    if (stats := getattr(fn, "stats", None)) is not None:
+        result.update(stats())
+    return result
+
+
+def run(pattern: str = None, quick: bool = False) -> dict:
+    """ Run every benchmark whose name contains pattern. """
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if pattern and pattern not in name:
+            continue
+        results[name] = measure(
+            setup, QUICK_REPEAT_TIME if quick else MIN_REPEAT_TIME,
+            3 if quick else DEFAULT_REPEATS
+        )
+        extra = "".join(f" {key}={value:.3f}"
+                        for key, value in results[name].items()
+                        if key not in ("median", "min", "max", "number",
+                                       "repeats"))
+        print(f"{name:<36} {_format_time(results[name]['median'])}{extra}",
+              file=sys.stderr)
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict,
+            threshold: float = DEFAULT_THRESHOLD) -> list:
+    """
+    Compare two result sets by median time.
+    :return: List of (name, baseline, current, ratio) for every benchmark
+        slower than baseline by more than threshold.
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        if (base := baseline["results"].get(name)) is None:
+            continue
+        ratio = result["median"] / base["median"]
+        marker = "REGRESSION" if ratio > 1 + threshold else ""
+        print(f"{name:<36} {_format_time(base['median'])} -> "
+              f"{_format_time(result['median'])} {ratio:6.2f}x {marker}",
+              file=sys.stderr)
+        if marker:
+            regressions.append((name, base["median"], result["median"],
+                                ratio))
+
+    return regressions
+
+
+def _format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:8.2f} {unit}"
+    return f"{seconds / 1e-9:8.2f} ns"
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-o", "--output", help="write results to this file")
+    parser.add_argument("-c", "--compare",
+                        help="baseline results file to compare against")
+    parser.add_argument("-t", "--threshold", type=float,
+                        default=DEFAULT_THRESHOLD,
+                        help="slowdown ratio treated as a regression")
+    parser.add_argument("-k", dest="pattern",
+                        help="only run benchmarks containing this string")
+    parser.add_argument("--quick", action="store_true",
+                        help="shorter runs, for smoke testing")
+    parser.add_argument("--list", action="store_true",
+                        help="list benchmark names and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        print("\n".join(BENCHMARKS))
+        return 0
+
+    results = run(args.pattern, args.quick)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""
+In-process stand-in for pyicloud's PyiCloudService so a full scan cycle can
+be benchmarked without network access or Apple ID credentials.
+"""
+import random
+
+# Roughly the shape of a Find My iPhone device payload.
+_TEMPLATE = {
+    'features': {'BTR': False, 'LLC': False, 'CLK': False, 'TEU': True,
+                 'SND': True, 'CLT': False, 'SVP': False, 'SPN': False,
+                 'XRM': False, 'CWP': False, 'MSG': True, 'LOC': True,
+                 'LME': False, 'LMG': False, 'LYU': False, 'LKL': False,
+                 'LST': True, 'LKM': False, 'WMG': True, 'SCA': False,
+                 'PSS': False, 'EAL': False, 'LAE': False, 'PIN': False,
+                 'LCK': True, 'REM': False, 'MCS': False, 'KEY': False,
+                 'KPD': False, 'WIP': True},
+    'maxMsgChar': 160, 'darkWake': False, 'fmlyShare': False,
+    'deviceStatus': '200', 'remoteLock': None, 'activationLocked': True,
+    'deviceClass': 'iPhone', 'deviceModel': 'iphone12-1-4-0',
+    'rawDeviceModel': 'iPhone13,2', 'passcodeLength': 6,
+    'canWipeAfterLock': True, 'trackingInfo': None, 'msg': None,
+    'remoteWipe': None, 'thisDevice': False, 'snd': None,
+    'prsId': None, 'wipeInProgress': False, 'lowPowerMode': False,
+    'lostModeEnabled': False, 'isLocating': True, 'lostModeCapable': True,
+    'mesg': None, 'batteryStatus': 'NotCharging', 'lockedTimestamp': None,
+    'lostTimestamp': '', 'locationCapable': True,
+    'deviceDisplayName': 'iPhone 12', 'lostDevice': None,
+    'deviceColor': '1-1-0', 'wipedTimestamp': None,
+    'modelDisplayName': 'iPhone', 'locationEnabled': True, 'isMac': False,
+    'locFoundEnabled': False,
+}
+
+
+class FakeAppleDevice:
+    def __init__(self, manager, content: dict) -> None:
+        self.manager = manager
+        self.content = content
+
+    def status(self, additional=None) -> dict:
+        # Like older pyicloud releases, every status call refreshes the
+        # whole account.
+        self.manager.refresh()
+        fields = ["batteryLevel", "deviceDisplayName", "deviceStatus", "name"]
+        fields += additional or []
+        return {field: self.content.get(field) for field in fields}
+
+    def __getitem__(self, key: str):
+        return self.content[key]
+
+    def __str__(self) -> str:
+        return f"{self['deviceDisplayName']}: {self['name']}"
+
+
+class FakeDeviceManager:
+    def __init__(self, n_devices: int, home: tuple, seed: int) -> None:
+        self.refreshes = 0
+        self._random = random.Random(seed)
+        self._home = home
+        self._devices = []
+        for i in range(n_devices):
+            content = dict(_TEMPLATE, id=f"device-{i:06d}",
+                           name=f"Device {i}", batteryLevel=0.5)
+            self._devices.append(FakeAppleDevice(self, content))
+        self._move()
+
+    def _move(self) -> None:
+        """ Give every device a new location near home. """
+        for device in self._devices:
+            device.content['location'] = {
+                'latitude': self._home[0] + self._random.uniform(-0.01, 0.01),
+                'longitude': self._home[1] + self._random.uniform(-0.01, 0.01),
+                'horizontalAccuracy': 65.0,
+                'timeStamp': 0,
+            }
+
+    def refresh(self, locate: bool = True) -> None:
+        self.refreshes += 1
+        self._move()
+
+    def __iter__(self):
+        return iter(self._devices)
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+
+class FakePyiCloudService:
+    """ Drop-in replacement for PyiCloudService with synthetic devices. """
+    requires_2fa = False
+
+    n_devices = 100
+    home = (51.5, -0.1)
+    seed = 0
+
+    def __init__(self, username: str, password: str) -> None:
+        self.devices = FakeDeviceManager(self.n_devices, self.home, self.seed)
@@ -0,0 +1,98 @@
+"""
+Check that importing libtracker stays within a time budget.
+
+Usage:
+    python benchmarks/importtime.py [-b 50] [-n 5] [-m libtracker]
+
+The module is imported in a fresh interpreter under -X importtime, taking
+the best of several runs. The exit status is 1 if its cumulative import time
+exceeds the budget or if it pulls in any of the heavy dependencies that
+should only load with a scanner.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_BUDGET = 50  # ms
+DEFAULT_RUNS = 5
+
+# Top-level packages which must not be imported by the core package.
+HEAVY_MODULES = ("pyicloud", "click", "requests", "numpy", "asyncio")
+
+
+def measure(module: str = None) -> dict[str, int]:
+    """
+    Import module in a fresh interpreter.
+    :param module: Module to import, or None to start the interpreter only
+    :return: Dictionary of cumulative import time in microseconds keyed by
+        every module that was imported.
+    """
+    code = f"import {module}" if module else "pass"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            continue  # the header line
+        times[fields[2].strip()] = cumulative
+
+    return times
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-b", "--budget", type=float, default=DEFAULT_BUDGET,
+                        help="maximum import time in milliseconds")
+    parser.add_argument("-n", "--runs", type=int, default=DEFAULT_RUNS,
+                        help="take the best of this many imports")
+    parser.add_argument("-m", "--module", default="libtracker",
+                        help="module to import")
+    args = parser.parse_args(argv)
+
+    best = None
+    for _ in range(args.runs):
+        times = measure(args.module)
+        if best is None or times[args.module] < best[args.module]:
+            best = times
+
+    # Leave out what the interpreter imports at startup, e.g. for site.
+    for name in measure():
+        if name != args.module:
+            best.pop(name, None)
+
+    elapsed = best[args.module] / 1000
+    slowest = sorted(best.items(), key=lambda item: item[1], reverse=True)
+    for name, cumulative in slowest[:10]:
+        print(f"{name:<40} {cumulative / 1000:8.2f} ms", file=sys.stderr)
+
+    failed = False
+    heavy = sorted({name.split(".")[0] for name in best} &
+                   set(HEAVY_MODULES))
+    if heavy:
+        print(f"import {args.module} pulls in: {', '.join(heavy)}")
+        failed = True
+    if elapsed > args.budget:
+        print(f"import {args.module} took {elapsed:.2f} ms, over the budget "
+              f"of {args.budget:g} ms")
+        failed = True
+    if not failed:
+        print(f"import {args.module} took {elapsed:.2f} ms "
+              f"(budget {args.budget:g} ms)")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+"""
+Replay GPS traces through the Device update path and report throughput and
+latency, without iCloud credentials or network access.
+
+Usage:
+    python benchmarks/replay.py TRACE [TRACE ...] [--speed 60] [--copies 100]
+                                [--home LAT,LON] [--compact] [--json]
+
+Traces may be CSV, JSON Lines or GPX files. See libtracker.replay for the
+expected fields.
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libtracker.replay import ReplayScanner, format_report  # noqa: E402
+from libtracker.state import StateMachine, CompactStateMachine  # noqa: E402
+from libtracker.zone import setup_zones  # noqa: E402
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("traces", nargs="+", help="trace files to replay")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="times faster than real time, 0 for as fast as "
+                             "possible (default)")
+    parser.add_argument("--copies", type=int, default=1,
+                        help="replay every traced device this many times")
+    parser.add_argument("--home", default="0,0",
+                        help="home zone as LAT,LON")
+    parser.add_argument("--compact", action="store_true",
+                        help="use the compact state machine")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    latitude, longitude = (float(x) for x in args.home.split(","))
+    config = {"home_name": "Home", "latitude": latitude,
+              "longitude": longitude, "replay_traces": args.traces,
+              "replay_speed": args.speed,
+              "replay_copies": args.copies}
+
+    if args.compact:
+        sm = CompactStateMachine()
+    else:
+        sm = StateMachine()
+    scanner = ReplayScanner(sm, config, setup_zones(sm, config))
+    scanner.add_devices()
+    try:
+        scanner.replay()
+    except KeyboardInterrupt:
+        pass
+
+    if args.json:
+        json.dump(scanner.stats(), sys.stdout, indent=2)
+        print()
+    else:
+        print(format_report(scanner.stats()))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""
+Compare reading every status field with the lean projection used on polls.
+
+Usage:
+    python benchmarks/status_fields.py [-d 100] [-n 200] [-f FIELD ...]
+
+For each scan cycle over the synthetic devices in fake_icloud, reports the
+time taken to read the statuses and the size of the statuses read, encoded
+as JSON. -f adds extra fields to the projection, as status_fields in the
+config does.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_icloud  # noqa: E402
+from libtracker.scanner import (  # noqa: E402
+    DEVICE_STATUS_SET, _read_status, status_fields
+)
+
+
+def measure(manager, fields: list[str], cycles: int) -> tuple[float, int]:
+    """
+    Read the statuses of every device cycles times.
+    :param manager: Device manager to read from
+    :param fields: Fields to read from each device
+    :param cycles: Number of cycles to time
+    :return: Seconds per cycle and JSON bytes per cycle
+    """
+    start = time.perf_counter()
+    for _ in range(cycles):
+        statuses = [_read_status(device, fields) for device in manager]
+    elapsed = (time.perf_counter() - start) / cycles
+
+    size = len(json.dumps(statuses, separators=(",", ":")).encode())
+    return elapsed, size
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-d", "--devices", type=int, default=100,
+                        help="number of devices")
+    parser.add_argument("-n", "--cycles", type=int, default=200,
+                        help="number of cycles to time")
+    parser.add_argument("-f", "--field", action="append", default=[],
+                        help="extra field to read on each poll")
+    args = parser.parse_args(argv)
+
+    manager = fake_icloud.FakeDeviceManager(args.devices, (51.5, -0.1), 0)
+    lean = status_fields({"status_fields": args.field})
+
+    full_time, full_size = measure(manager, DEVICE_STATUS_SET, args.cycles)
+    lean_time, lean_size = measure(manager, lean, args.cycles)
+
+    print(f"{args.devices} devices per cycle")
+    print(f"{'fields':<8} {'count':>5} {'time':>10} {'bytes':>10}")
+    for label, fields, elapsed, size in (
+        ("full", DEVICE_STATUS_SET, full_time, full_size),
+        ("lean", lean, lean_time, lean_size),
+    ):
+        print(f"{label:<8} {len(fields):>5} {elapsed * 1000:>7.3f} ms "
+              f"{size:>10}")
+    print(f"saved {(full_time - lean_time) * 1000:.3f} ms and "
+          f"{full_size - lean_size} bytes per cycle "
+          f"({1 - lean_size / full_size:.0%} of the bytes)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
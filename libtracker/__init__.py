@@ -1,19 +1,70 @@
-import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor
-from typing import Union
+import importlib
+from typing import Union, Optional, Any, TYPE_CHECKING
 
-from libtracker.state import StateMachine
+from libtracker.state import StateMachine, CompactStateMachine
 from libtracker.config import ensure_config, load_config
-from libtracker.scanner import ICloudDeviceScanner
+from libtracker.constants import CONFIG_MAX_WORKERS
+from libtracker import metrics
 from libtracker import zone
 
-# Currently only have support for one scanner but more mappings can be
-# easily added here.
+if TYPE_CHECKING:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor, Future
+    from libtracker.events import GeofenceTracker, ZoneEvent
+    from libtracker.proximity import ProximityTracker
+    from libtracker.snapshot import Snapshot, SnapshotWriter
+    from libtracker.trips import TripTracker
+
+# Scanners are given as "module:Class" and only imported when first used, so
+# importing libtracker doesn't pull in pyicloud, click or requests.
+# More mappings can be easily added here, as a path or as the class itself.
 SCANNER_MAP = {
-    "ios": ICloudDeviceScanner,
-    "icloud": ICloudDeviceScanner
+    "ios": "libtracker.scanner:ICloudDeviceScanner",
+    "icloud": "libtracker.scanner:ICloudDeviceScanner",
+    "icloud_sharded": "libtracker.sharding:ShardedICloudScanner",
+    "replay": "libtracker.replay:ReplayScanner"
+}
+
+# Names which can still be imported from the package, loaded on first access.
+_LAZY_ATTRS = {
+    "ICloudDeviceScanner": "libtracker.scanner:ICloudDeviceScanner",
+    "ShardedICloudScanner": "libtracker.sharding:ShardedICloudScanner",
+    "ReplayScanner": "libtracker.replay:ReplayScanner",
+    "GeofenceTracker": "libtracker.events:GeofenceTracker",
+    "ProximityTracker": "libtracker.proximity:ProximityTracker",
+    "TripTracker": "libtracker.trips:TripTracker",
+    "notify": "libtracker.notify",
 }
 
+# Upper bound on threads used for blocking calls in the asyncio runtime.
+DEFAULT_MAX_WORKERS = 4
+
+
+def _import(path: str) -> Any:
+    """ Import a "module" or "module:attribute" path. """
+    module, _, attr = path.partition(":")
+    module = importlib.import_module(module)
+    return getattr(module, attr) if attr else module
+
+
+def load_scanner(name: str) -> type:
+    """
+    Get a scanner class from SCANNER_MAP, importing it on first use.
+    :param name: Name of the scanner
+    :return: The scanner class
+    """
+    name = name.lower()
+    if isinstance(scanner := SCANNER_MAP[name], str):
+        scanner = SCANNER_MAP[name] = _import(scanner)
+    return scanner
+
+
+def __getattr__(name: str) -> Any:
+    if (path := _LAZY_ATTRS.get(name)) is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = globals()[name] = _import(path)
+    return value
+
 
 # noinspection PyShadowingNames
 class LibtrackerRunner:
@@ -22,39 +73,170 @@ class LibtrackerRunner:
     """
 
     running_scanners: list
-    _pool: ThreadPoolExecutor
+    zones: zone.ZoneIndex
+    events: "GeofenceTracker"
+    proximity: Optional["ProximityTracker"] = None
+    trips: Optional["TripTracker"] = None
+    snapshot_writer: Optional["SnapshotWriter"] = None
+    metrics_server = None
+    api_server = None
+    _snapshot: Optional["Snapshot"] = None
+    _pool: "ThreadPoolExecutor"
+    _loop: Optional["asyncio.AbstractEventLoop"] = None
+    _main_task: Optional["asyncio.Task"] = None
 
     def __init__(self, config: dict = None,
-                 scanners: Union[list[str], str] = None) -> None:
-        self.states = StateMachine()
+                 scanners: Union[list[str], str] = None,
+                 use_asyncio: bool = False,
+                 compact_states: bool = False) -> None:
+        # The compact state machine trades a little CPU on reads for much
+        # less memory per entity on very large fleets.
+        self.states = CompactStateMachine() if compact_states \
+            else StateMachine()
         self.config = config
         self.scanners = scanners or []
+        self.use_asyncio = use_asyncio
 
-    def start(self) -> None:
-        """ Attempt to initialise Libtracker """
+    def _setup(self) -> None:
+        """ Load config, set up zones and validate the chosen scanners. """
         if self.config is None:
             # If the user is running Libtracker as a script config will not be
             # passed in so set up config now.
             config_path = ensure_config()
             self.config = load_config(config_path)
 
-        # Setup the home zone
-        zone.setup_home_zone(self.states, self.config)
+        from libtracker.logs import setup_logging
+        setup_logging(self.config)
+
+        # Metrics are only recorded when an endpoint is configured.
+        if self.metrics_server is None:
+            self.metrics_server = metrics.start_from_config(self.config)
+
+        if self.api_server is None:
+            from libtracker import api
+            self.api_server = api.start_from_config(self.states, self.config)
+
+        from libtracker.snapshot import snapshot_path
+
+        if (path := snapshot_path(self.config)) is not None:
+            from libtracker.snapshot import load_snapshot, restore_states
+
+            # Warm start: show the last known states straight away. They are
+            # brought up to date by the first scan.
+            self._snapshot = load_snapshot(path)
+            if self._snapshot is not None:
+                restore_states(self.states, self._snapshot)
+
+        # Setup the home zone and any other configured zones
+        self.zones = zone.setup_zones(self.states, self.config)
+
+        from libtracker.events import GeofenceTracker
+
+        # Zone enter, exit and dwell events. Notifications are one subscriber.
+        self.events = GeofenceTracker.from_config(self.states, self.zones,
+                                                  self.config)
+        self.events.subscribe(self._notify_home)
+
+        from libtracker.proximity import ProximityTracker
+
+        # Groups of co-located devices, moved by the devices as they are
+        # seen. Off unless a radius is configured.
+        self.proximity = ProximityTracker.from_config(self.states, self.config)
+        if self.proximity is not None:
+            self.proximity.restore()
+
+        from libtracker.trips import TripTracker
+
+        # Trips and stops, segmented from every location the devices see.
+        self.trips = TripTracker.from_config(self.states, self.config)
 
         if not self.scanners:
             raise RuntimeError("Scanners must contain a scanner.")
         if not isinstance(self.scanners, list):
             self.scanners = [self.scanners]
 
+    def _add_scanner(self, scanner) -> None:
+        """ Restore the scanner's devices from the snapshot and track it. """
+        # Before any devices are created.
+        scanner.proximity = self.proximity
+        scanner.trips = self.trips
+        if self._snapshot is not None and hasattr(scanner, "restore_devices"):
+            scanner.restore_devices(self._snapshot.devices)
+        self.running_scanners.append(scanner)
+
+    def _notify_home(self, event: "ZoneEvent") -> None:
+        """ Send a notification when a device enters the home zone. """
+        from libtracker.events import EVENT_ENTER
+
+        if event.type != EVENT_ENTER or event.zone != "zone.home":
+            return
+        # Events carry the lowercased entity ID, so find the device by that
+        # rather than by its name.
+        name = event.device_name
+        for scanner in list(self.running_scanners):
+            device = next(
+                (device for device in
+                 list(getattr(scanner, "devices", {}).values())
+                 if device.entity_id.lower() == event.device), None
+            )
+            if device is None:
+                continue
+            # e.g. replayed trips must not message real Telegram users.
+            if not getattr(scanner, "notifications", True):
+                return
+            name = device.name
+            break
+
+        from libtracker import notify
+        notify.queue_notification(name, self.config)
+
+    def _start_snapshots(self) -> None:
+        """ Start saving snapshots in the background if enabled. """
+        from libtracker.snapshot import SnapshotWriter
+
+        self.snapshot_writer = SnapshotWriter.from_config(
+            self.states, self.config, self._export_devices
+        )
+        if self.snapshot_writer is not None:
+            self.snapshot_writer.start()
+
+    def _export_devices(self) -> dict:
+        """ Collect the device registries of every running scanner. """
+        devices = {}
+        for scanner in list(self.running_scanners):
+            if hasattr(scanner, "export_devices"):
+                devices.update(scanner.export_devices())
+        return devices
+
+    def start(self) -> None:
+        """ Attempt to initialise Libtracker """
+        if self.use_asyncio:
+            import asyncio
+
+            try:
+                asyncio.run(self.async_start())
+            except asyncio.CancelledError:
+                # Stopped through stop()
+                pass
+            return
+
+        self._setup()
+
         self.running_scanners = []
         for scanner in self.scanners:
             # Map each chosen scanner to its scanner class and append to
             # the list of scanners we would like to run.
             if (scanner := scanner.lower()) in SCANNER_MAP.keys():
-                scanner = SCANNER_MAP[scanner](self.states, self.config)
-                self.running_scanners.append(scanner)
+                scanner = load_scanner(scanner)(self.states, self.config,
+                                                self.zones)
+                self._add_scanner(scanner)
+
+        self.events.start()
+        self._start_snapshots()
 
         if self.running_scanners:
+            from concurrent.futures import ThreadPoolExecutor
+
             # Create a thread pool with num_threads = amount of scanners.
             self._pool = ThreadPoolExecutor(len(self.running_scanners))
 
@@ -69,10 +251,78 @@ class LibtrackerRunner:
                 # Add the exception callback for each future
                 fut.add_done_callback(_scanner_exception_callback)
 
+    async def async_start(self) -> None:
+        """
+        Run Libtracker on the current event loop. Every scanner runs as a
+        coroutine and blocking calls are handed to a bounded thread pool.
+        Cancelling this coroutine stops all scanners.
+        """
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        from libtracker import notify
+
+        self._setup()
+        self._loop = asyncio.get_running_loop()
+        self._main_task = asyncio.current_task()
+        self._pool = ThreadPoolExecutor(
+            self.config.get(CONFIG_MAX_WORKERS) or DEFAULT_MAX_WORKERS
+        )
+
+        try:
+            self.running_scanners = []
+            for scanner in self.scanners:
+                if (scanner := scanner.lower()) in SCANNER_MAP.keys():
+                    # Constructing a scanner may log in to a remote service.
+                    scanner = await self._loop.run_in_executor(
+                        self._pool, load_scanner(scanner), self.states,
+                        self.config, self.zones
+                    )
+                    self._add_scanner(scanner)
+
+            self.events.start()
+            self._start_snapshots()
+            tasks = [asyncio.create_task(scanner.async_start(self._pool))
+                     for scanner in self.running_scanners]
+            for task in tasks:
+                task.add_done_callback(_scanner_task_callback)
+
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            for scanner in self.running_scanners:
+                scanner.running = False
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self.events.stop()
+            notify.shutdown_dispatcher()
+            if self.snapshot_writer is not None:
+                self.snapshot_writer.stop()
+
+    def stop(self) -> None:
+        """
+        Stop the asyncio runtime. Safe to call from any thread.
+        :return: None
+        """
+        if self._loop is not None and self._main_task is not None:
+            self._loop.call_soon_threadsafe(self._main_task.cancel)
+
 
-def _scanner_exception_callback(future: concurrent.futures.Future) -> None:
+def _scanner_exception_callback(future: "Future") -> None:
     """
     Add a callback which allows exceptions coming from the any futures
     set to be caught instead of the program failing quietly
     """
-    print(future.result())
+    if (exc := future.exception()) is not None:
+        _log_scanner_error(exc)
+
+
+def _scanner_task_callback(task: "asyncio.Task") -> None:
+    """ Report exceptions raised by scanner tasks in the asyncio runtime. """
+    if not task.cancelled() and (exc := task.exception()) is not None:
+        _log_scanner_error(exc)
+
+
+def _log_scanner_error(exc: BaseException) -> None:
+    # logging is imported here to keep it out of the package import.
+    import logging
+    logging.getLogger(__name__).error("Scanner stopped: %r", exc,
+                                      exc_info=exc)
@@ -1,6 +1,12 @@
+import sys
+
 from libtracker import LibtrackerRunner
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["analyze"]:
+        from libtracker.analyze import main
+        sys.exit(main(sys.argv[2:]))
+
     runner = LibtrackerRunner(scanners="icloud")
     runner.start()
@@ -0,0 +1,489 @@
+"""
+Offline analysis of recorded GPS history.
+
+Usage:
+    python -m libtracker analyze FILE [FILE ...] [--config PATH]
+                                 [--home LAT,LON] [--zone NAME,LAT,LON[,R]]
+                                 [--workers N] [--chunk-size ROWS]
+                                 [--max-gap SECONDS] [--json]
+
+Reports, for every device, the number of fixes, the distance travelled and
+the number of visits to and time spent in each zone. Files may be location
+history files written by the tracker (.hist), NumPy structured arrays (.npy)
+with timestamp, latitude, longitude and optionally device fields, or CSV
+files with timestamp, device, latitude and longitude columns.
+
+Each file must hold every device's fixes in time order, as the tracker's
+history files do, and files must not overlap in time for the same device,
+though they may be given in any order. Files are split into chunks which
+are analysed separately, so input that breaks this is rejected rather than
+giving results which depend on the chunk size.
+"""
+import argparse
+import csv
+import io
+import json
+import mmap
+import os
+import sys
+from datetime import datetime
+from typing import Optional, Iterator
+
+import numpy as np
+
+from libtracker.constants import ATTR_LATITUDE, ATTR_LONGITUDE, CONFIG_ZONES
+from libtracker.distance import geodesic, lambert
+from libtracker.geodesic import inverse_vincenty_batch
+from libtracker.history import LocationHistory, HISTORY_EXTENSION
+from libtracker.state import StateMachine
+from libtracker.zone import PreparedZone, in_zone_batch, setup_zones
+
+# Rows handed to a worker at a time. Bounds the memory used by each worker.
+DEFAULT_CHUNK_SIZE = 100_000
+# Rough size of a CSV row, used to turn the chunk size into a byte range.
+CSV_BYTES_PER_ROW = 64
+# Time between two fixes is only counted as time spent in a zone if the fixes
+# are at most this far apart. Longer gaps are unknown.
+DEFAULT_MAX_GAP = 3600  # s
+
+FORMAT_HISTORY = "history"
+FORMAT_NUMPY = "numpy"
+FORMAT_CSV = "csv"
+
+FORMATS = {
+    HISTORY_EXTENSION: FORMAT_HISTORY,
+    ".npy": FORMAT_NUMPY,
+    ".csv": FORMAT_CSV,
+}
+
+
+class DeviceStats:
+    """
+    Statistics of one device over a span of its history.
+
+    Each chunk of input produces one DeviceStats per device in it. Stats of
+    consecutive spans merge into the stats of the whole, so chunks can be
+    analysed in any order and in separate processes. Spans which overlap in
+    time can't be merged.
+
+    The time from a fix to the next one is counted towards every zone the
+    first fix is inside, and a visit starts at each fix inside a zone that
+    the previous fix was not inside.
+    """
+    __slots__ = ("device", "points", "distance", "dwell", "visits",
+                 "first", "last", "first_zones", "last_zones")
+
+    def __init__(self, device: str) -> None:
+        self.device = device
+        self.points = 0
+        # km
+        self.distance = 0.0
+        # zone -> seconds
+        self.dwell: dict[str, float] = {}
+        # zone -> number of visits
+        self.visits: dict[str, int] = {}
+        # (timestamp, latitude, longitude) of the first and last fix
+        self.first: Optional[tuple] = None
+        self.last: Optional[tuple] = None
+        # Zones the first and last fix are inside
+        self.first_zones: frozenset = frozenset()
+        self.last_zones: frozenset = frozenset()
+
+    def merge(self, other: "DeviceStats",
+              max_gap: Optional[float] = DEFAULT_MAX_GAP) -> None:
+        """
+        Add the stats of the span which follows this one.
+        :param other: Stats of the following span of the same device
+        :param max_gap: See DEFAULT_MAX_GAP. None to count every gap.
+        :return: None
+        :raises ValueError: If other starts before this span ends.
+        """
+        if other.first is None:
+            return
+        if self.last is not None and other.first[0] < self.last[0]:
+            raise ValueError(
+                f"Fixes of {self.device} overlap in time: a span from "
+                f"{other.first[0]} to {other.last[0]} starts before the span "
+                f"ending at {self.last[0]}. Sort each device's fixes by time."
+            )
+        if self.first is None:
+            self.first, self.first_zones = other.first, other.first_zones
+        else:
+            # Join the last fix of this span to the first of the next.
+            self.distance += geodesic(self.last[1:], other.first[1:])
+            gap = other.first[0] - self.last[0]
+            if max_gap is None or gap <= max_gap:
+                for zone in self.last_zones:
+                    self.dwell[zone] = self.dwell.get(zone, 0.0) + gap
+            # A visit continuing across the join was counted as a new visit
+            # at the start of the next span.
+            for zone in self.last_zones & other.first_zones:
+                self.visits[zone] = self.visits.get(zone, 0) - 1
+
+        self.points += other.points
+        self.distance += other.distance
+        for zone, seconds in other.dwell.items():
+            self.dwell[zone] = self.dwell.get(zone, 0.0) + seconds
+        for zone, count in other.visits.items():
+            self.visits[zone] = self.visits.get(zone, 0) + count
+        self.last, self.last_zones = other.last, other.last_zones
+
+    def to_dict(self) -> dict:
+        zones = sorted(set(self.dwell) | set(self.visits))
+        return {
+            "device": self.device,
+            "points": self.points,
+            "first_seen": self.first[0] if self.first else None,
+            "last_seen": self.last[0] if self.last else None,
+            "distance_km": round(self.distance, 6),
+            "zones": {zone: {"visits": self.visits.get(zone, 0),
+                             "dwell_s": self.dwell.get(zone, 0.0)}
+                      for zone in zones},
+        }
+
+
+def summarise(timestamps, latitudes, longitudes, devices, names: list,
+              zones: list, max_gap: Optional[float] = DEFAULT_MAX_GAP) \
+        -> dict[str, DeviceStats]:
+    """
+    Compute the stats of every device in a chunk of fixes.
+    :param timestamps: Array of Unix times
+    :param latitudes: Array of latitudes
+    :param longitudes: Array of longitudes
+    :param devices: Array of indexes into names
+    :param names: Device names
+    :param zones: PreparedZones to measure dwell times and visits for
+    :param max_gap: See DEFAULT_MAX_GAP. None to count every gap.
+    :return: Dictionary of DeviceStats keyed by device name
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    devices = np.asarray(devices, dtype=np.intp)
+
+    # Drop fixes without a position, then order by device and time.
+    valid = ~(np.isnan(latitudes) | np.isnan(longitudes) |
+              np.isnan(timestamps))
+    order = np.lexsort((timestamps[valid], devices[valid]))
+    t = timestamps[valid][order]
+    lat = latitudes[valid][order]
+    lon = longitudes[valid][order]
+    codes = devices[valid][order]
+    n_devices = len(names)
+
+    # Consecutive fixes of the same device.
+    pairs = np.flatnonzero(codes[1:] == codes[:-1])
+    pair_codes = codes[pairs]
+    gaps = t[pairs + 1] - t[pairs]
+    counted = gaps <= max_gap if max_gap is not None \
+        else np.ones(pairs.size, dtype=bool)
+
+    distances = inverse_vincenty_batch(
+        np.stack([lat[pairs], lon[pairs]], axis=-1),
+        np.stack([lat[pairs + 1], lon[pairs + 1]], axis=-1)
+    )
+    # Nearly antipodal pairs, as geodesic does.
+    for i in np.flatnonzero(np.isnan(distances)):
+        distances[i] = lambert((lat[pairs[i]], lon[pairs[i]]),
+                               (lat[pairs[i] + 1], lon[pairs[i] + 1]))
+    distance = np.bincount(pair_codes, weights=distances,
+                           minlength=n_devices)
+
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) \
+        if codes.size else np.empty(0, dtype=np.intp)
+    ends = np.r_[starts[1:] - 1, codes.size - 1].astype(np.intp) \
+        if codes.size else starts
+    points = np.bincount(codes, minlength=n_devices)
+
+    dwell = {}
+    visits = {}
+    inside = {}
+    for zone in zones:
+        inside[zone.entity_id] = mask = _inside(zone, lat, lon)
+        dwell[zone.entity_id] = np.bincount(
+            pair_codes, weights=np.where(mask[pairs] & counted, gaps, 0.0),
+            minlength=n_devices
+        )
+        entered = mask.copy()
+        entered[pairs + 1] &= ~mask[pairs]
+        visits[zone.entity_id] = np.bincount(codes[entered],
+                                             minlength=n_devices)
+
+    stats = {}
+    for start, end in zip(starts, ends):
+        code = codes[start]
+        device = stats[names[code]] = DeviceStats(names[code])
+        device.points = int(points[code])
+        device.distance = float(distance[code])
+        device.first = (float(t[start]), float(lat[start]), float(lon[start]))
+        device.last = (float(t[end]), float(lat[end]), float(lon[end]))
+        device.first_zones = frozenset(z for z, mask in inside.items()
+                                       if mask[start])
+        device.last_zones = frozenset(z for z, mask in inside.items()
+                                      if mask[end])
+        for zone in inside:
+            if visits[zone][code]:
+                device.visits[zone] = int(visits[zone][code])
+                device.dwell[zone] = float(dwell[zone][code])
+
+    return stats
+
+
+def _inside(zone: PreparedZone, latitudes: np.ndarray,
+            longitudes: np.ndarray) -> np.ndarray:
+    """
+    in_zone for an array of points. Only points inside the zone's bounding
+    box are measured.
+    """
+    mask = np.zeros(latitudes.size, dtype=bool)
+    if zone.bbox is None:
+        candidates = np.arange(latitudes.size)
+    else:
+        min_lat, min_lon, max_lat, max_lon = zone.bbox
+        d_lon = (longitudes - zone.longitude + 180) % 360 - 180
+        candidates = np.flatnonzero(
+            (latitudes >= min_lat) & (latitudes <= max_lat) &
+            (np.abs(d_lon) <= max_lon - zone.longitude)
+        )
+    if candidates.size:
+        mask[candidates] = in_zone_batch(zone, latitudes[candidates],
+                                         longitudes[candidates])
+    return mask
+
+
+def _timestamps(values: list) -> np.ndarray:
+    """ Convert Unix times or ISO 8601 strings to an array of Unix times. """
+    try:
+        return np.array(values, dtype=np.float64)
+    except ValueError:
+        return np.array([
+            float(value) if value.replace(".", "", 1).isdigit() else
+            datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+            for value in values
+        ])
+
+
+def _read_chunk(task: tuple) -> tuple:
+    """
+    Read one chunk of an input file.
+    :return: (timestamps, latitudes, longitudes, device codes, names)
+    """
+    fmt, path, start, end = task[:4]
+
+    if fmt == FORMAT_HISTORY:
+        history = LocationHistory.open(path, readonly=True)
+        records = history.records()[start:end]
+        name = os.path.splitext(os.path.basename(path))[0]
+        return (records["timestamp"], records["latitude"],
+                records["longitude"], np.zeros(len(records), dtype=np.intp),
+                [name])
+
+    if fmt == FORMAT_NUMPY:
+        records = np.load(path, mmap_mode="r")[start:end]
+        if "device" in records.dtype.names:
+            names, codes = np.unique(records["device"], return_inverse=True)
+            names = [n.decode() if isinstance(n, bytes) else str(n)
+                     for n in names]
+        else:
+            names = [os.path.splitext(os.path.basename(path))[0]]
+            codes = np.zeros(len(records), dtype=np.intp)
+        return (records["timestamp"], records[ATTR_LATITUDE],
+                records[ATTR_LONGITUDE], codes, names)
+
+    header = task[4]
+    with open(path, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        text = data[start:end].decode()
+    rows = list(csv.reader(io.StringIO(text)))
+    if not rows:
+        return np.empty(0), np.empty(0), np.empty(0), \
+            np.empty(0, dtype=np.intp), []
+    columns = dict(zip(header, zip(*rows)))
+    names, codes = np.unique(np.array(columns["device"]),
+                             return_inverse=True)
+    return (_timestamps(list(columns["timestamp"])),
+            np.array(columns[ATTR_LATITUDE], dtype=np.float64),
+            np.array(columns[ATTR_LONGITUDE], dtype=np.float64),
+            codes, [str(name) for name in names])
+
+
+def _analyze_chunk(task: tuple, zones: list,
+                   max_gap: Optional[float]) -> dict[str, DeviceStats]:
+    """ Worker: summarise one chunk. zones are (entity_id, attrs) pairs. """
+    zones = [PreparedZone(entity_id, attrs) for entity_id, attrs in zones]
+    return summarise(*_read_chunk(task), zones, max_gap)
+
+
+def chunk_tasks(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE) \
+        -> Iterator[tuple]:
+    """
+    Split an input file into chunks which can be read independently.
+    :param path: Path to the input file
+    :param chunk_size: Rows per chunk
+    :return: Iterator of tasks for _read_chunk
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if (fmt := FORMATS.get(extension)) is None:
+        raise ValueError(f"Unsupported history format: {path}")
+
+    if fmt in (FORMAT_HISTORY, FORMAT_NUMPY):
+        if fmt == FORMAT_HISTORY:
+            rows = len(LocationHistory.open(path, readonly=True))
+        else:
+            rows = len(np.load(path, mmap_mode="r"))
+        for start in range(0, rows, chunk_size):
+            yield fmt, path, start, min(start + chunk_size, rows)
+        return
+
+    # CSV chunks are byte ranges ending on a line break.
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            header_end = data.find(b"\n") + 1 or len(data)
+            header = next(csv.reader([data[:header_end].decode()]))
+            header = tuple(field.strip() for field in header)
+
+            start = header_end
+            while start < len(data):
+                end = data.find(b"\n", start + chunk_size * CSV_BYTES_PER_ROW)
+                end = len(data) if end == -1 else end + 1
+                yield fmt, path, start, end, header
+                start = end
+
+
+def analyze(paths: list, zones: list, workers: int = None,
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+            max_gap: Optional[float] = DEFAULT_MAX_GAP) \
+        -> dict[str, DeviceStats]:
+    """
+    Analyse history files, splitting the work across a process pool.
+
+    The history of a device may be spread over several files and chunks, but
+    the spans they hold must not overlap in time.
+    :param paths: Input files
+    :param zones: PreparedZones, e.g. from iterating a ZoneIndex
+    :param workers: Number of processes, defaults to one per CPU. 1 runs in
+        the calling process.
+    :param chunk_size: Rows per chunk
+    :param max_gap: See DEFAULT_MAX_GAP. None to count every gap.
+    :return: Dictionary of DeviceStats keyed by device name
+    :raises ValueError: If a file's format is unsupported or the spans of
+        a device overlap.
+    """
+    tasks = [task for path in paths for task in chunk_tasks(path, chunk_size)]
+    zone_args = [(zone.entity_id, dict(zone.attrs)) for zone in zones]
+    workers = min(workers or os.cpu_count() or 1, max(len(tasks), 1))
+
+    if workers == 1:
+        results = (_analyze_chunk(task, zone_args, max_gap)
+                   for task in tasks)
+        return _combine(results, max_gap)
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        results = pool.map(_analyze_chunk, tasks, [zone_args] * len(tasks),
+                           [max_gap] * len(tasks))
+        return _combine(results, max_gap)
+
+
+def _combine(results, max_gap: Optional[float]) -> dict[str, DeviceStats]:
+    """ Merge the per chunk stats of each device in time order. """
+    spans: dict[str, list] = {}
+    for chunk in results:
+        for name, stats in chunk.items():
+            spans.setdefault(name, []).append(stats)
+
+    combined = {}
+    for name in sorted(spans):
+        total = combined[name] = DeviceStats(name)
+        for stats in sorted(spans[name], key=lambda s: s.first[0]):
+            total.merge(stats, max_gap)
+
+    return combined
+
+
+def format_report(stats: dict[str, DeviceStats]) -> str:
+    """ Format the output of analyze for printing. """
+    lines = []
+    for device in stats.values():
+        lines.append(f"{device.device}: {device.points} fixes, "
+                     f"{device.distance:.3f} km")
+        for zone, entry in device.to_dict()["zones"].items():
+            lines.append(f"  {zone}: {entry['visits']} visits, "
+                         f"{entry['dwell_s'] / 3600:.2f} h")
+    return "\n".join(lines)
+
+
+def _zone_config(args) -> dict:
+    """ Build a configuration with the zones given on the command line. """
+    from libtracker.config import load_config, resolve_config
+    from libtracker.constants import DEFAULT_CONFIG_PATH
+
+    if args.config is None and args.home is None:
+        config_path = resolve_config(DEFAULT_CONFIG_PATH)[1]
+        if os.path.exists(config_path):
+            args.config = config_path
+    config = dict(load_config(args.config)) if args.config else {}
+
+    if args.home is not None:
+        latitude, longitude = (float(x) for x in args.home.split(","))
+        config.update({"home_name": "Home", ATTR_LATITUDE: latitude,
+                       ATTR_LONGITUDE: longitude})
+    if ATTR_LATITUDE not in config:
+        raise SystemExit("Give the home zone with --home or --config.")
+
+    zones = list(config.get(CONFIG_ZONES) or [])
+    for zone in args.zone:
+        name, *values = zone.split(",")
+        entry = {"name": name, ATTR_LATITUDE: float(values[0]),
+                 ATTR_LONGITUDE: float(values[1])}
+        if len(values) > 2:
+            entry["radius"] = float(values[2])
+        zones.append(entry)
+    config[CONFIG_ZONES] = zones
+    config.setdefault("home_name", "Home")
+
+    return config
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m libtracker analyze",
+                                     description=__doc__.splitlines()[1])
+    parser.add_argument("files", nargs="+",
+                        help="history files to analyse, each holding every "
+                             "device's fixes in time order")
+    parser.add_argument("--config", help="libtracker config to read zones "
+                                         "from")
+    parser.add_argument("--home", help="home zone as LAT,LON")
+    parser.add_argument("--zone", action="append", default=[],
+                        help="extra zone as NAME,LAT,LON[,RADIUS]")
+    parser.add_argument("--workers", type=int,
+                        help="number of processes (default: one per CPU)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="rows per chunk")
+    parser.add_argument("--max-gap", type=float, default=DEFAULT_MAX_GAP,
+                        help="longest gap between fixes counted as time in "
+                             "a zone, in seconds (0 for no limit)")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    index = setup_zones(StateMachine(), _zone_config(args))
+    try:
+        stats = analyze(args.files, list(index), args.workers,
+                        args.chunk_size, args.max_gap or None)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+    if args.json:
+        json.dump([device.to_dict() for device in stats.values()],
+                  sys.stdout, indent=2)
+        print()
+    else:
+        print(format_report(stats))
+    return 0
@@ -0,0 +1,244 @@
+import json
+import threading
+import uuid
+from typing import Optional, Tuple
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from libtracker.constants import CONFIG_API_PORT, CONFIG_API_ADDRESS
+from libtracker.state import StateMachine
+
+DEFAULT_API_ADDRESS = "127.0.0.1"
+JSON_CONTENT_TYPE = "application/json"
+SSE_CONTENT_TYPE = "text/event-stream"
+
+# A comment is sent on idle event streams this often, so dead clients are
+# noticed and proxies don't time the connection out.
+SSE_KEEPALIVE = 15  # s
+
+# State machine versions start again from 0 in every process, so versions
+# handed to clients are prefixed with this. A version from before a restart
+# is then never mistaken for one of the current state table.
+BOOT_ID = uuid.uuid4().hex[:12]
+
+
+class _StateFeed:
+    """
+    Shared between the request handlers of one server. Caches the encoded
+    state table for the current version, so any number of clients polling an
+    unchanged table cost one serialisation, and wakes event streams when the
+    state machine changes.
+    """
+    def __init__(self, sm: StateMachine) -> None:
+        self.sm = sm
+        self.changed = threading.Condition()
+        self.closed = False
+        self._cache: Tuple[int, Optional[bytes]] = (-1, None)
+        self._cache_lock = threading.Lock()
+        self._unsubscribe = sm.subscribe(self._on_state_change)
+
+    def _on_state_change(self, entity_id, old_state, new_state) -> None:
+        with self.changed:
+            self.changed.notify_all()
+
+    def close(self) -> None:
+        self._unsubscribe()
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+    def full(self) -> Tuple[int, bytes]:
+        """ Get the current version and the encoded table of every state. """
+        with self._cache_lock:
+            if self._cache[0] != self.sm.version:
+                version, states = self.sm.changes_since(0)
+                self._cache = (version, _encode(version, states, True))
+            return self._cache
+
+    def since(self, version: int) -> Tuple[int, bytes]:
+        """
+        Get the current version and the encoded states changed after
+        version. Everything is returned for version 0, or if version is
+        ahead of the state machine.
+        """
+        if version <= 0 or version > self.sm.version:
+            return self.full()
+        current, states = self.sm.changes_since(version)
+        return current, _encode(current, states, False)
+
+    def wait(self, version: int, timeout: float) -> bool:
+        """
+        Wait until the state machine is past version.
+        :return: False if the feed was closed.
+        """
+        with self.changed:
+            self.changed.wait_for(
+                lambda: self.sm.version != version or self.closed, timeout
+            )
+            return not self.closed
+
+
+def _encode(version: int, states: list, full: bool) -> bytes:
+    return json.dumps({"version": _token(version), "full": full,
+                       "states": states},
+                      separators=(",", ":"), default=str).encode()
+
+
+def _token(version: int) -> str:
+    """ Get the version handed to clients for a state machine version. """
+    return f"{BOOT_ID}-{version}"
+
+
+def _parse_token(token: str) -> Optional[int]:
+    """
+    Read a version handed to a client.
+    :param token: Version from a client
+    :return: The state machine version, 0 for one handed out by another
+        process or for "0", or None if token isn't a version.
+    """
+    if token == "0":
+        return 0
+    boot, _, version = token.rpartition("-")
+    if not boot or not version.isdigit():
+        return None
+    return int(version) if boot == BOOT_ID else 0
+
+
+def _etag(version: int) -> str:
+    return f'"{_token(version)}"'
+
+
+def start_api_server(sm: StateMachine, port: int,
+                     address: str = DEFAULT_API_ADDRESS):
+    """
+    Serve the states of a state machine over HTTP from a background thread.
+
+    GET /states returns every state along with the state machine version,
+    which is also the ETag, so a client sending If-None-Match gets 304 Not
+    Modified until something changes. Versions are prefixed with BOOT_ID,
+    so they are never reused after a restart. GET /states?since=<version>
+    returns only the states changed after that version, or every state if
+    it is from before a restart. GET /states/<entity_id>
+    returns a single state. GET /stream is a server-sent event stream which
+    sends every state, or those changed after ?since= or Last-Event-ID, and
+    then each change as it is committed.
+
+    :param sm: State machine to serve
+    :param port: Port to listen on, 0 for any free port
+    :param address: Address to listen on. Defaults to localhost only.
+    :return: The running ThreadingHTTPServer. Call shutdown() to stop it.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    feed = _StateFeed(sm)
+
+    class StateHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self) -> None:
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            since = _parse_token(query.get("since", ["0"])[0])
+            if since is None:
+                self.send_error(400, "since must be a version from this API")
+                return
+
+            if url.path in ("/states", "/states/"):
+                self._send_states(since)
+            elif url.path.startswith("/states/"):
+                self._send_state(unquote(url.path[len("/states/"):]))
+            elif url.path == "/stream":
+                if "since" not in query:
+                    # Resume where a reconnecting client left off.
+                    since = _parse_token(
+                        self.headers.get("Last-Event-ID", "")) or 0
+                self._stream(since)
+            else:
+                self.send_error(404)
+
+        def _send_json(self, body: bytes, version: int) -> None:
+            self.send_response(200)
+            self.send_header("Content-Type", JSON_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", _etag(version))
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _not_modified(self, version: int) -> bool:
+            if self.headers.get("If-None-Match") != _etag(version):
+                return False
+            self.send_response(304)
+            self.send_header("ETag", _etag(version))
+            self.end_headers()
+            return True
+
+        def _send_states(self, since: int) -> None:
+            if self._not_modified(sm.version):
+                return
+            version, body = feed.since(since)
+            self._send_json(body, version)
+
+        def _send_state(self, entity_id: str) -> None:
+            version = sm.version
+            if (state := sm.get(entity_id.lower())) is None:
+                self.send_error(404, f"No entity {entity_id}")
+                return
+            if self._not_modified(version):
+                return
+            self._send_json(json.dumps(state.to_dict(), separators=(",", ":"),
+                                       default=str).encode(), version)
+
+        def _stream(self, version: int) -> None:
+            self.send_response(200)
+            self.send_header("Content-Type", SSE_CONTENT_TYPE)
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+
+            try:
+                while True:
+                    if version != sm.version:
+                        version, body = feed.since(version)
+                        self.wfile.write(b"id: %s\nevent: states\ndata: %s\n\n"
+                                         % (_token(version).encode(), body))
+                    elif not feed.wait(version, SSE_KEEPALIVE):
+                        return
+                    elif version == sm.version:
+                        self.wfile.write(b": keepalive\n\n")
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # The client went away.
+                pass
+
+        def log_message(self, format: str, *args) -> None:
+            # Dashboards poll too often for requests to be worth logging.
+            pass
+
+    class StateServer(ThreadingHTTPServer):
+        daemon_threads = True
+
+        def shutdown(self) -> None:
+            # End open event streams as well as the accept loop.
+            feed.close()
+            super().shutdown()
+
+    server = StateServer((address, port), StateHandler)
+    threading.Thread(target=server.serve_forever, name="libtracker-api",
+                     daemon=True).start()
+    return server
+
+
+def start_from_config(sm: StateMachine, config: dict):
+    """
+    Start the state API if an API port is configured.
+    :param sm: State machine to serve
+    :param config: Libtracker configuration object
+    :return: The running server, or None if the API is not configured.
+    """
+    if (port := config.get(CONFIG_API_PORT)) is None:
+        return None
+
+    return start_api_server(
+        sm, int(port), config.get(CONFIG_API_ADDRESS, DEFAULT_API_ADDRESS)
+    )
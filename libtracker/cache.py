@@ -0,0 +1,146 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Callable
+
+from libtracker.constants import (
+    ATTR_LATITUDE,
+    ATTR_LONGITUDE,
+    CONFIG_DISTANCE_CACHE_SIZE,
+    CONFIG_DISTANCE_CACHE_PRECISION,
+    CONFIG_DISTANCE_CACHE_TTL,
+)
+from libtracker.state import State, StateMachine
+from libtracker.zone import prepare_zone
+
+DEFAULT_CACHE_SIZE = 4096
+# Decimal places of latitude/longitude kept in cache keys. 4 places is about
+# 11m of latitude, so a parked phone whose fix wanders by a few metres keeps
+# hitting the same few keys, and a cached distance is never more than the
+# diagonal of one key's cell (about 13m) from the exact answer. At 5 or more
+# places the jitter alone makes most keys new (see distance_cache.* in
+# benchmarks/bench.py).
+DEFAULT_CACHE_PRECISION = 4
+
+_MISSING = object()
+
+
+class DistanceCache:
+    """
+    Bounded LRU cache of distances between zones and device positions.
+
+    Device coordinates are rounded to precision decimal places to form the
+    key, so a stationary device whose reported position jitters below that
+    precision is answered from the cache instead of running Vincenty again.
+    Entries can also expire after ttl seconds. Entries for a zone are dropped
+    when the zone moves. Because of the rounding a cached distance is only
+    approximate, so it must not be used to decide zone membership.
+    """
+    def __init__(self, maxsize: int = DEFAULT_CACHE_SIZE,
+                 precision: int = DEFAULT_CACHE_PRECISION,
+                 ttl: float = None) -> None:
+        self.maxsize = maxsize
+        self.precision = precision
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._scale = 10 ** precision
+        self._entries: OrderedDict = OrderedDict()
+        self._zone_keys: dict[str, set] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["DistanceCache"]:
+        """
+        Create a cache using the configured size, precision and TTL.
+        :param config: Libtracker configuration object
+        :return: The cache, or None if the configured size is 0.
+        """
+        maxsize = config.get(CONFIG_DISTANCE_CACHE_SIZE, DEFAULT_CACHE_SIZE)
+        if not maxsize:
+            return None
+
+        return cls(int(maxsize),
+                   int(config.get(CONFIG_DISTANCE_CACHE_PRECISION,
+                                  DEFAULT_CACHE_PRECISION)),
+                   config.get(CONFIG_DISTANCE_CACHE_TTL))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, int]:
+        """ Get the hit and miss counters and the number of entries. """
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._entries)}
+
+    def zone_distance(self, zone: State, latitude: float,
+                      longitude: float) -> Optional[float]:
+        """
+        Get the distance between a zone and a point.
+        :param zone: The zone state or PreparedZone to measure from
+        :param latitude: Latitude of device
+        :param longitude: Longitude of device
+        :return: Distance in kilometers, or None if Vincenty did not converge.
+        """
+        latitude, longitude = float(latitude), float(longitude)
+        key = (zone.entity_id, round(latitude * self._scale),
+               round(longitude * self._scale))
+
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                distance, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return distance
+            self.misses += 1
+
+        distance = prepare_zone(zone).distance(latitude, longitude)
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+
+        with self._lock:
+            self._entries[key] = (distance, expires)
+            self._entries.move_to_end(key)
+            self._zone_keys.setdefault(zone.entity_id, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                old_key, _ = self._entries.popitem(last=False)
+                self._zone_keys[old_key[0]].discard(old_key)
+
+        return distance
+
+    def invalidate_zone(self, entity_id: str) -> None:
+        """
+        Drop every cached distance for a zone.
+        :param entity_id: The entity ID of the zone
+        :return: None
+        """
+        with self._lock:
+            for key in self._zone_keys.pop(entity_id, ()):
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """ Drop every cached distance and reset the counters. """
+        with self._lock:
+            self._entries.clear()
+            self._zone_keys.clear()
+            self.hits = self.misses = 0
+
+    def watch(self, sm: StateMachine) -> Callable[[], None]:
+        """
+        Invalidate a zone's distances whenever its position changes in the
+        state machine.
+        :param sm: State machine instance
+        :return: A callable which stops watching.
+        """
+        def on_change(entity_id: str, old_state: Optional[State],
+                      new_state: State) -> None:
+            if not entity_id.startswith("zone.") or old_state is None:
+                return
+            old, new = old_state.attrs, new_state.attrs
+            if old.get(ATTR_LATITUDE) != new.get(ATTR_LATITUDE) or \
+                    old.get(ATTR_LONGITUDE) != new.get(ATTR_LONGITUDE):
+                self.invalidate_zone(entity_id)
+
+        return sm.subscribe(on_change)
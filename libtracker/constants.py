@@ -5,6 +5,7 @@ ATTR_LONGITUDE: Final = "longitude"
 ATTR_RADIUS: Final = "radius"
 ATTR_ENTITY_ID: Final = "entity_id"
 ATTR_ATTRS: Final = "attrs"
+ATTR_TIMESTAMP: Final = "timestamp"
 
 DEFAULT_CONFIG_PATH: Final = "config.json"
 CONFIG_DIRNAME: Final = ".libtracker"
@@ -12,4 +13,38 @@ CONFIG_DIRNAME: Final = ".libtracker"
 CONFIG_APPLE_ID_USERNAME: Final = "apple_username"
 CONFIG_APPLE_ID_PASSWORD: Final = "apple_password"
 CONFIG_TELEGRAM_BOT_TOKEN: Final = "telegram_token"
-CONFIG_TELEGRAM_USERS: Final = "telegram_users"
\ No newline at end of file
+CONFIG_TELEGRAM_USERS: Final = "telegram_users"
+CONFIG_ZONES: Final = "zones"
+CONFIG_MAX_WORKERS: Final = "max_workers"
+CONFIG_HISTORY_CAPACITY: Final = "history_capacity"
+CONFIG_HISTORY_DIR: Final = "history_dir"
+CONFIG_DISTANCE_CACHE_SIZE: Final = "distance_cache_size"
+CONFIG_DISTANCE_CACHE_PRECISION: Final = "distance_cache_precision"
+CONFIG_DISTANCE_CACHE_TTL: Final = "distance_cache_ttl"
+CONFIG_DISTANCE_ACCURACY: Final = "distance_accuracy"
+CONFIG_SCAN_ADAPTIVE: Final = "scan_adaptive"
+CONFIG_SCAN_MIN_INTERVAL: Final = "scan_min_interval"
+CONFIG_SCAN_MAX_INTERVAL: Final = "scan_max_interval"
+CONFIG_SCAN_BUDGET: Final = "scan_budget"
+CONFIG_APPLE_ACCOUNTS: Final = "apple_accounts"
+CONFIG_ACCOUNT_NAME: Final = "name"
+CONFIG_SCAN_WORKERS: Final = "scan_workers"
+CONFIG_REPLAY_TRACES: Final = "replay_traces"
+CONFIG_REPLAY_SPEED: Final = "replay_speed"
+CONFIG_REPLAY_COPIES: Final = "replay_copies"
+CONFIG_SNAPSHOT_PATH: Final = "snapshot_path"
+CONFIG_SNAPSHOT_INTERVAL: Final = "snapshot_interval"
+CONFIG_METRICS_PORT: Final = "metrics_port"
+CONFIG_METRICS_ADDRESS: Final = "metrics_address"
+CONFIG_LOG_LEVEL: Final = "log_level"
+CONFIG_LOG_FORMAT: Final = "log_format"
+CONFIG_GEOFENCE_HYSTERESIS: Final = "geofence_hysteresis"
+CONFIG_GEOFENCE_DEBOUNCE: Final = "geofence_debounce"
+CONFIG_GEOFENCE_DWELL: Final = "geofence_dwell"
+CONFIG_API_PORT: Final = "api_port"
+CONFIG_API_ADDRESS: Final = "api_address"
+CONFIG_STATUS_FIELDS: Final = "status_fields"
+CONFIG_PROXIMITY_RADIUS: Final = "proximity_radius"
+CONFIG_TRIPS: Final = "trips"
+CONFIG_TRIP_STOP_RADIUS: Final = "trip_stop_radius"
+CONFIG_TRIP_STOP_DURATION: Final = "trip_stop_duration"
@@ -0,0 +1,194 @@
+import math
+from typing import Tuple, Union
+
+from libtracker.state import State
+from libtracker.zone import (
+    inverse_vincenty,
+    prepare_zone,
+    PreparedZone,
+    EARTH_SEMI_MAJOR_AXIS,
+    EARTH_SEMI_MINOR_AXIS,
+)
+
+ACCURACY_EXACT = "exact"
+ACCURACY_TIERED = "tiered"
+ACCURACY_FAST = "fast"
+ACCURACY_MODES = (ACCURACY_EXACT, ACCURACY_TIERED, ACCURACY_FAST)
+
+FLATTENING = 1 / 298.257223563  # f = (a - b) / a
+ECCENTRICITY_SQ = FLATTENING * (2 - FLATTENING)
+
+EARTH_MEAN_RADIUS = (2 * EARTH_SEMI_MAJOR_AXIS + EARTH_SEMI_MINOR_AXIS) / 3
+
+# Smallest and largest radius of curvature anywhere on the ellipsoid: the
+# meridional radius at the equator and the prime vertical radius at the poles.
+# The ellipsoid's metric is never shorter than the first or longer than the
+# second in any direction, which is what all the bounds below rest on.
+MIN_RADIUS_OF_CURVATURE = EARTH_SEMI_MAJOR_AXIS * (1 - ECCENTRICITY_SQ)
+MAX_RADIUS_OF_CURVATURE = EARTH_SEMI_MAJOR_AXIS / math.sqrt(1 - ECCENTRICITY_SQ)
+
+# Geodesic distance lies within these multiples of the haversine distance on
+# a sphere of the mean radius.
+HAVERSINE_LOWER_RATIO = MIN_RADIUS_OF_CURVATURE / EARTH_MEAN_RADIUS
+HAVERSINE_UPPER_RATIO = MAX_RADIUS_OF_CURVATURE / EARTH_MEAN_RADIUS
+
+# Bounds closer than this to the zone boundary are left to Vincenty, which
+# rounds to the millimetre.
+BOUNDARY_MARGIN = 0.01  # m
+
+
+def haversine(theta_1: Tuple[float, float],
+              theta_2: Tuple[float, float]) -> float:
+    """
+    Great circle distance on a sphere of the Earth's mean radius.
+    Where:
+        ϕ1 = tuple(latitude, longitude)
+        ϕ2 = tuple(latitude, longitude)
+    Result is returned in kilometers. The distance on the ellipsoid is
+    between HAVERSINE_LOWER_RATIO and HAVERSINE_UPPER_RATIO (about 0.9944 and
+    1.0045) times this.
+    """
+    lat_1 = math.radians(theta_1[0])
+    lat_2 = math.radians(theta_2[0])
+    d_lat = lat_2 - lat_1
+    d_lon = math.radians(theta_2[1] - theta_1[1])
+
+    h = math.sin(d_lat / 2) ** 2 + \
+        math.cos(lat_1) * math.cos(lat_2) * math.sin(d_lon / 2) ** 2
+
+    return 2 * EARTH_MEAN_RADIUS * math.asin(min(1.0, math.sqrt(h))) / 1000
+
+
+def lambert(theta_1: Tuple[float, float],
+            theta_2: Tuple[float, float]) -> float:
+    """
+    Lambert's formula for the distance between two points on the ellipsoid.
+    It is not iterative, so unlike inverse_vincenty it always gives an answer,
+    including for nearly antipodal points. Accurate to around 10 metres over
+    thousands of kilometres.
+    Result is returned in kilometers.
+    """
+    beta_1 = math.atan((1 - FLATTENING) * math.tan(math.radians(theta_1[0])))
+    beta_2 = math.atan((1 - FLATTENING) * math.tan(math.radians(theta_2[0])))
+    d_lon = math.radians(theta_2[1] - theta_1[1])
+
+    # Central angle between the reduced latitudes.
+    h = math.sin((beta_2 - beta_1) / 2) ** 2 + \
+        math.cos(beta_1) * math.cos(beta_2) * math.sin(d_lon / 2) ** 2
+    sigma = 2 * math.asin(min(1.0, math.sqrt(h)))
+    if sigma == 0:
+        return 0.00
+
+    p = (beta_1 + beta_2) / 2
+    q = (beta_2 - beta_1) / 2
+    sin_sigma = math.sin(sigma)
+    cos_half_sq = math.cos(sigma / 2) ** 2
+    sin_half_sq = math.sin(sigma / 2) ** 2
+
+    x = 0.0 if cos_half_sq == 0 else \
+        (sigma - sin_sigma) * math.sin(p) ** 2 * math.cos(q) ** 2 / cos_half_sq
+    y = (sigma + sin_sigma) * math.cos(p) ** 2 * math.sin(q) ** 2 / sin_half_sq
+
+    s = EARTH_SEMI_MAJOR_AXIS * (sigma - FLATTENING / 2 * (x + y))
+    return round(s / 1000, 6)
+
+
+def geodesic(theta_1: Tuple[float, float],
+             theta_2: Tuple[float, float]) -> float:
+    """
+    inverse_vincenty, falling back to Lambert's formula for the nearly
+    antipodal points where Vincenty does not converge.
+    Result is returned in kilometers.
+    """
+    distance = inverse_vincenty(theta_1, theta_2)
+    if distance is None:
+        distance = lambert(theta_1, theta_2)
+    return distance
+
+
+def _zone_haversine(zone: PreparedZone, latitude: float,
+                    longitude: float) -> float:
+    """ haversine from a prepared zone, reusing its latitude terms. """
+    lat_2 = math.radians(latitude)
+    d_lon = math.radians(longitude - zone.longitude)
+
+    h = math.sin((lat_2 - zone.lat_rad) / 2) ** 2 + \
+        zone.cos_lat * math.cos(lat_2) * math.sin(d_lon / 2) ** 2
+
+    return 2 * EARTH_MEAN_RADIUS * math.asin(min(1.0, math.sqrt(h))) / 1000
+
+
+def _lower_bound(lat_1: float, lon_1: float, lat_2: float, lon_2: float,
+                 limit: float) -> float:
+    """
+    Equirectangular lower bound in metres on the distance between two points,
+    valid for deciding whether that distance is at least limit metres.
+
+    If the distance were below limit, every point of the shortest path would
+    be within limit / MIN_RADIUS_OF_CURVATURE radians of latitude of the
+    first point. In that band one radian of latitude is at least
+    MIN_RADIUS_OF_CURVATURE long and one radian of longitude at least
+    a * cos(highest latitude in the band), so the path is at least as long as
+    the straight line in those scaled coordinates. If that length reaches
+    limit the assumption was false and the distance is at least limit.
+    """
+    d_lat = abs(math.radians(lat_2 - lat_1))
+    meridional = MIN_RADIUS_OF_CURVATURE * d_lat
+    if meridional >= limit:
+        return meridional
+
+    band = abs(math.radians(lat_1)) + limit / MIN_RADIUS_OF_CURVATURE
+    if band >= math.pi / 2:
+        return meridional
+
+    d_lon = abs(math.radians(lon_2 - lon_1)) % (2 * math.pi)
+    d_lon = min(d_lon, 2 * math.pi - d_lon)
+    parallel = EARTH_SEMI_MAJOR_AXIS * math.cos(band) * d_lon
+
+    return math.hypot(meridional, parallel)
+
+
+def zone_membership(zone: Union[State, PreparedZone], latitude: float,
+                    longitude: float, radius: int = 0,
+                    accuracy: str = ACCURACY_TIERED) -> bool:
+    """
+    Determine if a device is inside a zone, running the cheapest test that
+    can decide it.
+
+    In tiered mode a point is first rejected with an equirectangular lower
+    bound, then decided by haversine with its proven error bound, and only
+    points within that error of the zone boundary are measured with Vincenty,
+    so wherever Vincenty converges the result is the same as in_zone. Fast
+    mode decides everything by haversine and exact mode always measures with
+    Vincenty.
+    :param zone: The zone state or PreparedZone to check against
+    :param latitude: Latitude of device
+    :param longitude: Longitude of device
+    :param radius: Radius offset
+    :param accuracy: One of ACCURACY_MODES
+    :return: Boolean depending on if a device is inside a zone.
+    """
+    zone = prepare_zone(zone)
+    zone_lat, zone_lon = zone.latitude, zone.longitude
+    latitude, longitude = float(latitude), float(longitude)
+    limit = zone.radius + radius  # m
+
+    if accuracy != ACCURACY_EXACT:
+        if _lower_bound(zone_lat, zone_lon, latitude, longitude,
+                        limit + BOUNDARY_MARGIN) >= limit + BOUNDARY_MARGIN:
+            return False
+
+        distance = _zone_haversine(zone, latitude, longitude) \
+            * 1000  # km -> m
+        if accuracy == ACCURACY_FAST:
+            return distance < limit
+        if distance * HAVERSINE_LOWER_RATIO >= limit + BOUNDARY_MARGIN:
+            return False
+        if distance * HAVERSINE_UPPER_RATIO < limit - BOUNDARY_MARGIN:
+            return True
+
+    distance = zone.distance(latitude, longitude)
+    if distance is None:
+        distance = lambert((zone_lat, zone_lon), (latitude, longitude))
+
+    return distance * 1000 - radius < zone.radius
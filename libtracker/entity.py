@@ -1,5 +1,4 @@
 from abc import ABC
-from collections import defaultdict
 from typing import Any
 
 
@@ -28,15 +27,27 @@ class Entity(ABC):
 
     sm = None
     entity_id = None
+    # Whether the state or attributes may have changed since the last push.
+    _dirty = True
+
+    def mark_dirty(self) -> None:
+        """ Make the next push_state write to the state machine. """
+        self._dirty = True
 
     def push_state(self) -> None:
         if self.sm is None:
             raise AttributeError("StateMachine attribute is none.")
         if self.entity_id is None:
             raise AttributeError("Entity ID needs to be defined.")
+        if not self._dirty:
+            # Nothing has changed, so don't build and compare a new state.
+            return
 
         state = str(self.state)
         attrs = self.state_attrs or {}
 
-        attrs.update(defaultdict(dict).get(self.entity_id, {}))
         self.sm.set(self.entity_id, state, attrs)
+        self._dirty = False
+        # Inside a batch the write is only staged. If the batch is discarded,
+        # push again next time.
+        self.sm.on_rollback(self.mark_dirty)
@@ -0,0 +1,396 @@
+import queue
+import threading
+import time
+from typing import NamedTuple, Optional, Callable, Iterator, AsyncIterator, \
+    Any
+
+from libtracker.constants import (
+    ATTR_LATITUDE,
+    ATTR_LONGITUDE,
+    ATTR_TIMESTAMP,
+    CONFIG_GEOFENCE_HYSTERESIS,
+    CONFIG_GEOFENCE_DEBOUNCE,
+    CONFIG_GEOFENCE_DWELL,
+)
+from libtracker.state import State, StateMachine
+from libtracker.zone import ZONE_RADIUS_OFFSET
+
+EVENT_ENTER = "enter"
+EVENT_EXIT = "exit"
+EVENT_DWELL = "dwell"
+
+# A device inside a zone stays inside until it is this far past the edge.
+DEFAULT_HYSTERESIS = 20  # m
+# A crossing must hold for this long before it is reported.
+DEFAULT_DEBOUNCE = 0  # s
+# Report a dwell event once a device has been inside a zone this long.
+DEFAULT_DWELL = 300  # s
+
+# How often pending crossings and dwell times are checked for devices whose
+# position isn't changing.
+TICK_INTERVAL = 5  # s
+
+
+class ZoneEvent(NamedTuple):
+    """ A device entering, leaving or dwelling in a zone. """
+    type: str
+    # Entity ID of the device
+    device: str
+    # Entity ID of the zone
+    zone: str
+    # Unix time at which the event happened
+    timestamp: float
+    latitude: float
+    longitude: float
+
+    @property
+    def device_name(self) -> str:
+        """ The object ID of the device, e.g. phone for device.phone """
+        return self.device.split('.', 1)[1]
+
+
+# Called with each event.
+EventListener = Callable[[Any], None]
+
+
+class EventStream:
+    """
+    Fans events out to listeners, which can subscribe with a callback or
+    iterate over the events as they happen.
+    """
+    def __init__(self) -> None:
+        self._listeners: list = []
+        self._listeners_lock = threading.Lock()
+
+    def publish(self, events: list) -> None:
+        """
+        Send events to every listener, in order.
+        :param events: List of events
+        :return: None
+        """
+        if not events:
+            return
+        with self._listeners_lock:
+            listeners = list(self._listeners)
+        for event in events:
+            for listener in listeners:
+                listener(event)
+
+    def subscribe(self, listener: EventListener) -> Callable[[], None]:
+        """
+        Call listener with every event. Listeners are called on the thread
+        that produced the event, so must not block.
+        :param listener: Callable taking an event
+        :return: A callable which removes the subscription.
+        """
+        with self._listeners_lock:
+            self._listeners.append(listener)
+
+        def unsubscribe() -> None:
+            with self._listeners_lock:
+                if listener in self._listeners:
+                    self._listeners.remove(listener)
+
+        return unsubscribe
+
+    def iter_events(self, timeout: float = None) -> Iterator:
+        """
+        Iterate over events as they happen, blocking until the next one.
+        :param timeout: Stop iterating after this many seconds without an
+            event. Wait forever if None.
+        :return: Iterator of events.
+        """
+        events: queue.Queue = queue.Queue()
+        unsubscribe = self.subscribe(events.put)
+        try:
+            while True:
+                try:
+                    yield events.get(timeout=timeout)
+                except queue.Empty:
+                    return
+        finally:
+            unsubscribe()
+
+    async def aiter_events(self) -> AsyncIterator:
+        """
+        Asynchronously iterate over events as they happen.
+        :return: Async iterator of events.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        events: asyncio.Queue = asyncio.Queue()
+        unsubscribe = self.subscribe(
+            lambda event: loop.call_soon_threadsafe(events.put_nowait, event)
+        )
+        try:
+            while True:
+                yield await events.get()
+        finally:
+            unsubscribe()
+
+
+class _DeviceFences:
+    """ Geofence state of one device. """
+    __slots__ = ("position", "inside", "pending", "dwelled", "offset")
+
+    def __init__(self) -> None:
+        self.position: Optional[tuple] = None
+        # Fix time less clock time for the freshest fix, None until the
+        # device reports when its location was recorded.
+        self.offset: Optional[float] = None
+        # zone -> time the device entered it
+        self.inside: dict[str, float] = {}
+        # zone -> (event type, time the crossing was first seen)
+        self.pending: dict[str, tuple] = {}
+        self.dwelled: set = set()
+
+
+class GeofenceTracker(EventStream):
+    """
+    Turns device positions into zone enter, exit and dwell events.
+
+    The tracker watches the state machine for device positions. A device
+    enters a zone when the scanner would put it inside, i.e. within the
+    zone's radius plus ZONE_RADIUS_OFFSET, but only leaves once it is more
+    than hysteresis metres further out, so GPS jitter at the edge doesn't
+    produce a stream of crossings. Events are stamped with the time the
+    device's location was recorded, from the timestamp attribute of its
+    state, or the clock if it has none. With debounce, a crossing must also
+    hold for that many seconds before it is reported, and is reported with
+    the time it was first seen. A dwell event follows once a device has
+    stayed in a zone for dwell seconds.
+
+    Deadlines are measured in the same time base as the fixes: between
+    fixes, a device's time runs on from its freshest fix at the rate of the
+    clock. Fixes which lag the clock, or are replayed from the past,
+    therefore don't settle crossings early.
+
+    ZoneEvents can be received through subscribe(), iter_events() or
+    aiter_events().
+    """
+    def __init__(self, sm: StateMachine, zones,
+                 hysteresis: float = DEFAULT_HYSTERESIS,
+                 debounce: float = DEFAULT_DEBOUNCE,
+                 dwell: Optional[float] = DEFAULT_DWELL,
+                 clock: Callable[[], float] = time.time) -> None:
+        super().__init__()
+        self.sm = sm
+        self.zones = zones
+        self.hysteresis = hysteresis
+        self.debounce = debounce
+        self.dwell = dwell
+        self.clock = clock
+
+        self._devices: dict[str, _DeviceFences] = {}
+        self._lock = threading.RLock()
+        self._unsubscribe: Optional[Callable[[], None]] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_config(cls, sm: StateMachine, zones,
+                    config: dict) -> "GeofenceTracker":
+        """
+        Create a tracker using the configured hysteresis, debounce and dwell.
+        :param sm: State machine to watch
+        :param zones: ZoneIndex of the zones to track
+        :param config: Libtracker configuration object
+        :return: The tracker
+        """
+        dwell = config.get(CONFIG_GEOFENCE_DWELL, DEFAULT_DWELL)
+        return cls(sm, zones,
+                   float(config.get(CONFIG_GEOFENCE_HYSTERESIS,
+                                    DEFAULT_HYSTERESIS)),
+                   float(config.get(CONFIG_GEOFENCE_DEBOUNCE,
+                                    DEFAULT_DEBOUNCE)),
+                   float(dwell) if dwell else None)
+
+    def start(self) -> None:
+        """
+        Start watching the state machine. Devices already inside a zone are
+        taken as inside without reporting an event, so restarting doesn't
+        repeat enter events.
+        """
+        if self._unsubscribe is not None:
+            return
+
+        with self._lock:
+            self._unsubscribe = self.sm.subscribe(self._on_state_change)
+            for state in self.sm.all():
+                if (position := _position(state["entity_id"],
+                                          state["attrs"])) is None:
+                    continue
+                fences = self._devices.setdefault(state["entity_id"],
+                                                  _DeviceFences())
+                fences.position = position
+                now = self._see(fences, _timestamp(state["attrs"]))
+                for zone in self._zones_entered(*position):
+                    fences.inside[zone] = now
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="libtracker-geofence",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """ Stop watching the state machine. """
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+            self._unsubscribe = None
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(TICK_INTERVAL):
+            self.tick()
+
+    def inside(self, device: str) -> set:
+        """
+        Get the zones a device is currently inside.
+        :param device: Entity ID of the device
+        :return: Set of zone entity IDs
+        """
+        with self._lock:
+            if (fences := self._devices.get(device)) is None:
+                return set()
+            return set(fences.inside)
+
+    def _zones_entered(self, latitude: float, longitude: float) -> set:
+        # The same offset as the scanner, so an enter event is sent exactly
+        # when the device's state becomes the zone.
+        return {zone.entity_id for zone in
+                self.zones.zones_containing(latitude, longitude,
+                                            ZONE_RADIUS_OFFSET)}
+
+    def _on_state_change(self, entity_id: str, old_state: Optional[State],
+                         new_state: State) -> None:
+        if (position := _position(entity_id, new_state.attrs)) is not None:
+            self.update(entity_id, *position, _timestamp(new_state.attrs))
+
+    def update(self, device: str, latitude: float, longitude: float,
+               timestamp: float = None) -> list:
+        """
+        Process a new position of a device.
+        :param device: Entity ID of the device
+        :param latitude: Latitude of device
+        :param longitude: Longitude of device
+        :param timestamp: When the position was recorded, defaults to now
+        :return: List of the events produced, which have also been published
+        """
+        with self._lock:
+            fences = self._devices.setdefault(device, _DeviceFences())
+            fences.position = (latitude, longitude)
+            seen = self._see(fences, timestamp)
+
+            inside = self._zones_entered(latitude, longitude)
+            if fences.inside and self.hysteresis:
+                # Zones the device is in stay entered until it is more than
+                # hysteresis metres outside them.
+                inside |= {zone.entity_id for zone in
+                           self.zones.zones_containing(
+                               latitude, longitude,
+                               ZONE_RADIUS_OFFSET + self.hysteresis
+                           )
+                           if zone.entity_id in fences.inside}
+
+            for zone in inside - set(fences.inside):
+                if fences.pending.get(zone, (None,))[0] != EVENT_ENTER:
+                    fences.pending[zone] = (EVENT_ENTER, seen)
+            for zone in set(fences.inside) - inside:
+                if fences.pending.get(zone, (None,))[0] != EVENT_EXIT:
+                    fences.pending[zone] = (EVENT_EXIT, seen)
+            # Crossings which have been reversed before being reported.
+            for zone in list(fences.pending):
+                kind = fences.pending[zone][0]
+                if (kind == EVENT_ENTER) != (zone in inside):
+                    del fences.pending[zone]
+
+            events = self._settle(device, fences, self._now(fences))
+
+        self.publish(events)
+        return events
+
+    def tick(self, now: float = None) -> list:
+        """
+        Report crossings whose debounce time has passed and dwell events for
+        devices whose positions haven't changed. Called periodically while
+        the tracker is started.
+        :param now: Current time in the time base of the fix timestamps,
+            defaults to each device's time, see the class docstring
+        :return: List of the events produced
+        """
+        with self._lock:
+            events = []
+            for device, fences in self._devices.items():
+                events.extend(self._settle(
+                    device, fences, self._now(fences) if now is None else now
+                ))
+
+        self.publish(events)
+        return events
+
+    def _see(self, fences: _DeviceFences, timestamp: Optional[float]) -> float:
+        """
+        Move a device's time on to a fix. Must hold the lock.
+        :return: The time of the fix, the device's time if it has none.
+        """
+        if timestamp is None:
+            return self._now(fences)
+        offset = timestamp - self.clock()
+        if fences.offset is None or offset > fences.offset:
+            fences.offset = offset
+        return timestamp
+
+    def _now(self, fences: _DeviceFences) -> float:
+        """ The current time in the time base of a device's fixes. """
+        return self.clock() + (fences.offset or 0.0)
+
+    def _settle(self, device: str, fences: _DeviceFences,
+                now: float) -> list:
+        """ Commit due crossings and dwell events. Must hold the lock. """
+        events = []
+        latitude, longitude = fences.position or (None, None)
+
+        for zone, (kind, since) in list(fences.pending.items()):
+            if now - since < self.debounce:
+                continue
+            del fences.pending[zone]
+            if kind == EVENT_ENTER:
+                fences.inside[zone] = since
+            else:
+                fences.inside.pop(zone, None)
+                fences.dwelled.discard(zone)
+            events.append(ZoneEvent(kind, device, zone, since, latitude,
+                                    longitude))
+
+        if self.dwell is not None:
+            for zone, entered in fences.inside.items():
+                if zone not in fences.dwelled and now - entered >= self.dwell:
+                    fences.dwelled.add(zone)
+                    events.append(ZoneEvent(EVENT_DWELL, device, zone,
+                                            entered + self.dwell, latitude,
+                                            longitude))
+
+        return events
+
+
+def _position(entity_id: str, attrs: dict) -> Optional[tuple]:
+    """ Get the position of a device state, None if it isn't one. """
+    if not entity_id.startswith("device."):
+        return None
+    latitude = attrs.get(ATTR_LATITUDE)
+    longitude = attrs.get(ATTR_LONGITUDE)
+    if latitude is None or longitude is None:
+        return None
+    return float(latitude), float(longitude)
+
+
+def _timestamp(attrs: dict) -> Optional[float]:
+    """ Get the time a device state's location was recorded, if known. """
+    if (timestamp := attrs.get(ATTR_TIMESTAMP)) is None:
+        return None
+    return float(timestamp)
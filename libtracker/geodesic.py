@@ -0,0 +1,168 @@
+import numpy as np
+
+from libtracker import metrics
+from libtracker.zone import (
+    VINCENTY_CONVERGENCE_THRESHOLD,
+    VINCENTY_MAX_ITERATIONS,
+    EARTH_SEMI_MAJOR_AXIS,
+    EARTH_SEMI_MINOR_AXIS,
+    VINCENTY_ITERATIONS,
+    VINCENTY_NON_CONVERGENCE,
+)
+
+FLATTENING = 1 / 298.257223563  # f = (a - b) / a
+
+
+def _as_points(theta) -> np.ndarray:
+    """ Convert to a float array, reading an empty list as no points. """
+    theta = np.asarray(theta, dtype=np.float64)
+    if theta.size == 0 and theta.shape[-1:] != (2,):
+        return theta.reshape(0, 2)
+    return theta
+
+
+def inverse_vincenty_batch(theta_1, theta_2) -> np.ndarray:
+    """
+    Vectorised form of the inverse Vincenty formula.
+    Where:
+        ϕ1 = array_like(..., 2) of (latitude, longitude)
+        ϕ2 = array_like(..., 2) of (latitude, longitude)
+    The leading dimensions of both inputs are broadcast against each other, so
+    an (N, 2) array of devices can be checked against a single (2,) zone.
+    Pairs are iterated together and dropped from the working set as soon as
+    they converge. Result is returned in kilometers with the same rounding as
+    inverse_vincenty. Pairs which fail to converge are NaN. An empty input
+    gives an empty result.
+    """
+    theta_1 = _as_points(theta_1)
+    theta_2 = _as_points(theta_2)
+
+    lat_1, lon_1, lat_2, lon_2 = np.broadcast_arrays(
+        theta_1[..., 0], theta_1[..., 1], theta_2[..., 0], theta_2[..., 1]
+    )
+    shape = lat_1.shape
+    lat_1, lon_1 = lat_1.ravel(), lon_1.ravel()
+    lat_2, lon_2 = lat_2.ravel(), lon_2.ravel()
+
+    distance = np.full(lat_1.size, np.nan)
+
+    # If the two points are coincident
+    coincident = (lat_1 == lat_2) & (lon_1 == lon_2)
+    distance[coincident] = 0.00
+    pending = np.flatnonzero(~coincident)
+
+    u1 = np.arctan((1 - FLATTENING) * np.tan(np.radians(lat_1[pending])))
+    u2 = np.arctan((1 - FLATTENING) * np.tan(np.radians(lat_2[pending])))
+    l = np.radians(lon_2[pending] - lon_1[pending])
+    _lambda = l.copy()
+
+    sin_u1 = np.sin(u1)
+    cos_u1 = np.cos(u1)
+    sin_u2 = np.sin(u2)
+    cos_u2 = np.cos(u2)
+
+    # Terms captured for each pair on the iteration it converges.
+    n = pending.size
+    sin_sigma_c = np.empty(n)
+    cos_sigma_c = np.empty(n)
+    sigma_c = np.empty(n)
+    cos_alpha_sq_c = np.empty(n)
+    cos_2_sigma_m_c = np.empty(n)
+    converged = np.zeros(n, dtype=bool)
+    zero = np.zeros(n, dtype=bool)
+
+    active = np.arange(n)
+    for i in range(VINCENTY_MAX_ITERATIONS):
+        if not active.size:
+            break
+
+        su1, cu1 = sin_u1[active], cos_u1[active]
+        su2, cu2 = sin_u2[active], cos_u2[active]
+        lambda_a = _lambda[active]
+
+        sin_lambda = np.sin(lambda_a)
+        cos_lambda = np.cos(lambda_a)
+
+        sin_sigma = np.sqrt((cu2 * sin_lambda) ** 2 +
+                            (cu1 * su2 - su1 * cu2 * cos_lambda) ** 2)
+
+        # Check again if the points are coincident
+        is_zero = sin_sigma == 0
+
+        cos_sigma = su1 * su2 + cu1 * cu2 * cos_lambda
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sin_alpha = cu1 * cu2 * sin_lambda / sin_sigma
+            cos_alpha_sq = 1 - sin_alpha ** 2
+            cos_2_sigma_m = np.where(
+                cos_alpha_sq == 0, 0.0,
+                cos_sigma - 2 * su1 * su2 / cos_alpha_sq
+            )
+
+        c = FLATTENING / 16 * cos_alpha_sq * (4 + FLATTENING *
+                                              (4 - 3 * cos_alpha_sq))
+
+        new_lambda = l[active] + (1 - c) * FLATTENING * sin_alpha * \
+            (sigma + c * sin_sigma *
+             (cos_2_sigma_m + c * cos_sigma * (-1 + 2 * cos_2_sigma_m ** 2)))
+        _lambda[active] = new_lambda
+
+        done = ~is_zero & (np.abs(new_lambda - lambda_a) <
+                           VINCENTY_CONVERGENCE_THRESHOLD)
+        done_idx = active[done]
+        sin_sigma_c[done_idx] = sin_sigma[done]
+        cos_sigma_c[done_idx] = cos_sigma[done]
+        sigma_c[done_idx] = sigma[done]
+        cos_alpha_sq_c[done_idx] = cos_alpha_sq[done]
+        cos_2_sigma_m_c[done_idx] = cos_2_sigma_m[done]
+        converged[done_idx] = True
+        zero[active[is_zero]] = True
+        if metrics.enabled and done_idx.size:
+            VINCENTY_ITERATIONS.observe(i + 1, done_idx.size)
+
+        active = active[~(done | is_zero)]
+
+    # Anything still active has hit the iteration limit and stays NaN.
+    if metrics.enabled and active.size:
+        VINCENTY_NON_CONVERGENCE.inc(active.size)
+    distance[pending[zero]] = 0.00
+
+    sin_sigma = sin_sigma_c[converged]
+    cos_sigma = cos_sigma_c[converged]
+    sigma = sigma_c[converged]
+    cos_alpha_sq = cos_alpha_sq_c[converged]
+    cos_2_sigma_m = cos_2_sigma_m_c[converged]
+
+    u_sq = cos_alpha_sq * (
+            EARTH_SEMI_MAJOR_AXIS ** 2 - EARTH_SEMI_MINOR_AXIS ** 2
+    ) / (EARTH_SEMI_MINOR_AXIS ** 2)
+    a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+
+    delta_sigma = b * sin_sigma * (cos_2_sigma_m + b / 4 *
+                                   (cos_sigma * (-1 + 2 * cos_2_sigma_m ** 2)
+                                    - b / 6 * cos_2_sigma_m *
+                                    (-3 + 4 * sin_sigma ** 2) *
+                                    (-3 + 4 * cos_2_sigma_m ** 2)))
+
+    s = EARTH_SEMI_MINOR_AXIS * a * (sigma - delta_sigma)
+    s /= 1000  # m -> km
+
+    distance[pending[converged]] = np.round(s, 6)
+
+    return distance.reshape(shape)
+
+
+def inverse_vincenty_matrix(points_1, points_2) -> np.ndarray:
+    """
+    Distance matrix between every point in points_1 (N, 2) and every point in
+    points_2 (M, 2), e.g. devices by zones.
+    :return: (N, M) array of distances in kilometers, NaN where Vincenty does
+        not converge.
+    """
+    points_1 = np.asarray(points_1, dtype=np.float64).reshape(-1, 2)
+    points_2 = np.asarray(points_2, dtype=np.float64).reshape(-1, 2)
+
+    return inverse_vincenty_batch(points_1[:, np.newaxis, :],
+                                  points_2[np.newaxis, :, :])
@@ -0,0 +1,173 @@
+import math
+import os
+import re
+from typing import Optional
+
+import numpy as np
+
+from libtracker.constants import CONFIG_HISTORY_CAPACITY, CONFIG_HISTORY_DIR
+
+DEFAULT_HISTORY_CAPACITY = 2880  # 12 hours at the default scan interval
+
+HISTORY_MAGIC = b"LTHIST01"
+HISTORY_EXTENSION = ".hist"
+# magic, capacity, total records written, reserved
+HEADER_SIZE = 32
+
+HISTORY_DTYPE = np.dtype([
+    ("timestamp", "<f8"),
+    ("latitude", "<f8"),
+    ("longitude", "<f8"),
+    ("battery", "<f4"),
+    ("state", "S32"),
+])
+
+
+class LocationHistory:
+    """
+    Fixed capacity ring buffer of location records for one device.
+
+    Every record is written twice, at i and i + capacity of a buffer twice the
+    capacity. The newest capacity records are then always one contiguous
+    slice, so range() can return a view without copying however far the ring
+    has wrapped.
+
+    If path is given the buffer is a memory-mapped file. Records survive a
+    restart and opening an existing file only maps it rather than reading it.
+    With readonly the file is mapped read-only, so it can be read while the
+    tracker appends to it, and append raises.
+    """
+    def __init__(self, capacity: int = DEFAULT_HISTORY_CAPACITY,
+                 path: str = None, readonly: bool = False) -> None:
+        self.path = path
+
+        if path is None:
+            self.capacity = capacity
+            self._header = np.zeros(4, dtype="<i8")
+            self._data = np.zeros(2 * capacity, dtype=HISTORY_DTYPE)
+            return
+
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                header = f.read(HEADER_SIZE)
+            if header[:8] != HISTORY_MAGIC:
+                raise ValueError(f"{path} is not a location history file.")
+            capacity = int(np.frombuffer(header, dtype="<i8", count=1,
+                                         offset=8)[0])
+            mode = "r" if readonly else "r+"
+        elif readonly:
+            raise FileNotFoundError(path)
+        else:
+            mode = "w+"
+
+        self.capacity = capacity
+        self._header = np.memmap(path, dtype="<i8", mode=mode,
+                                 offset=0, shape=(4,))
+        if mode == "w+":
+            self._header[0] = np.frombuffer(HISTORY_MAGIC, dtype="<i8")[0]
+            self._header[1] = capacity
+        self._data = np.memmap(path, dtype=HISTORY_DTYPE,
+                               mode="r" if readonly else "r+",
+                               offset=HEADER_SIZE, shape=(2 * capacity,))
+
+    @classmethod
+    def open(cls, path: str, readonly: bool = False) -> "LocationHistory":
+        """
+        Open an existing history file.
+        :param path: Path to the history file
+        :param readonly: Map the file read-only, e.g. for analysis
+        :return: The history stored in the file
+        """
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return cls(path=path, readonly=readonly)
+
+    @property
+    def total(self) -> int:
+        """ Number of records ever written, including overwritten ones. """
+        return int(self._header[2])
+
+    def __len__(self) -> int:
+        return min(self.total, self.capacity)
+
+    def append(self, timestamp: float, latitude: float, longitude: float,
+               battery: Optional[float], state: Optional[str]) -> None:
+        """
+        Add a record, overwriting the oldest one if the buffer is full.
+        Timestamps are expected to never go backwards.
+        :return: None
+        """
+        i = self.total % self.capacity
+        record = (
+            timestamp, latitude, longitude,
+            math.nan if battery is None else battery,
+            (state or "").encode()[:32]
+        )
+        self._data[i] = record
+        self._data[i + self.capacity] = record
+        self._header[2] += 1
+
+    def records(self) -> np.ndarray:
+        """
+        Get every stored record, oldest first.
+        :return: A view into the buffer. It is overwritten as new records
+            are added so copy it to keep it.
+        """
+        end = self.total % self.capacity + self.capacity
+        return self._data[end - len(self):end]
+
+    def range(self, start: float = None, end: float = None) -> np.ndarray:
+        """
+        Get the records with start <= timestamp <= end.
+        :param start: Earliest timestamp, or None for the oldest record.
+        :param end: Latest timestamp, or None for the newest record.
+        :return: A view into the buffer. It is overwritten as new records
+            are added so copy it to keep it.
+        """
+        records = self.records()
+        timestamps = records["timestamp"]
+
+        lo = 0 if start is None else \
+            np.searchsorted(timestamps, start, side="left")
+        hi = len(records) if end is None else \
+            np.searchsorted(timestamps, end, side="right")
+
+        return records[lo:hi]
+
+    def latest(self) -> Optional[np.void]:
+        """ Get the newest record, or None if the history is empty. """
+        if not self.total:
+            return None
+        return self._data[self.total % self.capacity + self.capacity - 1]
+
+    def flush(self) -> None:
+        """ Write any changes to disk if the history is memory-mapped. """
+        if self.path is not None:
+            self._header.flush()
+            self._data.flush()
+
+
+def history_path(history_dir: str, name: str) -> str:
+    """ Get the path of the history file for a device name. """
+    filename = re.sub(r"[^\w.-]", "_", name) + HISTORY_EXTENSION
+    return os.path.join(history_dir, filename)
+
+
+def open_history(config: dict, name: str) -> Optional[LocationHistory]:
+    """
+    Create the location history for a device if history is enabled.
+    :param config: Libtracker configuration object
+    :param name: Name of the device
+    :return: The device's history, or None if history is not enabled.
+    """
+    capacity = config.get(CONFIG_HISTORY_CAPACITY)
+    history_dir = config.get(CONFIG_HISTORY_DIR)
+    if not capacity and not history_dir:
+        return None
+
+    capacity = int(capacity or DEFAULT_HISTORY_CAPACITY)
+    if history_dir is None:
+        return LocationHistory(capacity)
+
+    os.makedirs(history_dir, exist_ok=True)
+    return LocationHistory(capacity, history_path(history_dir, name))
@@ -0,0 +1,59 @@
+import json
+import logging
+from datetime import datetime, timezone
+
+from libtracker.constants import CONFIG_LOG_LEVEL, CONFIG_LOG_FORMAT
+
+DEFAULT_LOG_LEVEL = "INFO"
+LOG_FORMAT_TEXT = "text"
+LOG_FORMAT_JSON = "json"
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# Attributes every LogRecord has. Anything else was passed in extra.
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord(
+    "", logging.INFO, "", 0, "", (), None
+))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format each record as one JSON object per line. Fields passed with
+    extra=... are included as keys, so logs can be filtered by device,
+    distance and so on.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc)
+                            .isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(config: dict) -> None:
+    """
+    Configure logging from the config when the application hasn't already
+    set up logging itself.
+    :param config: Libtracker configuration object
+    :return: None
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return
+
+    handler = logging.StreamHandler()
+    if config.get(CONFIG_LOG_FORMAT, LOG_FORMAT_TEXT) == LOG_FORMAT_JSON:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    root.addHandler(handler)
+    root.setLevel(str(config.get(CONFIG_LOG_LEVEL, DEFAULT_LOG_LEVEL)).upper())
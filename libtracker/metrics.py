@@ -0,0 +1,325 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Sequence, Tuple
+
+from libtracker.constants import CONFIG_METRICS_PORT, CONFIG_METRICS_ADDRESS
+
+# Instrumented code checks this before recording anything, so metrics cost a
+# single attribute lookup until enable() is called.
+enabled = False
+
+DEFAULT_METRICS_ADDRESS = "127.0.0.1"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, suited to network calls and scan cycles.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+# (name suffix, labels, value)
+Sample = Tuple[str, Tuple[Tuple[str, str], ...], float]
+
+
+class Metric:
+    """
+    Base class of a metric in the Prometheus data model.
+
+    A metric declared with labelnames holds one child metric per combination
+    of label values, created by labels().
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: dict = {}
+
+    def labels(self, *values: str) -> "Metric":
+        """
+        Get the child metric for a combination of label values. Keep the
+        child rather than calling this on a hot path.
+        :param values: One value for each of labelnames, in order
+        :return: The child metric
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}")
+
+        values = tuple(str(value) for value in values)
+        with self._lock:
+            if (child := self._children.get(values)) is None:
+                child = self._children[values] = self._new_child()
+            return child
+
+    def _new_child(self) -> "Metric":
+        return type(self)(self.name, self.documentation)
+
+    def collect(self) -> Iterator[Sample]:
+        """ Iterate over every sample of this metric and its children. """
+        if not self.labelnames:
+            yield from self._samples(())
+            return
+
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in children:
+            yield from child._samples(tuple(zip(self.labelnames, values)))
+
+    def _samples(self, labels: tuple) -> Iterator[Sample]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """ Value which only goes up, e.g. a number of events. """
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        """ Increase the counter by amount. """
+        with self._lock:
+            self.value += amount
+
+    def _samples(self, labels: tuple) -> Iterator[Sample]:
+        yield "", labels, self.value
+
+
+class Gauge(Metric):
+    """
+    Value which can go up and down. The value can instead be read from a
+    function whenever the metric is collected.
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = (),
+                 function: Callable[[], float] = None) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+        self.function = function
+
+    def set(self, value: float) -> None:
+        """ Set the gauge to value. """
+        self.value = float(value)
+
+    def inc(self, amount: float = 1) -> None:
+        """ Increase the gauge by amount. """
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        """ Decrease the gauge by amount. """
+        self.inc(-amount)
+
+    def _samples(self, labels: tuple) -> Iterator[Sample]:
+        value = self.function() if self.function is not None else self.value
+        yield "", labels, value
+
+
+class Histogram(Metric):
+    """ Distribution of observed values, counted into buckets. """
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Observations per bucket. The last bucket is +Inf.
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def _new_child(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value: float, count: int = 1) -> None:
+        """
+        Record an observation.
+        :param value: The observed value
+        :param count: Record the same value this many times
+        :return: None
+        """
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += count
+            self.sum += value * count
+            self.count += count
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        """ Observe the number of seconds taken by a with block. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def _samples(self, labels: tuple) -> Iterator[Sample]:
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self.sum, self.count
+
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),),
+                                       counts):
+            cumulative += bucket_count
+            yield "_bucket", labels + (("le", _format_value(bound)),), \
+                cumulative
+        yield "_sum", labels, total
+        yield "_count", labels, count
+
+
+class Registry:
+    """ Collection of metrics exposed together. """
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        Add a metric to the registry.
+        :param metric: The metric to add
+        :return: The metric
+        """
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already "
+                                 "registered.")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str) -> Optional[Metric]:
+        """ Look up a registered metric by name. """
+        return self._metrics.get(name)
+
+    def expose(self) -> str:
+        """ Render every metric in the Prometheus text format. """
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} "
+                         f"{_escape(metric.documentation, False)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.collect():
+                if labels:
+                    label_text = ",".join(f'{k}="{_escape(v)}"'
+                                          for k, v in labels)
+                    lines.append(f"{metric.name}{suffix}{{{label_text}}} "
+                                 f"{_format_value(value)}")
+                else:
+                    lines.append(f"{metric.name}{suffix} "
+                                 f"{_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str,
+            labelnames: Sequence[str] = ()) -> Counter:
+    """ Create a counter in the default registry. """
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = (),
+          function: Callable[[], float] = None) -> Gauge:
+    """ Create a gauge in the default registry. """
+    return REGISTRY.register(Gauge(name, documentation, labelnames, function))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    """ Create a histogram in the default registry. """
+    return REGISTRY.register(Histogram(name, documentation, labelnames,
+                                       buckets))
+
+
+def enable() -> None:
+    """ Start recording metrics. """
+    global enabled
+    enabled = True
+
+
+def disable() -> None:
+    """ Stop recording metrics. Values recorded so far are kept. """
+    global enabled
+    enabled = False
+
+
+def start_http_server(port: int, address: str = DEFAULT_METRICS_ADDRESS,
+                      registry: Registry = REGISTRY):
+    """
+    Serve the metrics in the Prometheus text format at /metrics from a
+    background thread.
+    :param port: Port to listen on, 0 for any free port
+    :param address: Address to listen on. Defaults to localhost only.
+    :param registry: Registry to expose
+    :return: The running ThreadingHTTPServer. Call shutdown() to stop it.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+
+            body = registry.expose().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            # Scrapes are too frequent to be worth logging.
+            pass
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="libtracker-metrics",
+                     daemon=True).start()
+    return server
+
+
+def start_from_config(config: dict):
+    """
+    Enable metrics and start the HTTP endpoint if a metrics port is
+    configured.
+    :param config: Libtracker configuration object
+    :return: The running server, or None if metrics are not configured.
+    """
+    if (port := config.get(CONFIG_METRICS_PORT)) is None:
+        return None
+
+    enable()
+    return start_http_server(
+        int(port), config.get(CONFIG_METRICS_ADDRESS, DEFAULT_METRICS_ADDRESS)
+    )
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if value == float("-inf"):
+        return "-Inf"
+    if value != value:
+        return "NaN"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str, quotes: bool = True) -> str:
+    value = str(value).replace("\\", r"\\").replace("\n", r"\n")
+    return value.replace('"', r'\"') if quotes else value
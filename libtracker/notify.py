@@ -1,33 +1,229 @@
+import logging
+import queue
+import threading
+import time
+from typing import Optional
+
 import requests
 
+from libtracker import metrics
 from libtracker.constants import CONFIG_TELEGRAM_USERS, CONFIG_TELEGRAM_BOT_TOKEN
 
-_USER_CACHE = []
+_LOGGER = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+
+DEFAULT_TIMEOUT = 10  # s
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF = 1.0  # s, doubled on every retry
+# Telegram allows roughly one message per second to a single chat.
+DEFAULT_MIN_INTERVAL = 1.0  # s
+
+_dispatcher: Optional["NotificationDispatcher"] = None
+_dispatcher_lock = threading.Lock()
+
+# Read from the shared dispatcher when scraped, so queueing costs nothing.
+NOTIFICATION_QUEUE_DEPTH = metrics.gauge(
+    "libtracker_notification_queue_depth",
+    "Notifications waiting to be sent.",
+    function=lambda: _dispatcher.depth if _dispatcher is not None else 0
+)
+
+
+def _get_users(config: dict) -> list:
+    """ Get the Telegram users to notify as a list. """
+    users = config.get(CONFIG_TELEGRAM_USERS) or []
+    if not isinstance(users, list):
+        users = [users]
+    return users
+
+
+def _format_message(device: str) -> str:
+    return f"Device: {device} has just returned home"
+
 
+class NotificationDispatcher:
+    """
+    Background sender for Telegram notifications.
 
-def send_notification(device: str, config: dict) -> None:
+    Callers only put events on a queue. A single worker thread sends them
+    through a pooled HTTP session, keeps at least min_interval seconds between
+    messages to the same chat and retries failed requests with exponential
+    backoff. Client errors other than 429, such as a bad token or an unknown
+    chat, are logged as failures without retrying. A "returned home" event
+    for a device that is still waiting to be sent is dropped rather than
+    queued twice.
     """
-    Send an HTTP POST request to the Telegram messaging API.
+    def __init__(self, config: dict, api_url: str = TELEGRAM_API_URL,
+                 session: requests.Session = None,
+                 timeout: float = DEFAULT_TIMEOUT,
+                 max_retries: int = DEFAULT_MAX_RETRIES,
+                 backoff: float = DEFAULT_BACKOFF,
+                 min_interval: float = DEFAULT_MIN_INTERVAL) -> None:
+        self.users = _get_users(config)
+        self.token = config.get(CONFIG_TELEGRAM_BOT_TOKEN)
+        self.api_url = api_url
+        # Only a session created here is closed by stop.
+        self._owns_session = session is None
+        self.session = session or requests.Session()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.min_interval = min_interval
+
+        self._queue: queue.Queue = queue.Queue()
+        self._pending: set = set()
+        self._pending_lock = threading.Lock()
+        self._last_sent: dict = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        """ Whether Telegram has been configured. """
+        return bool(self.users and self.token)
+
+    @property
+    def depth(self) -> int:
+        """ Number of events waiting to be sent. """
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        """ Start the worker thread. """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="libtracker-notify", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None) -> None:
+        """
+        Stop the worker thread. Events which have not been sent are dropped.
+        :param timeout: Seconds to wait for the worker to finish.
+        :return: None
+        """
+        self._stop.set()
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._owns_session:
+            self.session.close()
+
+    def notify(self, device: str, config: dict = None) -> bool:
+        """
+        Queue a "returned home" notification for a device.
+
+        :param device: The device name that has returned home.
+        :param config: Unused, accepted for symmetry with
+            queue_notification.
+        :return: False if notifications are disabled or the event was
+            coalesced with one already queued.
+        """
+        if not self.enabled:
+            return False
+
+        with self._pending_lock:
+            if device in self._pending:
+                return False
+            self._pending.add(device)
+
+        self._queue.put(device)
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            device = self._queue.get()
+            if device is None:
+                break
+
+            with self._pending_lock:
+                self._pending.discard(device)
+
+            message = _format_message(device)
+            for user in self.users:
+                if self._stop.is_set():
+                    return
+                try:
+                    self._send(user, message)
+                except requests.RequestException as e:
+                    _LOGGER.warning("Could not notify %s: %s", user, e,
+                                    extra={"user": user, "device": device})
+
+    def _send(self, user: str, message: str) -> None:
+        """ Send one message, waiting out the rate limit and retrying. """
+        url = f"{self.api_url}/bot{self.token}/sendMessage"
+
+        for attempt in range(self.max_retries + 1):
+            if (last := self._last_sent.get(user)) is not None:
+                wait = last + self.min_interval - time.monotonic()
+                if wait > 0 and self._stop.wait(wait):
+                    return
+
+            self._last_sent[user] = time.monotonic()
+            retry_after = None
+            try:
+                response = self.session.post(
+                    url, data={"chat_id": user, "text": message},
+                    timeout=self.timeout
+                )
+                status = response.status_code
+                if status < 400:
+                    return
+                error = requests.HTTPError(f"{status} from Telegram",
+                                           response=response)
+                if status < 500 and status != 429:
+                    # A bad token or unknown chat won't succeed on a retry.
+                    raise error
+                if status == 429:
+                    retry_after = _retry_after(response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if attempt == self.max_retries:
+                raise error
+            if self._stop.wait(retry_after or self.backoff * 2 ** attempt):
+                return
+
+
+def _retry_after(response: requests.Response) -> Optional[float]:
+    """ Read the retry_after hint from a rate limited Telegram response. """
+    try:
+        return float(response.json()["parameters"]["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def get_dispatcher(config: dict) -> NotificationDispatcher:
+    """
+    Get the shared notification dispatcher, starting it on first use.
+    :param config: Global configuration object.
+    :return: The running dispatcher.
+    """
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = NotificationDispatcher(config)
+            _dispatcher.start()
+    return _dispatcher
+
+
+def queue_notification(device: str, config: dict) -> None:
+    """
+    Queue a "returned home" notification on the shared dispatcher without
+    waiting for it to be sent.
 
     :param device: The device name that has returned home.
     :param config: Global configuration object.
     :return: None
     """
-    if not _USER_CACHE:
-        if users := config.setdefault(CONFIG_TELEGRAM_USERS, None):
-            if not isinstance(users, list):
-                users = [users]
-            for user in users:
-                _USER_CACHE.append(user)
-        else:
-            # Telegram users have not been added. Cancel sending the notification.
-            return
+    get_dispatcher(config).notify(device)
 
-    if not (token := config.setdefault(CONFIG_TELEGRAM_BOT_TOKEN, None)):
-        # No token has been set. Cancel sending the notification.
-        return
 
-    message = f"Device: {device} has just returned home"
-    for user in _USER_CACHE:
-        url = "https://api.telegram.org/bot" + token + '/sendMessage?chat_id=' + user + "&text=" + message
-        response = requests.post(url)
+def shutdown_dispatcher(timeout: float = None) -> None:
+    """ Stop the shared dispatcher if it has been started. """
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is not None:
+            _dispatcher.stop(timeout)
+            _dispatcher = None
@@ -0,0 +1,497 @@
+import itertools
+import math
+import threading
+from typing import Optional, Tuple, Iterable, Iterator
+
+from libtracker.constants import (
+    ATTR_LATITUDE,
+    ATTR_LONGITUDE,
+    ATTR_RADIUS,
+    CONFIG_PROXIMITY_RADIUS,
+)
+from libtracker.events import _position
+from libtracker.state import StateMachine
+from libtracker.zone import PreparedZone, METRES_PER_DEGREE_LAT
+
+PROXIMITY_DOMAIN = "proximity"
+ATTR_MEMBERS = "members"
+
+# Devices this close to each other are grouped together.
+DEFAULT_PROXIMITY_RADIUS = 50  # m
+
+# State of a group entity whose group has broken up.
+STATE_NO_GROUP = "0"
+
+
+class ProximityIndex:
+    """
+    Spatial hash of device positions.
+
+    Every device is kept in one cell of a latitude/longitude grid whose cells
+    are at least radius metres tall, so the devices within radius of a point
+    are found by measuring the distance to the devices in the few cells
+    around it, not to every device. Moving a device only touches its old and
+    new cells. Distances are inverse Vincenty, as for zones.
+    """
+    def __init__(self, radius: float = DEFAULT_PROXIMITY_RADIUS,
+                 cell_size: float = None) -> None:
+        if radius <= 0:
+            raise ValueError("radius must be greater than 0.")
+        self.radius = radius
+        # A whole number of cells around the globe, so longitudes wrap
+        # cleanly at the antimeridian.
+        self._lon_cells = max(1, math.floor(
+            360 / (cell_size or radius / METRES_PER_DEGREE_LAT)
+        ))
+        self.cell_size = 360 / self._lon_cells
+        self._positions: dict[str, Tuple[float, float]] = {}
+        self._device_cells: dict[str, Tuple[int, int]] = {}
+        self._cells: dict[Tuple[int, int], set] = {}
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, device: str) -> bool:
+        return device in self._positions
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._positions)
+
+    def _cell(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return (math.floor(latitude / self.cell_size),
+                math.floor(longitude / self.cell_size) % self._lon_cells)
+
+    def position(self, device: str) -> Optional[Tuple[float, float]]:
+        """
+        Get the indexed position of a device.
+        :param device: Entity ID of the device
+        :return: (latitude, longitude), or None if the device isn't indexed.
+        """
+        return self._positions.get(device)
+
+    def move(self, device: str, latitude: float, longitude: float) -> None:
+        """
+        Add a device to the index or move it to a new position.
+        :param device: Entity ID of the device
+        :param latitude: Latitude of device
+        :param longitude: Longitude of device
+        :return: None
+        """
+        cell = self._cell(latitude, longitude)
+        if (old_cell := self._device_cells.get(device)) != cell:
+            if old_cell is not None:
+                self._discard(device, old_cell)
+            self._cells.setdefault(cell, set()).add(device)
+            self._device_cells[device] = cell
+        self._positions[device] = (latitude, longitude)
+
+    def remove(self, device: str) -> None:
+        """
+        Remove a device from the index if it is present.
+        :param device: Entity ID of the device
+        :return: None
+        """
+        self._positions.pop(device, None)
+        if (cell := self._device_cells.pop(device, None)) is not None:
+            self._discard(device, cell)
+
+    def _discard(self, device: str, cell: Tuple[int, int]) -> None:
+        bucket = self._cells[cell]
+        bucket.discard(device)
+        if not bucket:
+            del self._cells[cell]
+
+    def _candidates(self, bbox: Optional[tuple]) -> Iterable[str]:
+        """ Get every device which may be inside a bounding box. """
+        if bbox is None:
+            # The circle reaches a pole.
+            return list(self._positions)
+
+        lat_lo = math.floor(bbox[0] / self.cell_size)
+        lon_lo = math.floor(bbox[1] / self.cell_size)
+        lat_hi = math.floor(bbox[2] / self.cell_size)
+        lon_hi = math.floor(bbox[3] / self.cell_size)
+        lon_count = min(lon_hi - lon_lo + 1, self._lon_cells)
+        if (lat_hi - lat_lo + 1) * lon_count > len(self._positions):
+            # Cheaper to look at every device than at every cell.
+            return list(self._positions)
+
+        found = []
+        for i in range(lat_lo, lat_hi + 1):
+            for j in range(lon_lo, lon_lo + lon_count):
+                found.extend(self._cells.get((i, j % self._lon_cells), ()))
+        return found
+
+    def within(self, latitude: float, longitude: float,
+               radius: float = None) -> list:
+        """
+        Find every device within radius metres of a point.
+        :param latitude: Latitude of the point
+        :param longitude: Longitude of the point
+        :param radius: Distance in metres, defaults to the index radius
+        :return: List of (entity ID, distance in metres), nearest first.
+        """
+        radius = self.radius if radius is None else radius
+        circle = PreparedZone("", {ATTR_LATITUDE: latitude,
+                                   ATTR_LONGITUDE: longitude,
+                                   ATTR_RADIUS: radius})
+
+        found = []
+        for device in self._candidates(circle.bbox):
+            distance = circle.distance(*self._positions[device])
+            if distance is not None and distance * 1000 <= radius:
+                found.append((device, distance * 1000))
+
+        found.sort(key=lambda item: item[1])
+        return found
+
+    def near(self, device: str, radius: float = None) -> list:
+        """
+        Find every other device within radius metres of a device.
+        :param device: Entity ID of the device
+        :param radius: Distance in metres, defaults to the index radius
+        :return: List of (entity ID, distance in metres), nearest first.
+        """
+        if (position := self._positions.get(device)) is None:
+            return []
+        return [(other, distance) for other, distance in
+                self.within(position[0], position[1], radius)
+                if other != device]
+
+    def cluster(self, device: str) -> set:
+        """
+        Get the group of a device: every device linked to it by a chain of
+        devices each within radius metres of the next.
+        :param device: Entity ID of the device
+        :return: Set of entity IDs including device, empty if the device
+            isn't indexed.
+        """
+        if device not in self._positions:
+            return set()
+
+        group = {device}
+        todo = [device]
+        while todo:
+            for other, _ in self.near(todo.pop()):
+                if other not in group:
+                    group.add(other)
+                    todo.append(other)
+        return group
+
+    def clusters(self, min_size: int = 2) -> list:
+        """
+        Split every indexed device into groups, as cluster does.
+        :param min_size: Leave out groups with fewer devices than this
+        :return: List of sets of entity IDs
+        """
+        seen = set()
+        groups = []
+        for device in self._positions:
+            if device in seen:
+                continue
+            group = self.cluster(device)
+            seen |= group
+            if len(group) >= min_size:
+                groups.append(group)
+        return groups
+
+
+class ProximityTracker:
+    """
+    Groups devices which are close together and publishes the groups to the
+    state machine.
+
+    Devices are grouped with every device within radius metres of them, and
+    so transitively with a chain of devices, e.g. a vehicle and the phones
+    inside it. The tracker keeps the links between devices within radius of
+    each other. update() is called by Device.mark_seen with each new position
+    and looks up the moved device's neighbours once. Groups only change when
+    one of its links appears or disappears: a new link merges two groups,
+    and a lost link splits a group unless the two devices are still joined
+    by a chain of links. So a device moving inside a crowded group, such as
+    a car park, costs one neighbour query rather than a walk over the group.
+
+    Each group of two or more devices is published as a proximity.<name>
+    entity named after its first member in sort order, with the number of
+    members as its state and their entity IDs under members. Once a group
+    has broken up its entity is set to 0 with no members. As the scanners
+    mark devices seen inside a batch, group changes are committed with the
+    positions that caused them, so devices moving together are never seen
+    apart half way through a cycle.
+    """
+    def __init__(self, sm: StateMachine,
+                 radius: float = DEFAULT_PROXIMITY_RADIUS,
+                 cell_size: float = None) -> None:
+        self.sm = sm
+        self.index = ProximityIndex(radius, cell_size)
+        # Device -> devices within radius of it, for every indexed device.
+        self._links: dict[str, set] = {}
+        # Device -> ID of its group, and group ID -> members, for every
+        # indexed device including those on their own.
+        self._group_ids: dict[str, int] = {}
+        self._members: dict[int, set] = {}
+        self._next_id = itertools.count()
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_config(cls, sm: StateMachine,
+                    config: dict) -> Optional["ProximityTracker"]:
+        """
+        Create a tracker using the configured radius.
+        :param sm: State machine to publish groups to
+        :param config: Libtracker configuration object
+        :return: The tracker, or None if proximity grouping is not enabled.
+        """
+        if not (radius := config.get(CONFIG_PROXIMITY_RADIUS)):
+            return None
+        return cls(sm, float(radius))
+
+    @property
+    def radius(self) -> float:
+        return self.index.radius
+
+    def restore(self) -> None:
+        """
+        Index the device positions already in the state machine, e.g. from
+        a snapshot, publish their groups and clear the groups left over from
+        the last run which no longer hold.
+        """
+        with self._lock:
+            stale = set()
+            for state in self.sm.all():
+                entity_id = state["entity_id"]
+                if entity_id.startswith(PROXIMITY_DOMAIN + "."):
+                    if state["attrs"].get(ATTR_MEMBERS):
+                        stale.add(entity_id)
+                elif (position := _position(entity_id,
+                                            state["attrs"])) is not None:
+                    self.index.move(entity_id, *position)
+
+            self._links = {device: {other for other, _ in
+                                    self.index.near(device)}
+                           for device in self.index}
+            self._group_ids.clear()
+            self._members.clear()
+            for device in self._links:
+                if device not in self._group_ids:
+                    self._new_group(self._component(device))
+
+            with self.sm.batch():
+                self._publish(self._grouped(self._members), stale)
+
+    def update(self, device: str, latitude: float, longitude: float) -> None:
+        """
+        Move a device and update the groups it leaves and joins.
+        :param device: Entity ID of the device
+        :param latitude: Latitude of device
+        :param longitude: Longitude of device
+        :return: None
+        """
+        # Entity IDs as the state machine stores them.
+        device = device.lower()
+        with self._lock:
+            if self.index.position(device) == (latitude, longitude):
+                return
+            self.index.move(device, latitude, longitude)
+            if (links := self._links.get(device)) is None:
+                links = self._links[device] = set()
+                self._new_group({device})
+
+            near = {other for other, _ in self.index.near(device)}
+            lost, found = links - near, near - links
+            if not lost and not found:
+                return
+
+            stale, changed = set(), set()
+            for other in lost:
+                self._unlink(device, other, stale, changed)
+            for other in found:
+                self._link(device, other, stale, changed)
+            self._publish(self._grouped(changed), stale)
+
+    def update_state(self, entity_id: str, attrs: dict) -> None:
+        """
+        Update from a state written to the state machine. States which
+        aren't device positions are ignored.
+        :param entity_id: Entity ID of the state
+        :param attrs: Attributes of the state
+        :return: None
+        """
+        if (position := _position(entity_id, attrs)) is not None:
+            self.update(entity_id, *position)
+
+    def remove(self, device: str) -> None:
+        """
+        Stop tracking a device and update the group it was in.
+        :param device: Entity ID of the device
+        :return: None
+        """
+        device = device.lower()
+        with self._lock:
+            if device not in self.index:
+                return
+            stale, changed = set(), set()
+            for other in list(self._links[device]):
+                self._unlink(device, other, stale, changed)
+            # Now on its own.
+            del self._members[self._group_ids.pop(device)]
+            del self._links[device]
+            self.index.remove(device)
+            self._publish(self._grouped(changed), stale)
+
+    def _new_group(self, members: set) -> int:
+        """ Put devices in a new group of their own. Must hold the lock. """
+        group_id = next(self._next_id)
+        self._members[group_id] = members
+        for device in members:
+            self._group_ids[device] = group_id
+        return group_id
+
+    def _link(self, device: str, other: str, stale: set,
+              changed: set) -> None:
+        """
+        Link two devices, merging their groups. Must hold the lock.
+        :param stale: Entity IDs of groups about to change are added to this
+        :param changed: IDs of groups which have changed are added to this
+        """
+        self._links[device].add(other)
+        self._links[other].add(device)
+        group_id = self._group_ids[device]
+        other_id = self._group_ids[other]
+        if group_id == other_id:
+            return
+
+        self._mark_stale(stale, group_id, other_id)
+        # Move the members of the smaller group into the larger.
+        if len(self._members[group_id]) < len(self._members[other_id]):
+            group_id, other_id = other_id, group_id
+        moved = self._members.pop(other_id)
+        for member in moved:
+            self._group_ids[member] = group_id
+        self._members[group_id] |= moved
+        changed.discard(other_id)
+        changed.add(group_id)
+
+    def _unlink(self, device: str, other: str, stale: set,
+                changed: set) -> None:
+        """
+        Unlink two devices, splitting their group if nothing else joins
+        them. Must hold the lock.
+        :param stale: Entity IDs of groups about to change are added to this
+        :param changed: IDs of groups which have changed are added to this
+        """
+        self._links[device].discard(other)
+        self._links[other].discard(device)
+        if (split := self._separate(device, other)) is None:
+            return
+
+        group_id = self._group_ids[device]
+        self._mark_stale(stale, group_id)
+        self._members[group_id] -= split
+        changed.add(group_id)
+        changed.add(self._new_group(split))
+
+    def _separate(self, device: str, other: str) -> Optional[set]:
+        """
+        Check whether two devices are still joined by a chain of links, by
+        searching from both at once. The search stops as soon as the two
+        sides meet, or one side runs out, so it only ever walks the smaller
+        part of a group that has split. Must hold the lock.
+        :return: None if they are still joined, otherwise the devices now
+            joined to one of them but not the other.
+        """
+        sides = (({device}, [device]), ({other}, [other]))
+        while True:
+            for (seen, todo), (other_seen, _) in zip(sides, sides[::-1]):
+                if not todo:
+                    return seen
+                for neighbour in self._links[todo.pop()]:
+                    if neighbour in other_seen:
+                        return None
+                    if neighbour not in seen:
+                        seen.add(neighbour)
+                        todo.append(neighbour)
+
+    def _component(self, device: str) -> set:
+        """ Every device joined to device by a chain of links. """
+        seen = {device}
+        todo = [device]
+        while todo:
+            for neighbour in self._links[todo.pop()]:
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    todo.append(neighbour)
+        return seen
+
+    def _mark_stale(self, stale: set, *group_ids: int) -> None:
+        """ Add the entity IDs of groups as they are now. """
+        for group_id in group_ids:
+            if len(members := self._members[group_id]) > 1:
+                stale.add(_entity_id(min(members)))
+
+    def _grouped(self, group_ids: Iterable[int]) -> list:
+        """ Get the members of every group of two or more devices. """
+        return [members for group_id in group_ids
+                if len(members := self._members.get(group_id, ())) > 1]
+
+    def _publish(self, groups: list, stale: set) -> None:
+        """ Set the entity of every group, and clear stale group entities. """
+        published = set()
+        for group in groups:
+            entity_id = _entity_id(min(group))
+            published.add(entity_id)
+            self.sm.set(entity_id, str(len(group)),
+                        {ATTR_MEMBERS: sorted(group)})
+
+        for entity_id in stale - published:
+            self.sm.set(entity_id, STATE_NO_GROUP, {ATTR_MEMBERS: []})
+
+    def within(self, latitude: float, longitude: float,
+               radius: float = None) -> list:
+        """
+        Find every device within radius metres of a point.
+        :param latitude: Latitude of the point
+        :param longitude: Longitude of the point
+        :param radius: Distance in metres, defaults to the grouping radius
+        :return: List of (entity ID, distance in metres), nearest first.
+        """
+        with self._lock:
+            return self.index.within(latitude, longitude, radius)
+
+    def near(self, device: str, radius: float = None) -> list:
+        """
+        Find every other device within radius metres of a device.
+        :param device: Entity ID of the device
+        :param radius: Distance in metres, defaults to the grouping radius
+        :return: List of (entity ID, distance in metres), nearest first.
+        """
+        with self._lock:
+            return self.index.near(device.lower(), radius)
+
+    def group_of(self, device: str) -> frozenset:
+        """
+        Get the group a device is in.
+        :param device: Entity ID of the device
+        :return: Entity IDs of the devices in its group, including itself.
+            Empty if the device isn't in a group.
+        """
+        with self._lock:
+            if (group_id := self._group_ids.get(device.lower())) is None \
+                    or len(members := self._members[group_id]) < 2:
+                return frozenset()
+            return frozenset(members)
+
+    def groups(self) -> list:
+        """
+        Get every group of two or more devices.
+        :return: List of frozensets of device entity IDs
+        """
+        with self._lock:
+            return [frozenset(members)
+                    for members in self._grouped(self._members)]
+
+
+def _entity_id(device: str) -> str:
+    """ Entity ID of the group led by device. """
+    return PROXIMITY_DOMAIN + "." + device.split('.', 1)[1]
+
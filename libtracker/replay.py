@@ -0,0 +1,297 @@
+import asyncio
+import csv
+import json
+import logging
+import os
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from array import array
+from datetime import datetime
+from itertools import groupby
+from typing import NamedTuple, Optional, Union
+
+import numpy as np
+
+from libtracker.constants import (
+    ATTR_LATITUDE,
+    ATTR_LONGITUDE,
+    CONFIG_REPLAY_TRACES,
+    CONFIG_REPLAY_SPEED,
+    CONFIG_REPLAY_COPIES,
+)
+from libtracker.scanner import Device
+
+DEFAULT_REPLAY_SPEED = 1.0
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class TracePoint(NamedTuple):
+    """
+    One location from a trace. CSV and JSON Lines traces have a field for
+    each, battery being optional. GPX traces have one device per track.
+    Timestamps are Unix times or ISO 8601 strings.
+    """
+    timestamp: float
+    device: str
+    latitude: float
+    longitude: float
+    battery: Optional[float] = None
+
+
+def _parse_time(value: Union[str, float, int]) -> float:
+    """ Convert a Unix time or an ISO 8601 string to a Unix time. """
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def _point(record: dict, device: str = None) -> TracePoint:
+    battery = record.get("battery")
+    return TracePoint(
+        _parse_time(record["timestamp"]),
+        str(device or record["device"]).replace(' ', ''),
+        float(record[ATTR_LATITUDE]),
+        float(record[ATTR_LONGITUDE]),
+        float(battery) if battery not in (None, "") else None
+    )
+
+
+def _load_csv(path: str) -> list:
+    with open(path, newline="") as f:
+        return [_point(row) for row in csv.DictReader(f)]
+
+
+def _load_jsonl(path: str) -> list:
+    with open(path) as f:
+        return [_point(json.loads(line)) for line in f if line.strip()]
+
+
+def _load_gpx(path: str) -> list:
+    points = []
+    default_name = os.path.splitext(os.path.basename(path))[0]
+
+    for _, track in ElementTree.iterparse(path):
+        # GPX elements are namespaced. Compare local names only.
+        if not track.tag.endswith("trk"):
+            continue
+
+        name = default_name
+        for child in track:
+            if child.tag.endswith("name") and child.text:
+                name = child.text
+                break
+
+        for i, trkpt in enumerate(e for e in track.iter()
+                                  if e.tag.endswith("trkpt")):
+            timestamp = next((e.text for e in trkpt
+                              if e.tag.endswith("time")), None)
+            points.append(_point({
+                # Untimed points are replayed a second apart.
+                "timestamp": timestamp if timestamp is not None else i,
+                ATTR_LATITUDE: trkpt.get("lat"),
+                ATTR_LONGITUDE: trkpt.get("lon"),
+            }, name))
+
+        track.clear()
+
+    return points
+
+
+TRACE_LOADERS = {
+    ".csv": _load_csv,
+    ".jsonl": _load_jsonl,
+    ".ndjson": _load_jsonl,
+    ".gpx": _load_gpx,
+}
+
+
+def load_trace(path: str) -> list:
+    """
+    Read a trace file.
+    :param path: Path to a CSV, JSON Lines or GPX file
+    :return: List of TracePoints sorted by timestamp.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in TRACE_LOADERS:
+        raise ValueError(f"Unsupported trace format: {path}")
+
+    return sorted(TRACE_LOADERS[extension](path),
+                  key=lambda point: point.timestamp)
+
+
+class ReplayScanner:
+    """
+    Scanner which feeds recorded traces through the normal Device update
+    path, so the pipeline can be load tested without iCloud credentials.
+
+    replay_speed is how many times faster than real time the traces are
+    played back, 0 meaning as fast as possible. replay_copies plays every
+    traced device that many times under different names, to simulate large
+    fleets from a few traces. The latency of an update is measured from when
+    it was due to when its state was committed to the state machine.
+    """
+    # Replayed trips must not message real Telegram users.
+    notifications = False
+    # ProximityTracker and TripTracker given to every device, set by the
+    # runner.
+    proximity = None
+    trips = None
+
+    def __init__(self, sm, config, zones=None) -> None:
+        self._sm = sm
+        self.config = config
+        self.zones = zones
+
+        traces = config.get(CONFIG_REPLAY_TRACES) or []
+        if not isinstance(traces, list):
+            traces = [traces]
+        if not traces:
+            raise RuntimeError(f"{CONFIG_REPLAY_TRACES} must list at least "
+                               "one trace file.")
+        self.traces = traces
+        self.speed = float(config.get(CONFIG_REPLAY_SPEED,
+                                      DEFAULT_REPLAY_SPEED))
+        self.copies = max(1, int(config.get(CONFIG_REPLAY_COPIES) or 1))
+
+        self.points = []
+        self.devices = {}
+        # Traced device name -> the devices replaying it
+        self._replicas: dict[str, list] = {}
+        self._latencies = array('d')
+        self._started_at = None
+        self._finished_at = None
+        self._stop = threading.Event()
+
+        self.running = False
+
+    def add_devices(self) -> None:
+        """ Load the traces and create a device for every replica. """
+        self.points = sorted(
+            (point for path in self.traces for point in load_trace(path)),
+            key=lambda point: point.timestamp
+        )
+
+        for point in self.points:
+            if point.device in self._replicas:
+                continue
+            replicas = []
+            for copy in range(self.copies):
+                name = point.device if copy == 0 else f"{point.device}_{copy}"
+                device = Device(self._sm, point.device, name, self.config,
+                                self.zones, self.proximity, self.trips)
+                self.devices[name] = device
+                replicas.append(device)
+            self._replicas[point.device] = replicas
+
+        self.running = True
+
+    def start(self) -> None:
+        """ Replay every trace once, then log a report. """
+        self.add_devices()
+        self.replay()
+        stats = self.stats()
+        _LOGGER.info(format_report(stats), extra={"replay": stats})
+
+    async def async_start(self, executor=None) -> None:
+        """ Run start in executor so the event loop is not blocked. """
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(executor, self.start)
+        finally:
+            self.running = False
+
+    def stop(self) -> None:
+        """ Stop replaying. Safe to call from any thread. """
+        self.running = False
+        self._stop.set()
+
+    def replay(self) -> None:
+        """
+        Push every trace point through its devices at the configured speed.
+        :return: None
+        """
+        if not self.points:
+            return
+
+        timer = time.perf_counter
+        first = self.points[0].timestamp
+        self._started_at = start = timer()
+
+        # Points recorded at the same time are committed together, as the
+        # devices of a scan cycle are.
+        for timestamp, points in groupby(self.points,
+                                         key=lambda point: point.timestamp):
+            if not self.running:
+                break
+
+            if self.speed > 0:
+                due = start + (timestamp - first) / self.speed
+                if (delay := due - timer()) > 0 and self._stop.wait(delay):
+                    break
+            else:
+                due = timer()
+
+            updates = 0
+            with self._sm.batch():
+                for point in points:
+                    gps = point.latitude, point.longitude
+                    for device in self._replicas[point.device]:
+                        device.mark_seen(device.name, None, gps,
+                                         point.battery, None, timestamp)
+                        updates += 1
+            self._latencies.extend([timer() - due] * updates)
+
+        self._finished_at = timer()
+        self.running = False
+
+    def stats(self) -> dict:
+        """
+        Get throughput and latency of the updates replayed so far.
+        :return: Dictionary with the number of updates, elapsed seconds,
+            updates per second and latency percentiles in seconds.
+        """
+        latencies = np.frombuffer(self._latencies, dtype=np.float64) \
+            if self._latencies else np.zeros(0)
+        updates = len(latencies)
+
+        if self._started_at is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self._finished_at or time.perf_counter()) \
+                - self._started_at
+
+        stats = {
+            "devices": len(self.devices),
+            "updates": updates,
+            "elapsed": elapsed,
+            "throughput": updates / elapsed if elapsed else 0.0,
+            "latency": None,
+        }
+        if updates:
+            p50, p95, p99 = np.percentile(latencies, (50, 95, 99))
+            stats["latency"] = {
+                "mean": float(latencies.mean()),
+                "p50": float(p50),
+                "p95": float(p95),
+                "p99": float(p99),
+                "max": float(latencies.max()),
+            }
+
+        return stats
+
+
+def format_report(stats: dict) -> str:
+    """ Format the output of ReplayScanner.stats for printing. """
+    lines = [
+        f"Replayed {stats['updates']} updates for {stats['devices']} devices "
+        f"in {stats['elapsed']:.2f}s ({stats['throughput']:.0f} updates/s)."
+    ]
+    if latency := stats["latency"]:
+        lines.append("Latency: " + ", ".join(
+            f"{key} {value * 1000:.3f}ms" for key, value in latency.items()
+        ))
+
+    return "\n".join(lines)
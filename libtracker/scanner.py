@@ -1,26 +1,49 @@
+import asyncio
+import logging
 from typing import Tuple, Optional, Any
 
 import click
 from pyicloud import PyiCloudService
 from pyicloud.exceptions import PyiCloudNoDevicesException
-from time import sleep
+from time import sleep, time, perf_counter
 
 from libtracker.constants import (
     ATTR_LATITUDE,
     ATTR_LONGITUDE,
     ATTR_ATTRS,
+    ATTR_TIMESTAMP,
     CONFIG_APPLE_ID_USERNAME,
-    CONFIG_APPLE_ID_PASSWORD
+    CONFIG_APPLE_ID_PASSWORD,
+    CONFIG_STATUS_FIELDS
 )
+from libtracker import metrics
 from libtracker.entity import Entity
-from libtracker.zone import inverse_vincenty, in_zone
-from libtracker.notify import send_notification
+from libtracker.zone import inverse_vincenty, in_zone, ZONE_RADIUS_OFFSET
+from libtracker.history import open_history
+from libtracker.distance import haversine
+from libtracker.schedule import ScanScheduler, boundary_distance
+
+_LOGGER = logging.getLogger(__name__)
+
+SCAN_DURATION = metrics.histogram(
+    "libtracker_scan_duration_seconds",
+    "Time taken by a scan cycle, from fetching statuses to updating states."
+)
+ICLOUD_REQUEST_DURATION = metrics.histogram(
+    "libtracker_icloud_request_duration_seconds",
+    "Latency of requests to the Find My iPhone service.",
+    ("call",)
+)
+_REFRESH_DURATION = ICLOUD_REQUEST_DURATION.labels("refresh")
+_STATUS_DURATION = ICLOUD_REQUEST_DURATION.labels("status")
 
 STATE_HOME = "home"
 STATE_AWAY = "away"
 
 DEFAULT_SCAN_INTERVAL = 15
 
+_MISSING = object()
+
 DEVICE_STATUS_SET = ['features', 'maxMsgChar', 'darkWake', 'fmlyShare',
                      'deviceStatus', 'remoteLock', 'activationLocked',
                      'deviceClass', 'id', 'deviceModel', 'rawDeviceModel',
@@ -34,25 +57,39 @@ DEVICE_STATUS_SET = ['features', 'maxMsgChar', 'darkWake', 'fmlyShare',
                      'wipedTimestamp', 'modelDisplayName', 'locationEnabled',
                      'isMac', 'locFoundEnabled']
 
+# Fields read from every device on each poll. Anything else is only read on
+# demand by device_status, or when listed under status_fields in the config.
+STATUS_FIELDS = ['id', 'name', 'location', 'batteryLevel']
+
 
 class Device(Entity):
     """ Class to represent a tracked device entity. """
 
     gps: Optional[Tuple[float, float]] = None
     location_name: Optional[str] = None
-
-    _notified: bool = False
-    _notified_since_last_home: bool = False
-
-    def __init__(self, sm, device, name, config) -> None:
+    # Speed in m/s between the last two locations, None until seen twice.
+    speed: Optional[float] = None
+    _seen_at: Optional[float] = None
+    # Time the current location was first recorded.
+    _located_at: Optional[float] = None
+
+    def __init__(self, sm, device, name, config, zones=None,
+                 proximity=None, trips=None) -> None:
         self.sm = sm
         self.device = device
         self.entity_id = "device." + name
         self.config = config
+        self.zones = zones
+        # ProximityTracker to move the device in, or None.
+        self.proximity = proximity
+        # TripTracker to add every location to, or None.
+        self.trips = trips
         self.battery = None
         self._name = name
         self._state = None
         self._attrs = {}
+        # None unless location history is enabled in the config.
+        self.history = open_history(config, name)
 
     @property
     def name(self) -> str:
@@ -71,69 +108,157 @@ class Device(Entity):
             ATTR_LATITUDE: self.gps[0],
             ATTR_LONGITUDE: self.gps[1]
         }
+        if self._located_at is not None:
+            attrs[ATTR_TIMESTAMP] = self._located_at
 
         if self._attrs:
-            attrs[ATTR_ATTRS] = self._attrs
+            # Copy so later updates to the device don't leak into the state
+            # already stored in the state machine.
+            attrs[ATTR_ATTRS] = dict(self._attrs)
 
         return attrs
 
     def update(self) -> None:
         """ Update the device entity with data from the iCloud tracker. """
+        old_state = self._state
         if self.location_name:
             self._state = self.location_name
 
         if self.gps is not None:
-            # Fetch the home zone entity from the state machine.
-            h_zone = self.sm.get("zone.home")
-            # Is the device home?
-            zone_state = in_zone(h_zone, self.gps[0], self.gps[1], 7)
+            if self.zones is not None:
+                # Only run the exact check against zones near the device.
+                zones = self.zones.zones_containing(self.gps[0],
+                                                    self.gps[1],
+                                                    ZONE_RADIUS_OFFSET)
+                zone_state = any(z.entity_id == "zone.home" for z in zones)
+            else:
+                # Fetch the home zone entity from the state machine.
+                h_zone = self.sm.get("zone.home")
+                zones = []
+                # Is the device home?
+                zone_state = in_zone(h_zone, self.gps[0], self.gps[1],
+                                     ZONE_RADIUS_OFFSET)
             if zone_state:
                 # The device is home.
                 self._state = STATE_HOME
-                if not self._notified_since_last_home:
-                    # If we haven't sent a Telegram since the device returned home
-                    # do so now.
-                    send_notification(self.name, self.config)
-                self._notified_since_last_home = True
             else:
-                # The device is not home.
-                self._state = STATE_AWAY
-                self._notified_since_last_home = False
+                # The device is not home. If it is inside another zone use
+                # the zone's name as the state. Where zones overlap this is
+                # the smallest, as zones_containing orders them.
+                if zones:
+                    self._state = zones[0].entity_id.split('.', 1)[1]
+                else:
+                    self._state = STATE_AWAY
 
         else:
             self._state = STATE_AWAY
 
-        # Update state machine.
+        if self._state != old_state:
+            self._dirty = True
+
+        # Update state machine. Skipped if nothing has changed.
         self.push_state()
 
+    def snapshot(self) -> dict[str, Any]:
+        """ Get the tracking data to save in a state snapshot. """
+        return {
+            "device": str(self.device),
+            "state": self._state,
+            "gps": self.gps,
+            "battery": self.battery,
+            "speed": self.speed,
+            "seen_at": self._seen_at,
+            "located_at": self._located_at,
+            "attrs": self._attrs,
+        }
+
+    def restore(self, record: dict[str, Any]) -> None:
+        """
+        Restore tracking data saved by snapshot, so that the first scan after
+        a restart carries on from where the last run left off.
+        """
+        self._state = record.get("state")
+        gps = record.get("gps")
+        self.gps = None if gps is None else (float(gps[0]), float(gps[1]))
+        self.battery = record.get("battery")
+        self.speed = record.get("speed")
+        self._seen_at = record.get("seen_at")
+        self._located_at = record.get("located_at")
+        self._attrs = dict(record.get("attrs") or {})
+        self._dirty = True
+
     def mark_seen(self, device_name: str, location_name: str,
                   gps: Tuple[float, float], battery: float,
-                  attrs: dict[Any]) -> None:
-        """ Mark a device as seen by the iCloud scanner. """
+                  attrs: dict[Any], seen_at: float = None) -> None:
+        """
+        Mark a device as seen by the iCloud scanner.
+        :param seen_at: Time the location was recorded, defaults to now
+        """
+        now = time() if seen_at is None else seen_at
         self._name = device_name
         self.location_name = location_name
 
         if battery:
             self.battery = battery
-        if attrs:
+        if attrs and any(self._attrs.get(key, _MISSING) != value
+                         for key, value in attrs.items()):
             self._attrs.update(attrs)
+            self._dirty = True
 
+        moved = False
         if gps is not None:
-            self.gps = float(gps[0]), float(gps[1])
+            gps = float(gps[0]), float(gps[1])
+            if gps != self.gps:
+                self._dirty = True
+                moved = True
+                self._located_at = float(now)
+            if self.gps is not None and self._seen_at is not None \
+                    and now > self._seen_at:
+                self.speed = haversine(self.gps, gps) * 1000 \
+                    / (now - self._seen_at)
+            self._seen_at = now
+            self.gps = gps
 
         self.update()
 
+        if moved and self.proximity is not None:
+            # Inside a scanner batch, so group changes are committed with
+            # the position.
+            self.proximity.update(self.entity_id, *self.gps)
+        if gps is not None and self.trips is not None:
+            # Unchanged locations too, as they make a stop last.
+            self.trips.update(self.entity_id, now, *self.gps)
+
+        if self.history is not None and self.gps is not None:
+            self.history.append(now, self.gps[0], self.gps[1],
+                                self.battery, self._state)
+
 
 class ICloudDeviceScanner:
     """ Class to represent an iCloud device scanner. """
-    def __init__(self, sm, config) -> None:
+    # ProximityTracker and TripTracker given to every device, set by the
+    # runner.
+    proximity = None
+    trips = None
+    # Put before the name of every device, so devices of different accounts
+    # tracked together can't share an entity ID.
+    device_prefix = ""
+
+    def __init__(self, sm, config, zones=None) -> None:
         self._sm = sm
         self.config = config
+        self.zones = zones
         self.__username = config[CONFIG_APPLE_ID_USERNAME]
         self.__password = config[CONFIG_APPLE_ID_PASSWORD]
         self.api = PyiCloudService(self.__username, self.__password)
         self.devices = {}
+        # iCloud device ID -> key into self.devices
+        self._device_ids = {}
         self._first_iter = True
+        self._executor = None
+        # None unless adaptive scanning is enabled in the config.
+        self.scheduler = ScanScheduler.from_config(config)
+        self.status_fields = status_fields(config)
 
         self.running = False
 
@@ -152,13 +277,92 @@ class ICloudDeviceScanner:
         :return: None
         """
         while self.running:
-            for device in self.devices:
-                self.update(self.devices[device])
-            sleep(DEFAULT_SCAN_INTERVAL)
+            if self.scheduler is None:
+                self.update_all()
+                sleep(DEFAULT_SCAN_INTERVAL)
+            else:
+                self.update_due()
+                sleep(self.scheduler.wait_time())
+
+            if self._first_iter:
+                self._first_iter = False
+
+    async def async_start(self, executor=None) -> None:
+        """
+        Start the scanner as a coroutine. Blocking iCloud calls are run in
+        executor.
+        """
+        loop = asyncio.get_running_loop()
+        self._executor = executor
+
+        if self.api.requires_2fa:
+            await loop.run_in_executor(executor, self.do_icloud_2fa)
+
+        await loop.run_in_executor(executor, self.add_devices)
+
+        await self.async_keep_alive()
+
+    async def async_keep_alive(self) -> None:
+        """
+        Keep the loop running without blocking the event loop.
+        :return: None
+        """
+        while self.running:
+            if self.scheduler is None:
+                await self.async_update_all()
+                await asyncio.sleep(DEFAULT_SCAN_INTERVAL)
+            else:
+                await self.async_update_due()
+                await asyncio.sleep(self.scheduler.wait_time())
 
             if self._first_iter:
                 self._first_iter = False
 
+    async def async_update_all(self) -> None:
+        """
+        Update every tracked device, fetching the snapshot in the executor.
+        :return: None
+        """
+        start = perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            snapshot = await loop.run_in_executor(self._executor,
+                                                  self.fetch_snapshot)
+        except PyiCloudNoDevicesException:
+            _LOGGER.warning("No devices found.")
+            return
+
+        self._process_snapshot(snapshot)
+        _observe_scan(start)
+
+    async def async_update_due(self) -> None:
+        """
+        Update the devices the scheduler says are due, fetching the snapshot
+        in the executor.
+        :return: None
+        """
+        if not (due := self._take_due()):
+            return
+
+        start = perf_counter()
+        loop = asyncio.get_running_loop()
+        rescheduled = False
+        try:
+            try:
+                snapshot = await loop.run_in_executor(self._executor,
+                                                      self.fetch_snapshot)
+            except PyiCloudNoDevicesException:
+                _LOGGER.warning("No devices found.")
+                snapshot = {}
+
+            self._process_snapshot(snapshot, due)
+            self._reschedule(due)
+            rescheduled = True
+        finally:
+            if not rescheduled:
+                self._retry(due)
+        _observe_scan(start)
+
     def do_icloud_2fa(self) -> None:
         devices = self.api.trusted_devices
         fmt_devices = []
@@ -176,7 +380,7 @@ class ICloudDeviceScanner:
         device = devices[device]
 
         if not self.api.send_verification_code(device):
-            print("Failed to send verification code.")
+            _LOGGER.error("Failed to send verification code.")
             exit(1)
 
         code = click.prompt("Please enter validation code.")
@@ -185,14 +389,76 @@ class ICloudDeviceScanner:
 
     def add_devices(self) -> None:
         for device in self.api.devices:
-            status = device.status(DEVICE_STATUS_SET)
-            devicename = status["name"].replace(' ', '', 99)
-            device = Device(self._sm, device, devicename, self.config)
-            self.devices[devicename] = device
+            # The device list already holds these fields, so don't refresh
+            # every device just to read them.
+            status = _read_status(device, ["id", "name"])
+            devicename = self.device_prefix + \
+                status["name"].replace(' ', '', 99)
+            if devicename in self.devices:
+                # Restored from a snapshot. Attach the live device.
+                self.devices[devicename].device = device
+            else:
+                self.devices[devicename] = Device(self._sm, device,
+                                                  devicename, self.config,
+                                                  self.zones, self.proximity,
+                                                  self.trips)
+            self._device_ids[status["id"]] = devicename
+            if self.scheduler is not None:
+                self.scheduler.schedule(devicename)
             self.running = True
 
+    def export_devices(self) -> dict[str, dict[str, Any]]:
+        """
+        Get the device registry to save in a state snapshot.
+        :return: Dictionary of device tracking data keyed by device name.
+        """
+        names = {name: device_id
+                 for device_id, name in self._device_ids.items()}
+        return {
+            name: dict(device.snapshot(), id=names.get(name),
+                       account=self.__username)
+            for name, device in list(self.devices.items())
+        }
+
+    def restore_devices(self, records: dict[str, dict[str, Any]]) -> int:
+        """
+        Recreate the devices of this account from a snapshot. The restored
+        devices are updated by the first scan as usual.
+        :param records: Device registry saved by export_devices
+        :return: Number of devices restored
+        """
+        count = 0
+        for name, record in records.items():
+            if record.get("account") != self.__username \
+                    or record.get("id") is None:
+                continue
+            device = Device(self._sm, record.get("device"), name,
+                            self.config, self.zones, self.proximity,
+                            self.trips)
+            device.restore(record)
+            self.devices[name] = device
+            self._device_ids[record["id"]] = name
+            count += 1
+
+        return count
+
+    def device_status(self, name: str,
+                      fields: list[str] = None) -> dict[str, Any]:
+        """
+        Read the full status of one device as of the last refresh. Polls only
+        read status_fields, so use this for anything else.
+        :param name: Name of a tracked device
+        :param fields: Fields to read. Defaults to DEVICE_STATUS_SET.
+        :return: Dictionary of status fields
+        """
+        return _read_status(self.devices[name].device,
+                            fields or DEVICE_STATUS_SET)
+
     def determine_distance(self, latitude: float, longitude: float) -> float:
         h_zone = self._sm.get("zone.home")
+        if self.zones is not None and self.zones.cache is not None:
+            return self.zones.cache.zone_distance(h_zone, latitude, longitude)
+
         zone_state_lat = h_zone.attrs[ATTR_LATITUDE]
         zone_state_lon = h_zone.attrs[ATTR_LONGITUDE]
 
@@ -203,27 +469,227 @@ class ICloudDeviceScanner:
 
         return distance  # km
 
+    def determine_distances(self, coords) -> Any:
+        """
+        Distance of many (latitude, longitude) pairs from the home zone in a
+        single vectorised call.
+        :param coords: Array-like of shape (N, 2)
+        :return: Array of N distances in km, NaN where Vincenty did not
+            converge.
+        """
+        from libtracker.geodesic import inverse_vincenty_batch
+
+        h_zone = self._sm.get("zone.home")
+        zone_state_lat = h_zone.attrs[ATTR_LATITUDE]
+        zone_state_lon = h_zone.attrs[ATTR_LONGITUDE]
+
+        return inverse_vincenty_batch(
+            coords, (float(zone_state_lat), float(zone_state_lon))
+        )  # km
+
+    def fetch_snapshot(self) -> dict[str, dict[str, Any]]:
+        """
+        Fetch the status of every device on the account with a single refresh
+        of the Find My iPhone service.
+        :return: Dictionary of device statuses keyed by iCloud device ID.
+        """
+        manager = self.api.devices
+        start = perf_counter()
+        _refresh_devices(manager)
+        if metrics.enabled:
+            _REFRESH_DURATION.observe(perf_counter() - start)
+
+        snapshot = {}
+        for device in manager:
+            status = _read_status(device, self.status_fields)
+            snapshot[status["id"]] = status
+
+        return snapshot
+
+    def update_all(self) -> None:
+        """
+        Update every tracked device from one snapshot of the account.
+        :return: None
+        """
+        start = perf_counter()
+        try:
+            snapshot = self.fetch_snapshot()
+        except PyiCloudNoDevicesException:
+            _LOGGER.warning("No devices found.")
+            return
+
+        self._process_snapshot(snapshot)
+        _observe_scan(start)
+
+    def update_due(self) -> None:
+        """
+        Update only the devices the scheduler says are due, from one snapshot
+        of the account, and schedule their next poll.
+        :return: None
+        """
+        if not (due := self._take_due()):
+            return
+
+        start = perf_counter()
+        rescheduled = False
+        try:
+            try:
+                snapshot = self.fetch_snapshot()
+            except PyiCloudNoDevicesException:
+                _LOGGER.warning("No devices found.")
+                snapshot = {}
+
+            self._process_snapshot(snapshot, due)
+            self._reschedule(due)
+            rescheduled = True
+        finally:
+            # The devices are no longer queued, so put them back or they
+            # would never be polled again.
+            if not rescheduled:
+                self._retry(due)
+        _observe_scan(start)
+
+    def _take_due(self) -> list:
+        """ Take the due devices and count the poll against the budget. """
+        due = self.scheduler.pop_due()
+        if due:
+            self.scheduler.record_request()
+        return due
+
+    def _reschedule(self, names: list) -> None:
+        """ Schedule the next poll of each device from how it is moving. """
+        for name in names:
+            device = self.devices[name]
+            nearest = None
+            if device.gps is not None and self.zones is not None:
+                nearest = boundary_distance(self.zones, *device.gps)
+            self.scheduler.schedule(
+                name, self.scheduler.interval_for(device.speed, nearest)
+            )
+
+    def _retry(self, names: list) -> None:
+        """ Schedule devices whose poll failed, backing off each time. """
+        for name in names:
+            self.scheduler.retry(name)
+
+    def _process_snapshot(self, snapshot: dict[str, dict[str, Any]],
+                          only: list = None) -> None:
+        """
+        Update tracked devices from a snapshot of the account.
+        :param snapshot: Device statuses keyed by iCloud device ID
+        :param only: Names of the devices to update, or None for all
+        """
+        only = None if only is None else set(only)
+        tracked = [(self.devices[name], status)
+                   for device_id, status in snapshot.items()
+                   if (name := self._device_ids.get(device_id)) is not None
+                   and (only is None or name in only)]
+        # The distance from home is only logged, so don't work it out
+        # unless it will be.
+        located = [status['location'] for _, status in tracked
+                   if status['location']] \
+            if _LOGGER.isEnabledFor(logging.DEBUG) else []
+        if located:
+            distances = iter(self.determine_distances([
+                (location[ATTR_LATITUDE], location[ATTR_LONGITUDE])
+                for location in located
+            ]))
+
+        # Publish the whole cycle as one update of the state machine.
+        with self._sm.batch():
+            for device_o, status in tracked:
+                _LOGGER.info("Updating location for: %s", device_o.device,
+                             extra={"device": device_o.name})
+                if status['location']:
+                    if located:
+                        distance = float(next(distances))
+                        _LOGGER.debug("Device is %skm from home.", distance,
+                                      extra={"device": device_o.name,
+                                             "distance_km": distance})
+                    self._see_device(device_o, status)
+
+    def _see_device(self, device_o: Device, status: dict[str, Any]) -> None:
+        """ Mark a device as seen using a status with a location. """
+        location = status['location']
+        battery = (status.get('batteryLevel') or 0) * 100
+
+        gps = location[ATTR_LATITUDE], location[ATTR_LONGITUDE]
+        # Extra configured fields are published as device attributes.
+        attrs = {field: status.get(field) for field in self.status_fields
+                 if field not in STATUS_FIELDS} or None
+        # mark_seen pushes the new state itself.
+        self.devices[device_o.name].mark_seen(device_o.name, "Test",
+                                              gps, battery, attrs)
+
     def update(self, device_o: Device) -> None:
         try:
             for device in self.api.devices:
                 if str(device) != str(device_o.device):
                     continue
 
-                print("Updating location for: " + str(device))
+                _LOGGER.info("Updating location for: %s", device,
+                             extra={"device": device_o.name})
 
-                status = device.status(DEVICE_STATUS_SET)
+                start = perf_counter()
+                status = device.status(self.status_fields)
+                if metrics.enabled:
+                    _STATUS_DURATION.observe(perf_counter() - start)
                 location = status['location']
-                battery = status.get('batteryLevel', 0) * 100
 
                 if location:
-                    distance = self.determine_distance(location[ATTR_LATITUDE],
-                                                       location[ATTR_LONGITUDE])
-                    print(f"Device is {str(distance)}km from home.")
+                    if _LOGGER.isEnabledFor(logging.DEBUG):
+                        distance = self.determine_distance(
+                            location[ATTR_LATITUDE], location[ATTR_LONGITUDE]
+                        )
+                        _LOGGER.debug("Device is %skm from home.", distance,
+                                      extra={"device": device_o.name,
+                                             "distance_km": distance})
 
-                    gps = location[ATTR_LATITUDE], location[ATTR_LONGITUDE]
-                    self.devices[device_o.name].mark_seen(device_o.name, "Test",
-                                                          gps, battery, None)
-                    self.devices[device_o.name].push_state()
+                    self._see_device(device_o, status)
 
         except PyiCloudNoDevicesException:
-            print("No devices found.")
+            _LOGGER.warning("No devices found.")
+
+
+def _observe_scan(start: float) -> None:
+    """ Record the duration of a scan cycle which began at start. """
+    if metrics.enabled:
+        SCAN_DURATION.observe(perf_counter() - start)
+
+
+def _refresh_devices(manager) -> None:
+    """ Refresh the status of every device with one Find My iPhone request. """
+    # Older pyicloud releases call this refresh_client.
+    refresh = getattr(manager, "refresh", None) or manager.refresh_client
+    refresh()
+
+
+def status_fields(config: dict) -> list[str]:
+    """
+    Get the status fields to read on each poll: STATUS_FIELDS plus any listed
+    under status_fields in the config.
+    :param config: Libtracker configuration object
+    :return: List of field names
+    """
+    extra = config.get(CONFIG_STATUS_FIELDS) or []
+    if isinstance(extra, str):
+        extra = [extra]
+
+    fields = list(STATUS_FIELDS)
+    fields.extend(field for field in extra if field not in fields)
+    return fields
+
+
+def _read_status(device, fields: list[str]) -> dict[str, Any]:
+    """
+    Read status fields from the data a device already holds. Unlike
+    AppleDevice.status this does not trigger a refresh of its own.
+    """
+    status = {}
+    for field in fields:
+        try:
+            status[field] = device[field]
+        except KeyError:
+            status[field] = None
+
+    return status
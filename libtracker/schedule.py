@@ -0,0 +1,197 @@
+import heapq
+import itertools
+import time
+from collections import deque
+from typing import Optional, Callable, Hashable
+
+from libtracker.constants import (
+    CONFIG_SCAN_ADAPTIVE,
+    CONFIG_SCAN_MIN_INTERVAL,
+    CONFIG_SCAN_MAX_INTERVAL,
+    CONFIG_SCAN_BUDGET,
+)
+from libtracker.distance import haversine
+
+DEFAULT_MIN_SCAN_INTERVAL = 15  # s
+DEFAULT_MAX_SCAN_INTERVAL = 300  # s
+
+# Only zones this close are considered when finding the nearest boundary.
+BOUNDARY_SEARCH_RADIUS = 5000  # m
+# Speeds below this are treated as GPS jitter rather than movement.
+MIN_SPEED = 0.5  # m/s
+# Poll again after this fraction of the time the device needs to reach the
+# nearest zone boundary at its current speed.
+SAFETY_FACTOR = 0.5
+
+BUDGET_WINDOW = 60  # s
+
+
+class ScanScheduler:
+    """
+    Priority queue of devices ordered by when each should next be polled.
+
+    A device's next poll is brought forward when it is moving quickly or is
+    close to a zone boundary, where its state is likely to change, and pushed
+    back towards max_interval while it is idle. budget caps the number of
+    requests made in any minute; due devices simply wait for the next slot.
+    """
+    def __init__(self, min_interval: float = DEFAULT_MIN_SCAN_INTERVAL,
+                 max_interval: float = DEFAULT_MAX_SCAN_INTERVAL,
+                 budget: int = None,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.budget = budget
+        self.clock = clock
+
+        self._heap: list = []
+        self._when: dict = {}
+        # Consecutive failed polls of each device, see retry.
+        self._failures: dict = {}
+        self._counter = itertools.count()
+        self._requests: deque = deque()
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["ScanScheduler"]:
+        """
+        Create a scheduler from the configuration.
+        :param config: Libtracker configuration object
+        :return: The scheduler, or None if adaptive scanning is disabled.
+        """
+        if not config.get(CONFIG_SCAN_ADAPTIVE):
+            return None
+
+        budget = config.get(CONFIG_SCAN_BUDGET)
+        return cls(
+            float(config.get(CONFIG_SCAN_MIN_INTERVAL,
+                             DEFAULT_MIN_SCAN_INTERVAL)),
+            float(config.get(CONFIG_SCAN_MAX_INTERVAL,
+                             DEFAULT_MAX_SCAN_INTERVAL)),
+            int(budget) if budget else None
+        )
+
+    def __len__(self) -> int:
+        return len(self._when)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._when
+
+    def schedule(self, key: Hashable, delay: float = 0) -> None:
+        """
+        Schedule a device to be polled after delay seconds, replacing any
+        previous schedule for it.
+        :param key: The device to schedule
+        :param delay: Seconds from now
+        :return: None
+        """
+        self._failures.pop(key, None)
+        self._push(key, delay)
+
+    def retry(self, key: Hashable) -> float:
+        """
+        Schedule a device whose poll failed. The delay starts at min_interval
+        and doubles with every consecutive failure up to max_interval, and is
+        reset by the next call to schedule.
+        :param key: The device to schedule
+        :return: The delay in seconds
+        """
+        failures = self._failures.get(key, 0)
+        self._failures[key] = failures + 1
+        delay = min(self.max_interval, self.min_interval * 2 ** failures)
+        self._push(key, delay)
+        return delay
+
+    def _push(self, key: Hashable, delay: float) -> None:
+        when = self.clock() + delay
+        self._when[key] = when
+        heapq.heappush(self._heap, (when, next(self._counter), key))
+
+    def remove(self, key: Hashable) -> None:
+        """ Stop polling a device. """
+        self._when.pop(key, None)
+        self._failures.pop(key, None)
+
+    def _prune(self, now: float) -> None:
+        while self._requests and self._requests[0] <= now - BUDGET_WINDOW:
+            self._requests.popleft()
+        # Drop heap entries that have been rescheduled or removed.
+        while self._heap and self._when.get(self._heap[0][2]) != \
+                self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def pop_due(self) -> list:
+        """
+        Take every device that is due, if the request budget allows a poll
+        now. The caller should reschedule them once polled.
+        :return: List of due devices, empty if none are due or the budget
+            is spent.
+        """
+        now = self.clock()
+        self._prune(now)
+        if self.budget is not None and len(self._requests) >= self.budget:
+            return []
+
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, _, key = heapq.heappop(self._heap)
+            if self._when.get(key) == when:
+                del self._when[key]
+                due.append(key)
+
+        return due
+
+    def record_request(self) -> None:
+        """ Count a request against the budget. """
+        self._requests.append(self.clock())
+
+    def wait_time(self) -> float:
+        """ Seconds until a device is due and the budget allows polling. """
+        now = self.clock()
+        self._prune(now)
+
+        wait = self._heap[0][0] - now if self._heap else self.max_interval
+        if self.budget is not None and len(self._requests) >= self.budget:
+            wait = max(wait, self._requests[0] + BUDGET_WINDOW - now)
+
+        return max(0.0, wait)
+
+    def interval_for(self, speed: Optional[float],
+                     boundary_distance: Optional[float]) -> float:
+        """
+        Choose how long to wait before polling a device again.
+        :param speed: Recent speed of the device in m/s, None if unknown
+        :param boundary_distance: Metres to the nearest zone boundary, None
+            if no zone is nearby
+        :return: Interval in seconds between min_interval and max_interval
+        """
+        if speed is None:
+            return self.min_interval
+        if boundary_distance is None:
+            boundary_distance = BOUNDARY_SEARCH_RADIUS
+
+        interval = SAFETY_FACTOR * boundary_distance / max(speed, MIN_SPEED)
+        return min(self.max_interval, max(self.min_interval, interval))
+
+
+def boundary_distance(zones, latitude: float,
+                      longitude: float) -> Optional[float]:
+    """
+    Approximate distance from a point to the nearest zone boundary.
+    :param zones: ZoneIndex to search
+    :param latitude: Latitude of device
+    :param longitude: Longitude of device
+    :return: Distance in metres, or None if no zone is within
+        BOUNDARY_SEARCH_RADIUS.
+    """
+    nearest = None
+    for entity_id in zones.candidates(latitude, longitude,
+                                      BOUNDARY_SEARCH_RADIUS):
+        if (zone := zones.prepared(entity_id)) is None:
+            continue
+        distance = haversine((zone.latitude, zone.longitude),
+                             (latitude, longitude)) * 1000  # km -> m
+        edge = abs(distance - zone.radius)
+        if nearest is None or edge < nearest:
+            nearest = edge
+
+    return nearest
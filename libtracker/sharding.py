@@ -0,0 +1,292 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import re
+import time
+from typing import Any
+
+from libtracker.constants import (
+    CONFIG_APPLE_ACCOUNTS,
+    CONFIG_ACCOUNT_NAME,
+    CONFIG_APPLE_ID_USERNAME,
+    CONFIG_APPLE_ID_PASSWORD,
+    CONFIG_SCAN_WORKERS,
+)
+
+WORKER_STARTING = "starting"
+WORKER_OK = "ok"
+WORKER_ERROR = "error"
+WORKER_DEAD = "dead"
+
+# A worker that has not reported for this long is marked dead.
+HEALTH_TIMEOUT = 120  # s
+POLL_INTERVAL = 1  # s
+
+MSG_STATE = "state"
+MSG_HEALTH = "health"
+MSG_SEGMENTS = "segments"
+
+
+def shard_accounts(accounts: list, workers: int) -> list:
+    """
+    Split accounts round robin into at most workers shards.
+    :param accounts: List of account configurations
+    :param workers: Maximum number of shards
+    :return: List of non-empty lists of accounts
+    """
+    workers = max(1, min(workers, len(accounts)))
+    return [accounts[i::workers] for i in range(workers)]
+
+
+def account_name(account: dict) -> str:
+    """
+    Get the name an account's devices are prefixed with: its configured name,
+    or else the part of its Apple ID before the @. Anything but letters,
+    digits and underscores is replaced with an underscore.
+    :param account: Account configuration
+    :return: The lower case account name
+    """
+    name = account.get(CONFIG_ACCOUNT_NAME) or \
+        account[CONFIG_APPLE_ID_USERNAME].split("@", 1)[0]
+    return re.sub(r"\W", "_", str(name)).lower()
+
+
+class ShardedICloudScanner:
+    """
+    Scanner for many Apple IDs at once.
+
+    The accounts under apple_accounts are sharded across worker processes,
+    each running an ICloudDeviceScanner per account against its own state
+    machine. Devices are named <account>_<device>, as two accounts often
+    have a device with the same name. Workers stream every device state
+    change and a heartbeat back to this process over a queue. Changes are
+    applied to the shared state machine and each worker's health is
+    published as a worker.<n> entity.
+    Trips and stops are segmented in the workers, where the devices are
+    seen, and their events are passed on through this process's TripTracker.
+    """
+    # Scanner run for each account inside the workers.
+    scanner_class = None
+    # ProximityTracker fed with the device positions received from the
+    # workers, and TripTracker passing on their segment events. Set by the
+    # runner.
+    proximity = None
+    trips = None
+
+    def __init__(self, sm, config, zones=None) -> None:
+        self._sm = sm
+        self.config = config
+        self.zones = zones
+        self.accounts = list(config.get(CONFIG_APPLE_ACCOUNTS) or [])
+        if not self.accounts:
+            raise RuntimeError(f"{CONFIG_APPLE_ACCOUNTS} must list at least "
+                               "one account.")
+        names = [account_name(account) for account in self.accounts]
+        if duplicates := sorted({n for n in names if names.count(n) > 1}):
+            raise RuntimeError(
+                f"More than one account in {CONFIG_APPLE_ACCOUNTS} is named "
+                f"{', '.join(duplicates)}. Give each a unique "
+                f"{CONFIG_ACCOUNT_NAME}."
+            )
+
+        workers = config.get(CONFIG_SCAN_WORKERS) or os.cpu_count() or 1
+        self.shards = shard_accounts(self.accounts, int(workers))
+
+        self._ctx = multiprocessing.get_context("spawn")
+        self._queue = self._ctx.Queue()
+        self._stop = self._ctx.Event()
+        self._processes: dict[int, Any] = {}
+        self._last_seen: dict[int, float] = {}
+
+        self.running = False
+
+    def start(self) -> None:
+        """ Start the workers and apply their updates until stopped. """
+        for worker_id, shard in enumerate(self.shards):
+            process = self._ctx.Process(
+                target=_worker_main,
+                args=(worker_id, shard, self.config, self._queue, self._stop,
+                      self.scanner_class),
+                name=f"libtracker-worker-{worker_id}",
+                daemon=True
+            )
+            process.start()
+            self._processes[worker_id] = process
+            self._last_seen[worker_id] = time.monotonic()
+            self._set_health(worker_id, WORKER_STARTING,
+                             {"pid": process.pid, "accounts": len(shard)})
+
+        self.running = True
+        try:
+            while self.running:
+                self.receive(POLL_INTERVAL)
+                self.check_workers()
+        finally:
+            self.stop()
+
+    async def async_start(self, executor=None) -> None:
+        """ Run start in executor so the event loop is not blocked. """
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(executor, self.start)
+        finally:
+            self.running = False
+
+    def stop(self, timeout: float = 5) -> None:
+        """
+        Stop every worker.
+        :param timeout: Seconds to wait for each worker before killing it
+        :return: None
+        """
+        self.running = False
+        self._stop.set()
+        for process in self._processes.values():
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+    def receive(self, timeout: float = None) -> int:
+        """
+        Apply every message waiting from the workers.
+        :param timeout: Seconds to wait for the first message
+        :return: Number of messages applied
+        """
+        count = 0
+        try:
+            message = self._queue.get(timeout=timeout)
+            while True:
+                self._apply(message)
+                count += 1
+                message = self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+        return count
+
+    def _apply(self, message: tuple) -> None:
+        kind, worker_id, payload = message
+        self._last_seen[worker_id] = time.monotonic()
+
+        if kind == MSG_STATE:
+            # Devices are marked seen in the workers, so their positions
+            # reach the proximity tracker here, in the same commit.
+            with self._sm.batch():
+                for entity_id, state, attrs in payload:
+                    self._sm.set(entity_id, state, attrs)
+                    if self.proximity is not None:
+                        self.proximity.update_state(entity_id, attrs)
+        elif kind == MSG_SEGMENTS:
+            if self.trips is not None:
+                self.trips.publish(payload)
+        elif kind == MSG_HEALTH:
+            status = payload.pop("status")
+            self._set_health(worker_id, status, payload)
+
+    def check_workers(self) -> None:
+        """ Mark workers which have exited or stopped reporting as dead. """
+        now = time.monotonic()
+        for worker_id, process in self._processes.items():
+            if not process.is_alive():
+                reason = f"exited with code {process.exitcode}"
+            elif now - self._last_seen[worker_id] > HEALTH_TIMEOUT:
+                reason = "stopped reporting"
+            else:
+                continue
+
+            health = self._sm.get(f"worker.{worker_id}")
+            if health is None or health.state != WORKER_DEAD:
+                attrs = dict(health.attrs) if health is not None else {}
+                attrs["dead_reason"] = reason
+                self._set_health(worker_id, WORKER_DEAD, attrs)
+
+    def _set_health(self, worker_id: int, status: str, attrs: dict) -> None:
+        self._sm.set(f"worker.{worker_id}", status, attrs)
+
+
+def _worker_main(worker_id: int, accounts: list, config: dict,
+                 out: multiprocessing.Queue, stop, scanner_class=None) -> None:
+    """
+    Entry point of a worker process. Runs a scanner for every account in the
+    shard and forwards device state changes to the parent.
+    """
+    from libtracker.state import StateMachine
+    from libtracker.zone import setup_zones
+    from libtracker.scanner import ICloudDeviceScanner, DEFAULT_SCAN_INTERVAL
+    from libtracker.trips import TripTracker, SEGMENT_DOMAIN
+
+    scanner_class = scanner_class or ICloudDeviceScanner
+    sm = StateMachine()
+    zones = setup_zones(sm, config)
+    trips = TripTracker.from_config(sm, config)
+
+    changes = []
+    segments = []
+
+    def forward(entity_id: str, old_state, new_state) -> None:
+        if entity_id.startswith(("device.", SEGMENT_DOMAIN + ".")):
+            changes.append((entity_id, new_state.state, new_state.attrs))
+
+    sm.subscribe(forward)
+    if trips is not None:
+        trips.subscribe(segments.append)
+
+    health = {"pid": os.getpid(), "accounts": len(accounts), "devices": 0,
+              "cycles": 0, "cycle_time": None, "errors": 0,
+              "last_error": None}
+
+    def report(status: str) -> None:
+        if changes:
+            out.put((MSG_STATE, worker_id, list(changes)))
+            changes.clear()
+        if segments:
+            out.put((MSG_SEGMENTS, worker_id, list(segments)))
+            segments.clear()
+        out.put((MSG_HEALTH, worker_id, dict(health, status=status)))
+
+    scanners = []
+    for account in accounts:
+        account_config = dict(config)
+        account_config.pop(CONFIG_APPLE_ACCOUNTS, None)
+        account_config[CONFIG_APPLE_ID_USERNAME] = \
+            account[CONFIG_APPLE_ID_USERNAME]
+        account_config[CONFIG_APPLE_ID_PASSWORD] = \
+            account[CONFIG_APPLE_ID_PASSWORD]
+        try:
+            scanner = scanner_class(sm, account_config, zones)
+            scanner.trips = trips
+            scanner.device_prefix = account_name(account) + "_"
+            if scanner.api.requires_2fa:
+                # Workers have no terminal to prompt on.
+                raise RuntimeError("Account requires 2FA. Sign in with the "
+                                   "icloud scanner first.")
+            scanner.add_devices()
+            scanners.append(scanner)
+        except Exception as e:
+            health["errors"] += 1
+            health["last_error"] = \
+                f"{account[CONFIG_APPLE_ID_USERNAME]}: {e!r}"
+
+    health["devices"] = sum(len(scanner.devices) for scanner in scanners)
+    report(WORKER_OK if scanners else WORKER_ERROR)
+
+    while scanners and not stop.is_set():
+        start = time.monotonic()
+        status = WORKER_OK
+        wait = DEFAULT_SCAN_INTERVAL
+        for scanner in scanners:
+            try:
+                if scanner.scheduler is None:
+                    scanner.update_all()
+                else:
+                    scanner.update_due()
+                    wait = min(wait, scanner.scheduler.wait_time())
+            except Exception as e:
+                status = WORKER_ERROR
+                health["errors"] += 1
+                health["last_error"] = repr(e)
+
+        health["cycles"] += 1
+        health["cycle_time"] = time.monotonic() - start
+        report(status)
+        stop.wait(wait)
@@ -0,0 +1,213 @@
+import atexit
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from typing import NamedTuple, Optional, Callable
+
+from libtracker.constants import CONFIG_SNAPSHOT_PATH, CONFIG_SNAPSHOT_INTERVAL
+from libtracker.state import StateMachine
+
+SNAPSHOT_MAGIC = b"LTSNAP01"
+# magic, CRC32 of the payload, payload length
+SNAPSHOT_HEADER = struct.Struct("<8sIQ")
+
+DEFAULT_SNAPSHOT_INTERVAL = 30  # s
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Snapshot(NamedTuple):
+    saved_at: float
+    # State dictionaries as returned by StateMachine.all()
+    states: list
+    # Device name -> tracking data saved by the scanner that owns it
+    devices: dict
+
+
+def save_snapshot(path: str, states: list, devices: dict = None) -> None:
+    """
+    Atomically write a snapshot. The snapshot is written to a temporary file
+    in the same directory which then replaces path, so a crash mid-write
+    leaves the previous snapshot intact.
+    :param path: Path of the snapshot file
+    :param states: State dictionaries as returned by StateMachine.all()
+    :param devices: Device name -> tracking data
+    :return: None
+    """
+    payload = zlib.compress(json.dumps({
+        "saved_at": time.time(),
+        "states": [[s["entity_id"], s["state"], s["attrs"]] for s in states],
+        "devices": devices or {},
+    }, separators=(",", ":"), default=str).encode())
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, zlib.crc32(payload),
+                                  len(payload))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp",
+                                    prefix=os.path.basename(path) + ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    if os.name != "nt":
+        # Make the rename itself durable.
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def load_snapshot(path: str) -> Optional[Snapshot]:
+    """
+    Read a snapshot written by save_snapshot.
+    :param path: Path of the snapshot file
+    :return: The snapshot, or None if there is no usable snapshot at path.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+
+    try:
+        magic, crc, length = SNAPSHOT_HEADER.unpack_from(data)
+        payload = data[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + length]
+        if magic != SNAPSHOT_MAGIC or len(payload) != length \
+                or zlib.crc32(payload) != crc:
+            raise ValueError("bad header or checksum")
+        snapshot = json.loads(zlib.decompress(payload))
+    except (struct.error, ValueError, zlib.error) as e:
+        _LOGGER.warning("Ignoring unreadable snapshot %s: %s", path, e)
+        return None
+
+    return Snapshot(
+        snapshot["saved_at"],
+        [{"entity_id": entity_id, "state": state, "attrs": attrs}
+         for entity_id, state, attrs in snapshot["states"]],
+        snapshot["devices"]
+    )
+
+
+def restore_states(sm: StateMachine, snapshot: Snapshot) -> int:
+    """
+    Load the states from a snapshot into a state machine.
+    :param sm: State machine instance
+    :param snapshot: Snapshot to restore
+    :return: Number of states restored
+    """
+    for state in snapshot.states:
+        sm.set(state["entity_id"], state["state"], state["attrs"])
+
+    return len(snapshot.states)
+
+
+def snapshot_path(config: dict) -> Optional[str]:
+    """ Get the configured snapshot path, or None if snapshots are off. """
+    if path := config.get(CONFIG_SNAPSHOT_PATH):
+        return os.path.expanduser(path)
+    return None
+
+
+class SnapshotWriter:
+    """
+    Write-behind snapshots of a state machine and device registry.
+
+    A background thread saves a snapshot every interval seconds, but only if
+    the state machine has changed since the last one, so writes never happen
+    on the scan path and bursts of changes cost a single write. The last
+    changes are saved when the writer is stopped or the interpreter exits.
+    """
+    def __init__(self, sm: StateMachine, path: str,
+                 interval: float = DEFAULT_SNAPSHOT_INTERVAL,
+                 devices: Callable[[], dict] = None) -> None:
+        self.sm = sm
+        self.path = path
+        self.interval = interval
+        # Called to get the device registry to save.
+        self.devices = devices
+        self.saves = 0
+
+        self._saved_version = None
+        self._save_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_config(cls, sm: StateMachine, config: dict,
+                    devices: Callable[[], dict] = None) \
+            -> Optional["SnapshotWriter"]:
+        """
+        Create a writer using the configured path and interval.
+        :param sm: State machine to snapshot
+        :param config: Libtracker configuration object
+        :param devices: Callable returning the device registry to save
+        :return: The writer, or None if snapshots are not enabled.
+        """
+        if (path := snapshot_path(config)) is None:
+            return None
+
+        return cls(sm, path, float(config.get(CONFIG_SNAPSHOT_INTERVAL,
+                                              DEFAULT_SNAPSHOT_INTERVAL)),
+                   devices)
+
+    def save(self) -> bool:
+        """
+        Save a snapshot now if anything has changed since the last one.
+        :return: True if a snapshot was written.
+        """
+        with self._save_lock:
+            if self.sm.version == self._saved_version:
+                return False
+            # Every state, read together with its version.
+            version, states = self.sm.changes_since(0)
+
+            devices = self.devices() if self.devices is not None else None
+            save_snapshot(self.path, states, devices)
+            self._saved_version = version
+            self.saves += 1
+            return True
+
+    def start(self) -> None:
+        """ Start saving in the background. """
+        if self._thread is not None:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="libtracker-snapshot",
+                                        daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """ Stop the background thread and save any unsaved changes. """
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        atexit.unregister(self.stop)
+        self.save()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.save()
+            except OSError as e:
+                _LOGGER.error("Could not save snapshot to %s: %s",
+                              self.path, e)
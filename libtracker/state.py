@@ -1,4 +1,21 @@
-from typing import Collection, Any, List
+import math
+import queue
+import threading
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Collection, Any, List, Callable, Iterator, Optional, Tuple
+
+from libtracker import metrics
+from libtracker.constants import ATTR_LATITUDE, ATTR_LONGITUDE, ATTR_TIMESTAMP
+
+STATE_WRITES = metrics.counter(
+    "libtracker_state_writes_total",
+    "Calls to StateMachine.set, by whether the state changed.",
+    ("result",)
+)
+_WRITES_CHANGED = STATE_WRITES.labels("changed")
+_WRITES_UNCHANGED = STATE_WRITES.labels("unchanged")
 
 
 class State:
@@ -14,6 +31,8 @@ class State:
     and object_id represents the name of an object being represented by a
     state.
     """
+    __slots__ = ("entity_id", "state", "attrs")
+
     def __init__(self, entity_id: str, state: str, attrs: dict) -> None:
         self.entity_id = entity_id.lower()
         self.state = state
@@ -27,12 +46,33 @@ class State:
         }
 
 
+# Called with (entity_id, old_state, new_state). old_state is None the first
+# time an entity is set.
+StateListener = Callable[[str, Optional[State], State], None]
+
+
 class StateMachine:
     """
     Class to hold states to track the state of different entities.
+
+    The state machine is safe to use from several threads. Every write that
+    actually changes an entity's state or attributes bumps a version number so
+    consumers can read only what has changed since they last looked, or
+    subscribe to be told about changes as they happen.
+
+    Writes made inside a batch() are committed together when it exits, as a
+    single version.
     """
     def __init__(self) -> None:
         self._states: dict = {}
+        self._lock = threading.RLock()
+        self.version = 0
+        # entity_id -> version of its last change, oldest change first.
+        self._changed: OrderedDict = OrderedDict()
+        self._listeners: list = []
+        self._all_cache: Optional[list] = None
+        # Writes staged by the batch open on each thread.
+        self._local = threading.local()
 
     def get(self, entity_id: str) -> State:
         """
@@ -42,30 +82,347 @@ class StateMachine:
         """
         return self._states.get(entity_id)
 
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def _entity_ids(self):
+        """ Iterate over the IDs of every stored entity. """
+        return iter(self._states)
+
+    def _unchanged(self, entity_id: str, new_state: str, attrs: dict) -> bool:
+        """ Whether setting a state would leave the stored state as it is. """
+        old_state = self._states.get(entity_id)
+        return old_state is not None and old_state.state == new_state \
+            and old_state.attrs == attrs
+
+    def _store(self, entity_id: str, new_state: str, attrs: dict) -> None:
+        """ Store a state. """
+        state = State(
+            entity_id,
+            new_state,
+            attrs
+        )
+
+        self._states[entity_id] = state
+
     def all(self) -> List[dict[str, Collection[Any]]]:
         """
         Get a list of dictionary representations of all states.
         :return: A list of all state dictionary representations.
         """
-        return [
-            self._states[state].to_dict() for state in self._states
-        ]
+        with self._lock:
+            if self._all_cache is None:
+                self._all_cache = [
+                    self.get(entity_id).to_dict()
+                    for entity_id in self._entity_ids()
+                ]
+            return list(self._all_cache)
+
+    def changes_since(self, version: int) \
+            -> Tuple[int, List[dict[str, Collection[Any]]]]:
+        """
+        Get every state that has changed after a given version.
+        :param version: A version previously read from the state machine, or
+            0 for everything.
+        :return: The current version and a list of dictionary representations
+            of the states changed since version.
+        """
+        with self._lock:
+            changed = []
+            for entity_id in reversed(self._changed):
+                if self._changed[entity_id] <= version:
+                    break
+                changed.append(self.get(entity_id).to_dict())
+            changed.reverse()
+            return self.version, changed
 
-    def set(self, entity_id: str, new_state: str, attrs: dict) -> None:
+    def set(self, entity_id: str, new_state: str, attrs: dict) -> bool:
         """
-        Set a new state inside the state machine.
+        Set a new state inside the state machine. Inside a batch the write is
+        only staged until the batch is committed.
         :param entity_id: The unique ID of the state.
         :param new_state: The new state to set the entity to.
         :param attrs: Any additional attributes to be stored within the state.
-        :return: None
+        :return: True if the state or its attributes changed.
         """
         entity_id = entity_id.lower()
         attrs = attrs or {}
 
-        state = State(
-            entity_id,
-            new_state,
-            attrs
+        if (pending := getattr(self._local, "pending", None)) is not None:
+            pending[entity_id] = (new_state, attrs)
+            return not self._unchanged(entity_id, new_state, attrs)
+
+        with self._lock:
+            listeners = list(self._listeners)
+            if (old_state := self._apply(entity_id, new_state, attrs,
+                                         listeners)) is False:
+                return False
+
+            self.version += 1
+            self._changed[entity_id] = self.version
+            self._changed.move_to_end(entity_id)
+            self._all_cache = None
+
+        if listeners:
+            state = self.get(entity_id)
+            for listener in listeners:
+                listener(entity_id, old_state, state)
+
+        return True
+
+    def _apply(self, entity_id: str, new_state: str, attrs: dict,
+               listeners: list):
+        """
+        Store a state unless it is unchanged. Must hold the lock.
+        :return: False if unchanged, otherwise the old state if there are
+            listeners to pass it to.
+        """
+        if self._unchanged(entity_id, new_state, attrs):
+            if metrics.enabled:
+                _WRITES_UNCHANGED.inc()
+            return False
+
+        old_state = self.get(entity_id) if listeners else None
+        self._store(entity_id, new_state, attrs)
+        if metrics.enabled:
+            _WRITES_CHANGED.inc()
+        return old_state
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """
+        Group writes into one transaction. Writes made on this thread inside
+        the with block are not visible to readers until the block exits, when
+        every entity that actually changed is committed under one new version
+        and listeners are called. If the block raises, the writes are
+        discarded and the callbacks given to on_rollback are called. Nested
+        batches join the outermost one.
+        """
+        if getattr(self._local, "pending", None) is not None:
+            yield
+            return
+
+        pending = self._local.pending = {}
+        rollbacks = self._local.rollbacks = []
+        try:
+            yield
+        except BaseException:
+            self._local.pending = self._local.rollbacks = None
+            for callback in rollbacks:
+                callback()
+            raise
+        finally:
+            self._local.pending = self._local.rollbacks = None
+
+        self._commit(pending)
+
+    def on_rollback(self, callback: Callable[[], None]) -> None:
+        """
+        Call callback if the batch open on this thread is discarded, e.g. so
+        a writer can tell that what it wrote was never stored. Does nothing
+        outside a batch.
+        :param callback: Callable taking no arguments
+        :return: None
+        """
+        if (rollbacks := getattr(self._local, "rollbacks", None)) is not None:
+            rollbacks.append(callback)
+
+    def _commit(self, pending: dict) -> int:
+        """
+        Apply the writes staged by a batch.
+        :param pending: entity_id -> (state, attrs)
+        :return: Number of entities changed
+        """
+        changed = []
+        with self._lock:
+            listeners = list(self._listeners)
+            for entity_id, (new_state, attrs) in pending.items():
+                if (old_state := self._apply(entity_id, new_state, attrs,
+                                             listeners)) is not False:
+                    changed.append((entity_id, old_state))
+
+            if changed:
+                self.version += 1
+                for entity_id, _ in changed:
+                    self._changed[entity_id] = self.version
+                    self._changed.move_to_end(entity_id)
+                self._all_cache = None
+
+        for entity_id, old_state in changed if listeners else ():
+            state = self.get(entity_id)
+            for listener in listeners:
+                listener(entity_id, old_state, state)
+
+        return len(changed)
+
+    def subscribe(self, listener: StateListener) -> Callable[[], None]:
+        """
+        Call listener whenever an entity's state or attributes change.
+        Listeners are called on the thread that made the change.
+        :param listener: Callable taking (entity_id, old_state, new_state).
+        :return: A callable which removes the subscription.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+        def unsubscribe() -> None:
+            with self._lock:
+                if listener in self._listeners:
+                    self._listeners.remove(listener)
+
+        return unsubscribe
+
+    def iter_changes(self, timeout: float = None) -> Iterator[State]:
+        """
+        Iterate over states as they change, blocking until the next change.
+        :param timeout: Stop iterating after this many seconds without a
+            change. Wait forever if None.
+        :return: Iterator of changed states.
+        """
+        changes: queue.Queue = queue.Queue()
+        unsubscribe = self.subscribe(
+            lambda entity_id, old_state, new_state: changes.put(new_state)
         )
+        try:
+            while True:
+                try:
+                    yield changes.get(timeout=timeout)
+                except queue.Empty:
+                    return
+        finally:
+            unsubscribe()
 
-        self._states[entity_id] = state
+
+class CompactStateMachine(StateMachine):
+    """
+    State machine for very large fleets which stores states in columns
+    instead of one State object per entity.
+
+    Each entity is a row. State strings are interned into a table and stored
+    as integer codes, float latitude/longitude attributes and the float
+    timestamp of a position are stored in float64 arrays and any remaining
+    attributes are kept in a dictionary only for the rows that have them.
+    get() and all() build State objects on demand so the public API is the
+    same as StateMachine.
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self._index: dict[str, int] = {}
+        self._ids: list[str] = []
+        self._codes = array("I")
+        self._state_names: list = []
+        self._state_codes: dict = {}
+        self._latitude = array("d")
+        self._longitude = array("d")
+        self._timestamp = array("d")
+        self._extra: dict[int, dict] = {}
+
+    def get(self, entity_id: str) -> Optional[State]:
+        """
+        Look up a specific state by entity id.
+        :param entity_id: The unique ID of the state.
+        :return: A state object built from the stored row.
+        """
+        # A row is spread over several columns, so read it under the lock
+        # or a concurrent write could be seen half done.
+        with self._lock:
+            if (row := self._index.get(entity_id)) is None:
+                return None
+
+            latitude = self._latitude[row]
+            if math.isnan(latitude):
+                attrs = {}
+            else:
+                attrs = {
+                    ATTR_LATITUDE: latitude,
+                    ATTR_LONGITUDE: self._longitude[row]
+                }
+                if not math.isnan(timestamp := self._timestamp[row]):
+                    attrs[ATTR_TIMESTAMP] = timestamp
+            if (extra := self._extra.get(row)) is not None:
+                attrs.update(extra)
+
+            return State(entity_id, self._state_names[self._codes[row]],
+                         attrs)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def _entity_ids(self):
+        return iter(self._ids)
+
+    @staticmethod
+    def _split(attrs: dict) -> Tuple[float, float, float, Optional[dict]]:
+        """
+        Split attributes into the values stored in the latitude, longitude
+        and timestamp columns and everything else. Only floats are moved into
+        the columns so other types are returned unchanged by get(). A
+        timestamp is only moved along with a position.
+        """
+        latitude = attrs.get(ATTR_LATITUDE)
+        longitude = attrs.get(ATTR_LONGITUDE)
+        if type(latitude) is not float or type(longitude) is not float \
+                or math.isnan(latitude):
+            return math.nan, math.nan, math.nan, attrs or None
+
+        timestamp = attrs.get(ATTR_TIMESTAMP)
+        if type(timestamp) is not float or math.isnan(timestamp):
+            timestamp = math.nan
+            columns = 2
+        else:
+            columns = 3
+        if len(attrs) == columns:
+            return latitude, longitude, timestamp, None
+        extra = {k: v for k, v in attrs.items()
+                 if k != ATTR_LATITUDE and k != ATTR_LONGITUDE
+                 and (columns == 2 or k != ATTR_TIMESTAMP)}
+        return latitude, longitude, timestamp, extra
+
+    def _unchanged(self, entity_id: str, new_state: str, attrs: dict) -> bool:
+        if (row := self._index.get(entity_id)) is None:
+            return False
+        if self._state_codes.get(new_state) != self._codes[row]:
+            return False
+
+        latitude, longitude, timestamp, extra = self._split(attrs)
+        old_latitude = self._latitude[row]
+        if math.isnan(latitude):
+            if not math.isnan(old_latitude):
+                return False
+        elif latitude != old_latitude or longitude != self._longitude[row]:
+            return False
+        old_timestamp = self._timestamp[row]
+        if math.isnan(timestamp):
+            if not math.isnan(old_timestamp):
+                return False
+        elif timestamp != old_timestamp:
+            return False
+
+        return extra == self._extra.get(row)
+
+    def _store(self, entity_id: str, new_state: str, attrs: dict) -> None:
+        if (code := self._state_codes.get(new_state)) is None:
+            code = len(self._state_names)
+            self._state_names.append(new_state)
+            self._state_codes[new_state] = code
+
+        latitude, longitude, timestamp, extra = self._split(attrs)
+
+        if (row := self._index.get(entity_id)) is None:
+            row = len(self._ids)
+            self._index[entity_id] = row
+            self._ids.append(entity_id)
+            self._codes.append(code)
+            self._latitude.append(latitude)
+            self._longitude.append(longitude)
+            self._timestamp.append(timestamp)
+        else:
+            self._codes[row] = code
+            self._latitude[row] = latitude
+            self._longitude[row] = longitude
+            self._timestamp[row] = timestamp
+
+        if extra is not None:
+            self._extra[row] = extra
+        else:
+            self._extra.pop(row, None)
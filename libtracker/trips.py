@@ -0,0 +1,372 @@
+import threading
+from typing import NamedTuple, Optional
+
+from libtracker.constants import (
+    ATTR_LATITUDE,
+    ATTR_LONGITUDE,
+    CONFIG_TRIPS,
+    CONFIG_TRIP_STOP_RADIUS,
+    CONFIG_TRIP_STOP_DURATION,
+)
+from libtracker.distance import haversine
+from libtracker.events import EventStream
+from libtracker.state import StateMachine
+
+SEGMENT_DOMAIN = "segment"
+SEGMENT_TRIP = "trip"
+SEGMENT_STOP = "stop"
+# State of a device's segment entity until its first trip or stop is known.
+STATE_UNKNOWN = "unknown"
+
+ATTR_SINCE = "since"
+ATTR_TRIPS = "trips"
+ATTR_STOPS = "stops"
+ATTR_DISTANCE = "distance"
+ATTR_MOVING = "moving"
+ATTR_STOPPED = "stopped"
+ATTR_LAST_TRIP = "last_trip"
+ATTR_LAST_STOP = "last_stop"
+
+# A device which stays within this distance of where it stopped...
+DEFAULT_STOP_RADIUS = 100  # m
+# ...for at least this long has stopped.
+DEFAULT_STOP_DURATION = 300  # s
+
+
+class Segment(NamedTuple):
+    """ A trip or a stop of a device. """
+    type: str
+    # Entity ID of the device
+    device: str
+    # Unix times the segment started and ended, or was last extended.
+    start: float
+    end: float
+    # Centroid of the locations in the segment.
+    latitude: float
+    longitude: float
+    # Distance travelled in metres. For a stop, this is GPS jitter.
+    distance: float
+    # False when the segment has just been detected, True once it is over.
+    ended: bool
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    @property
+    def device_name(self) -> str:
+        """ The object ID of the device, e.g. phone for device.phone """
+        return self.device.split('.', 1)[1]
+
+    def summary(self) -> dict:
+        """ The segment as published in segment entity attributes. """
+        return {"start": self.start, "end": self.end,
+                ATTR_LATITUDE: self.latitude, ATTR_LONGITUDE: self.longitude,
+                ATTR_DISTANCE: self.distance}
+
+
+class _Span:
+    """
+    Running totals of consecutive locations: constant size however many
+    locations are added. Longitudes are summed as offsets from the first
+    location, so a span across the antimeridian has the right centroid.
+    """
+    __slots__ = ("start", "end", "latitude", "longitude", "count", "sum_lat",
+                 "sum_lon", "distance")
+
+    def __init__(self, timestamp: float, latitude: float,
+                 longitude: float) -> None:
+        self.start = self.end = timestamp
+        # First location
+        self.latitude = latitude
+        self.longitude = longitude
+        self.count = 1
+        self.sum_lat = latitude
+        self.sum_lon = 0.0
+        self.distance = 0.0
+
+    def add(self, timestamp: float, latitude: float, longitude: float,
+            hop: float) -> None:
+        self.end = timestamp
+        self.count += 1
+        self.sum_lat += latitude
+        self.sum_lon += _wrap(longitude - self.longitude)
+        self.distance += hop
+
+    def merge(self, other: "_Span") -> None:
+        """ Append the locations of a later span. """
+        self.end = other.end
+        self.count += other.count
+        self.sum_lat += other.sum_lat
+        self.sum_lon += other.sum_lon + \
+            other.count * _wrap(other.longitude - self.longitude)
+        self.distance += other.distance
+
+    def centroid(self) -> tuple:
+        return (self.sum_lat / self.count,
+                _wrap(self.longitude + self.sum_lon / self.count))
+
+    def distance_to(self, latitude: float, longitude: float) -> float:
+        """ Distance from the centroid to a location in metres. """
+        return haversine(self.centroid(), (latitude, longitude)) * 1000
+
+    def segment(self, kind: str, device: str, ended: bool) -> Segment:
+        return Segment(kind, device, self.start, self.end, *self.centroid(),
+                       self.distance, ended)
+
+
+class _Track:
+    """
+    Segmentation state and totals of one device.
+
+    While a device is on a trip, its recent locations within stop_radius of
+    their centroid are held as a candidate stop. The candidate becomes a stop
+    once it lasts stop_duration, ending the trip when the device arrived.
+    The first location outside it ends the candidate, which was just a slow
+    part of the trip, and starts a new one. A stop ends at the first location
+    outside stop_radius of its centroid.
+    """
+    __slots__ = ("kind", "segment", "candidate", "last", "trips", "stops",
+                 "travelled", "moving", "stopped", "last_trip", "last_stop")
+
+    def __init__(self) -> None:
+        # SEGMENT_TRIP, SEGMENT_STOP or None before the first is known.
+        self.kind: Optional[str] = None
+        self.segment: Optional[_Span] = None
+        self.candidate: Optional[_Span] = None
+        # (timestamp, latitude, longitude) of the last location
+        self.last: Optional[tuple] = None
+        self.trips = 0
+        self.stops = 0
+        self.travelled = 0.0
+        self.moving = 0.0
+        self.stopped = 0.0
+        self.last_trip: Optional[dict] = None
+        self.last_stop: Optional[dict] = None
+
+    def restore(self, attrs: dict) -> None:
+        """ Carry on the totals of a published segment entity. """
+        self.trips = int(attrs.get(ATTR_TRIPS) or 0)
+        self.stops = int(attrs.get(ATTR_STOPS) or 0)
+        self.travelled = float(attrs.get(ATTR_DISTANCE) or 0)
+        self.moving = float(attrs.get(ATTR_MOVING) or 0)
+        self.stopped = float(attrs.get(ATTR_STOPPED) or 0)
+        self.last_trip = attrs.get(ATTR_LAST_TRIP)
+        self.last_stop = attrs.get(ATTR_LAST_STOP)
+
+    def add(self, device: str, timestamp: float, latitude: float,
+            longitude: float, stop_radius: float,
+            stop_duration: float) -> list:
+        """
+        Add a location.
+        :return: List of the segments started or ended by it.
+        """
+        if self.last is None:
+            self.last = (timestamp, latitude, longitude)
+            self.candidate = _Span(timestamp, latitude, longitude)
+            return []
+        if timestamp < self.last[0]:
+            # Out of order.
+            return []
+
+        previous = self.last
+        self.last = (timestamp, latitude, longitude)
+        hop = haversine(previous[1:], (latitude, longitude)) * 1000
+        events = []
+
+        if self.kind == SEGMENT_STOP:
+            stop = self.segment
+            if stop.distance_to(latitude, longitude) <= stop_radius:
+                stop.add(timestamp, latitude, longitude, hop)
+                return []
+            # Left. The trip starts from the last location in the stop.
+            events.append(self._end(device))
+            self.kind = SEGMENT_TRIP
+            self.segment = _Span(*previous)
+            self.segment.distance = hop
+            self.candidate = _Span(timestamp, latitude, longitude)
+            events.append(self.segment.segment(SEGMENT_TRIP, device, False))
+            return events
+
+        candidate = self.candidate
+        if candidate.distance_to(latitude, longitude) <= stop_radius:
+            candidate.add(timestamp, latitude, longitude, hop)
+            if candidate.end - candidate.start < stop_duration:
+                return []
+            if self.kind == SEGMENT_TRIP:
+                # The trip ends on arrival.
+                self.segment.add(candidate.start, candidate.latitude,
+                                 candidate.longitude, 0)
+                events.append(self._end(device))
+            self.kind = SEGMENT_STOP
+            self.segment = candidate
+            self.candidate = None
+            events.append(candidate.segment(SEGMENT_STOP, device, False))
+            return events
+
+        if self.kind is None:
+            # Moving since the first location.
+            self.kind = SEGMENT_TRIP
+            self.segment = candidate
+            events.append(candidate.segment(SEGMENT_TRIP, device, False))
+        else:
+            self.segment.merge(candidate)
+        self.segment.distance += hop
+        self.candidate = _Span(timestamp, latitude, longitude)
+        return events
+
+    def _end(self, device: str) -> Segment:
+        """ End the current segment and add it to the totals. """
+        segment = self.segment.segment(self.kind, device, True)
+        if self.kind == SEGMENT_TRIP:
+            self.trips += 1
+            self.travelled += segment.distance
+            self.moving += segment.duration
+            self.last_trip = segment.summary()
+        else:
+            self.stops += 1
+            self.stopped += segment.duration
+            self.last_stop = segment.summary()
+        return segment
+
+    def attrs(self) -> dict:
+        """
+        Attributes of the device's segment entity. They only change when a
+        segment starts or ends, so a stationary device doesn't rewrite them.
+        """
+        return {
+            ATTR_SINCE: self.segment.start if self.segment else None,
+            ATTR_TRIPS: self.trips,
+            ATTR_STOPS: self.stops,
+            ATTR_DISTANCE: self.travelled,
+            ATTR_MOVING: self.moving,
+            ATTR_STOPPED: self.stopped,
+            ATTR_LAST_TRIP: self.last_trip,
+            ATTR_LAST_STOP: self.last_stop,
+        }
+
+
+class TripTracker(EventStream):
+    """
+    Splits the track of every device into trips and stops as it is seen.
+
+    update() is called by Device.mark_seen with every location, including
+    unchanged ones, and does a constant amount of work with a constant
+    amount of memory per device: running totals of the current segment and
+    of a candidate stop, never the locations themselves.
+
+    Each device has a segment.<name> entity whose state is trip or stop,
+    with the time it started under since, the number of trips and stops,
+    the distance travelled, the time spent moving and stopped and a summary
+    of the last trip and stop. As the scanners mark devices seen inside a
+    batch, these are committed with the location which changed them.
+
+    A Segment is published when a trip or stop is detected, with ended
+    False, and again when it is over. Receive them with subscribe(),
+    iter_events() or aiter_events(). Listeners are called while the scan
+    cycle is being processed, before it is committed.
+    """
+    def __init__(self, sm: StateMachine,
+                 stop_radius: float = DEFAULT_STOP_RADIUS,
+                 stop_duration: float = DEFAULT_STOP_DURATION) -> None:
+        super().__init__()
+        self.sm = sm
+        self.stop_radius = stop_radius
+        self.stop_duration = stop_duration
+        self._tracks: dict[str, _Track] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, sm: StateMachine,
+                    config: dict) -> Optional["TripTracker"]:
+        """
+        Create a tracker using the configured stop radius and duration.
+        :param sm: State machine to publish segment entities to
+        :param config: Libtracker configuration object
+        :return: The tracker, or None if trip segmentation is not enabled.
+        """
+        if not config.get(CONFIG_TRIPS):
+            return None
+        return cls(sm,
+                   float(config.get(CONFIG_TRIP_STOP_RADIUS,
+                                    DEFAULT_STOP_RADIUS)),
+                   float(config.get(CONFIG_TRIP_STOP_DURATION,
+                                    DEFAULT_STOP_DURATION)))
+
+    def update(self, device: str, timestamp: float, latitude: float,
+               longitude: float) -> list:
+        """
+        Add a location of a device.
+        :param device: Entity ID of the device
+        :param timestamp: Unix time the location was recorded
+        :param latitude: Latitude of device
+        :param longitude: Longitude of device
+        :return: List of the segments started or ended, which have also
+            been published.
+        """
+        # Entity IDs as the state machine stores them.
+        device = device.lower()
+        with self._lock:
+            if (track := self._tracks.get(device)) is None:
+                track = self._tracks[device] = self._new_track(device)
+                changed = True
+            else:
+                changed = False
+            events = track.add(device, timestamp, latitude, longitude,
+                               self.stop_radius, self.stop_duration)
+            if events or changed:
+                self.sm.set(_entity_id(device), track.kind or STATE_UNKNOWN,
+                            track.attrs())
+
+        self.publish(events)
+        return events
+
+    def _new_track(self, device: str) -> _Track:
+        """
+        Start tracking a device, carrying on the totals of its segment
+        entity, e.g. restored from a snapshot.
+        """
+        track = _Track()
+        if (state := self.sm.get(_entity_id(device))) is not None:
+            track.restore(state.attrs)
+        return track
+
+    def current(self, device: str) -> Optional[Segment]:
+        """
+        Get the trip or stop a device is on.
+        :param device: Entity ID of the device
+        :return: The segment so far, or None if it isn't known yet.
+        """
+        device = device.lower()
+        with self._lock:
+            if (track := self._tracks.get(device)) is None \
+                    or track.kind is None:
+                return None
+            return track.segment.segment(track.kind, device, False)
+
+    def report(self) -> dict:
+        """
+        Get the trip and stop totals of every device, from the segment
+        entities in the state machine.
+        :return: Dictionary of totals keyed by device entity ID, as in the
+            segment entity attributes along with the current segment.
+        """
+        report = {}
+        prefix = SEGMENT_DOMAIN + "."
+        for state in self.sm.all():
+            if not state["entity_id"].startswith(prefix):
+                continue
+            device = "device." + state["entity_id"][len(prefix):]
+            report[device] = dict(state["attrs"], segment=state["state"])
+        return report
+
+
+def _entity_id(device: str) -> str:
+    """ Entity ID of the segment entity of a device. """
+    return SEGMENT_DOMAIN + "." + device.split('.', 1)[1]
+
+
+def _wrap(longitude: float) -> float:
+    """ Wrap a longitude or longitude difference to [-180, 180). """
+    return (longitude + 180) % 360 - 180
+
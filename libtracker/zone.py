@@ -1,9 +1,17 @@
+import functools
 import math
-from typing import Union, Tuple, Optional
+from typing import Union, Tuple, Optional, Callable, Iterator
 
-from libtracker import StateMachine
+from libtracker import metrics
+from libtracker.state import State, StateMachine
 from libtracker.entity import Entity
-from libtracker.constants import ATTR_LATITUDE, ATTR_LONGITUDE, ATTR_RADIUS
+from libtracker.constants import (
+    ATTR_LATITUDE,
+    ATTR_LONGITUDE,
+    ATTR_RADIUS,
+    CONFIG_ZONES,
+    CONFIG_DISTANCE_ACCURACY,
+)
 
 ZONE_STATE = "zoning"
 
@@ -11,12 +19,33 @@ STATE_HOME = "home"
 STATE_AWAY = "away"
 
 DEFAULT_ZONE_RADIUS = 100  # m
+# Radius offset a device is given when deciding which zones it is in.
+ZONE_RADIUS_OFFSET = 7  # m
 
 VINCENTY_CONVERGENCE_THRESHOLD = 1e-12
 VINCENTY_MAX_ITERATIONS = 200
 
 EARTH_SEMI_MAJOR_AXIS = 6378137.0
 EARTH_SEMI_MINOR_AXIS = 6356752.314245
+FLATTENING = 1 / 298.257223563  # f = (a - b) / a
+
+ZONE_INDEX_CELL_SIZE = 0.01  # degrees, roughly 1.1km of latitude
+
+# Lower bound on the length of one degree of latitude and of one degree of
+# longitude at the equator on the WGS84 ellipsoid. Using the lower bound makes
+# the bounding boxes we derive from them slightly too large, never too small.
+METRES_PER_DEGREE_LAT = 110574.0
+METRES_PER_DEGREE_LON = 111319.0
+
+VINCENTY_ITERATIONS = metrics.histogram(
+    "libtracker_vincenty_iterations",
+    "Iterations taken by inverse Vincenty to converge.",
+    buckets=(1, 2, 3, 4, 5, 10, 20, 50, 100, VINCENTY_MAX_ITERATIONS)
+)
+VINCENTY_NON_CONVERGENCE = metrics.counter(
+    "libtracker_vincenty_non_convergence_total",
+    "Inverse Vincenty calls which did not converge."
+)
 
 
 class Zone(Entity):
@@ -51,18 +80,326 @@ class Zone(Entity):
         return attrs
 
 
-def setup_home_zone(sm: StateMachine, config: dict) -> None:
+class PreparedZone:
+    """
+    Geometry of a zone worked out once, so checking many points against the
+    zone only costs the terms which depend on the point.
+
+    Holds the zone's coordinates as floats, its radius in metres, the sine
+    and cosine of its reduced latitude used by inverse Vincenty, the cosine
+    of its latitude used by haversine and its bounding box. It has the
+    entity_id and attrs of the zone's state, so it can be passed anywhere a
+    zone state is expected.
+    """
+    __slots__ = ("entity_id", "attrs", "latitude", "longitude", "radius",
+                 "lat_rad", "cos_lat", "sin_u1", "cos_u1", "bbox")
+
+    def __init__(self, entity_id: str, attrs: dict) -> None:
+        self.entity_id = entity_id
+        self.attrs = attrs
+        self.latitude = float(attrs[ATTR_LATITUDE])
+        self.longitude = float(attrs[ATTR_LONGITUDE])
+        self.radius = float(attrs[ATTR_RADIUS])
+
+        self.lat_rad = math.radians(self.latitude)
+        self.cos_lat = math.cos(self.lat_rad)
+        u1 = math.atan((1 - FLATTENING) * math.tan(self.lat_rad))
+        self.sin_u1 = math.sin(u1)
+        self.cos_u1 = math.cos(u1)
+        # (min lat, min lon, max lat, max lon) in degrees, None if the zone
+        # reaches a pole.
+        self.bbox = bounding_box(self.latitude, self.longitude, self.radius)
+
+    def distance(self, latitude: float, longitude: float) -> Optional[float]:
+        """
+        Inverse Vincenty distance from the zone's centre to a point. Gives
+        the same result as inverse_vincenty.
+        :param latitude: Latitude of device
+        :param longitude: Longitude of device
+        :return: Distance in kilometers, or None if it did not converge.
+        """
+        if latitude == self.latitude and longitude == self.longitude:
+            return 0.00
+        return _vincenty(self.sin_u1, self.cos_u1, latitude,
+                         math.radians(longitude - self.longitude))
+
+
+def prepare_zone(zone) -> PreparedZone:
+    """
+    Get the prepared geometry of a zone.
+    :param zone: A zone state, Zone entity or PreparedZone
+    :return: The PreparedZone, which is zone itself if already prepared.
+    """
+    if isinstance(zone, PreparedZone):
+        return zone
+    if isinstance(zone, Zone):
+        return PreparedZone(zone.entity_id, zone.state_attrs)
+    return PreparedZone(zone.entity_id, zone.attrs)
+
+
+def bounding_box(latitude: float, longitude: float,
+                 radius: float) -> Optional[Tuple[float, float, float, float]]:
+    """
+    Get a latitude/longitude box containing every point within radius metres
+    of a point. The box may be slightly too large but is never too small.
+    :return: (min lat, min lon, max lat, max lon) in degrees, or None if the
+        circle reaches a pole. Longitudes are not wrapped to +/-180.
+    """
+    d_lat = radius / METRES_PER_DEGREE_LAT
+    max_lat = abs(latitude) + d_lat
+    if max_lat >= 90:
+        return None
+
+    d_lon = radius / (METRES_PER_DEGREE_LON * math.cos(math.radians(max_lat)))
+    if d_lon >= 180:
+        return None
+
+    return (latitude - d_lat, longitude - d_lon,
+            latitude + d_lat, longitude + d_lon)
+
+
+class ZoneIndex:
+    """
+    Spatial index over zone entities.
+
+    Every zone is stored in each cell of a fixed latitude/longitude grid that
+    its bounding box overlaps, so finding the zones a point may be inside is a
+    dictionary lookup rather than a pass over every zone. The exact Vincenty
+    check is then only run against those candidates.
+    """
+    def __init__(self, sm: StateMachine,
+                 cell_size: float = ZONE_INDEX_CELL_SIZE) -> None:
+        self.sm = sm
+        self.cell_size = cell_size
+        # Optional DistanceCache for distances which are only reported, such
+        # as how far a device is from home. Its keys are rounded, so it is
+        # never used to decide membership.
+        self.cache = None
+        # Called as (zone, latitude, longitude, radius) to decide whether a
+        # candidate zone contains a point.
+        self.membership = in_zone
+        self._lon_cells = int(round(360 / cell_size))
+        self._cells: dict[Tuple[int, int], set] = {}
+        self._zone_cells: dict[str, list] = {}
+        self._prepared: dict[str, PreparedZone] = {}
+        # Zones whose bounding box reaches a pole cover every longitude so
+        # are kept out of the grid and always treated as candidates.
+        self._polar: set = set()
+
+    def __len__(self) -> int:
+        return len(self._zone_cells) + len(self._polar)
+
+    def __contains__(self, entity_id: str) -> bool:
+        return entity_id in self._zone_cells or entity_id in self._polar
+
+    def __iter__(self) -> Iterator[PreparedZone]:
+        """ Iterate over the prepared geometry of every indexed zone. """
+        return iter(list(self._prepared.values()))
+
+    def _cell(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return (math.floor(latitude / self.cell_size),
+                math.floor(longitude / self.cell_size) % self._lon_cells)
+
+    def _bounding_cells(self, latitude: float, longitude: float,
+                        radius: float) -> Optional[list]:
+        """
+        Get every grid cell covered by a circle of radius metres. Returns None
+        if the circle reaches a pole.
+        """
+        return self._box_cells(bounding_box(latitude, longitude, radius))
+
+    def _box_cells(self, bbox: Optional[tuple]) -> Optional[list]:
+        """ Get every grid cell covered by a bounding box. """
+        if bbox is None:
+            return None
+
+        lat_lo = math.floor(bbox[0] / self.cell_size)
+        lon_lo = math.floor(bbox[1] / self.cell_size)
+        lat_hi = math.floor(bbox[2] / self.cell_size)
+        lon_hi = math.floor(bbox[3] / self.cell_size)
+
+        return [(i, j % self._lon_cells)
+                for i in range(lat_lo, lat_hi + 1)
+                for j in range(lon_lo, lon_hi + 1)]
+
+    def add(self, zone: Zone) -> None:
+        """
+        Add a zone to the index, replacing any previous entry for the same
+        entity. The zone's geometry is prepared here, so call add again or
+        use watch() if the zone changes.
+        :param zone: The zone entity, zone state or PreparedZone to index
+        :return: None
+        """
+        prepared = prepare_zone(zone)
+        self.remove(prepared.entity_id)
+        self._prepared[prepared.entity_id] = prepared
+
+        if (cells := self._box_cells(prepared.bbox)) is None:
+            self._polar.add(prepared.entity_id)
+            return
+
+        for cell in cells:
+            self._cells.setdefault(cell, set()).add(prepared.entity_id)
+        self._zone_cells[prepared.entity_id] = cells
+
+    def remove(self, entity_id: str) -> None:
+        """
+        Remove a zone from the index if it is present.
+        :param entity_id: The entity ID of the zone
+        :return: None
+        """
+        self._polar.discard(entity_id)
+        self._prepared.pop(entity_id, None)
+        for cell in self._zone_cells.pop(entity_id, ()):
+            bucket = self._cells[cell]
+            bucket.discard(entity_id)
+            if not bucket:
+                del self._cells[cell]
+
+    def prepared(self, entity_id: str) -> Optional[PreparedZone]:
+        """
+        Get the prepared geometry of an indexed zone.
+        :param entity_id: The entity ID of the zone
+        :return: The PreparedZone, or None if the zone is not indexed.
+        """
+        return self._prepared.get(entity_id)
+
+    def watch(self) -> Callable[[], None]:
+        """
+        Re-index a zone whenever its position or radius changes in the state
+        machine.
+        :return: A callable which stops watching.
+        """
+        def on_change(entity_id: str, old_state: Optional[State],
+                      new_state: State) -> None:
+            if (prepared := self._prepared.get(entity_id)) is None:
+                return
+            attrs = new_state.attrs
+            if attrs.get(ATTR_LATITUDE) != prepared.attrs.get(ATTR_LATITUDE) \
+                    or attrs.get(ATTR_LONGITUDE) != \
+                    prepared.attrs.get(ATTR_LONGITUDE) \
+                    or attrs.get(ATTR_RADIUS) != prepared.attrs.get(ATTR_RADIUS):
+                self.add(PreparedZone(entity_id, attrs))
+
+        return self.sm.subscribe(on_change)
+
+    def candidates(self, latitude: float, longitude: float,
+                   radius: int = 0) -> set:
+        """
+        Get the entity IDs of all zones a point could be inside.
+        :param latitude: Latitude of device
+        :param longitude: Longitude of device
+        :param radius: Radius offset
+        :return: Set of zone entity IDs
+        """
+        if radius:
+            cells = self._bounding_cells(latitude, longitude, radius)
+        else:
+            cells = [self._cell(latitude, longitude)]
+        if cells is None:
+            return set(self._zone_cells) | self._polar
+
+        found = set(self._polar)
+        for cell in cells:
+            found.update(self._cells.get(cell, ()))
+
+        return found
+
+    def zones_containing(self, latitude: float, longitude: float,
+                         radius: int = 0) -> list:
+        """
+        Find every zone a point is inside.
+
+        Zones are ordered smallest radius first, then by the distance from
+        their centre to the point, then by entity ID, so where zones overlap
+        the first is the most specific and is the same on every call.
+        :param latitude: Latitude of device
+        :param longitude: Longitude of device
+        :param radius: Radius offset
+        :return: List of zone states the point is inside.
+        """
+        found = []
+        for entity_id in self.candidates(latitude, longitude, radius):
+            prepared = self._prepared[entity_id]
+            if self.membership(prepared, latitude, longitude, radius) and \
+                    (zone := self.sm.get(entity_id)) is not None:
+                found.append((prepared, zone))
+
+        if len(found) > 1:
+            found.sort(key=lambda item: _zone_order(item[0], latitude,
+                                                    longitude))
+        return [zone for _, zone in found]
+
+
+def _zone_order(zone: PreparedZone, latitude: float,
+                longitude: float) -> tuple:
+    """ Sort key of a zone containing a point, see zones_containing. """
+    distance = zone.distance(latitude, longitude)
+    return (zone.radius, math.inf if distance is None else distance,
+            zone.entity_id)
+
+
+def setup_home_zone(sm: StateMachine, config: dict) -> Zone:
     """
     Create a new home zone entity and push it onto the state machine.
     :param sm: State machine instance
     :param config: Libtracker configuration object
-    :return: None
+    :return: The home zone entity
     """
     h_zone = Zone(sm, config["home_name"], config[ATTR_LATITUDE],
                   config[ATTR_LONGITUDE], DEFAULT_ZONE_RADIUS)
     h_zone.entity_id = "zone.home"
     h_zone.push_state()
 
+    return h_zone
+
+
+def setup_zones(sm: StateMachine, config: dict) -> ZoneIndex:
+    """
+    Create the home zone and every zone listed in the configuration, push
+    them onto the state machine and build a spatial index over them.
+    :param sm: State machine instance
+    :param config: Libtracker configuration object
+    :return: Index of all configured zones
+    """
+    from libtracker.cache import DistanceCache
+    from libtracker.distance import (
+        zone_membership,
+        ACCURACY_MODES,
+        ACCURACY_TIERED,
+    )
+
+    index = ZoneIndex(sm)
+    index.watch()
+    if (cache := DistanceCache.from_config(config)) is not None:
+        cache.watch(sm)
+        index.cache = cache
+
+    accuracy = config.get(CONFIG_DISTANCE_ACCURACY) or ACCURACY_TIERED
+    if accuracy not in ACCURACY_MODES:
+        raise ValueError(f"{CONFIG_DISTANCE_ACCURACY} must be one of "
+                         f"{', '.join(ACCURACY_MODES)}, not {accuracy!r}.")
+    index.membership = functools.partial(zone_membership, accuracy=accuracy)
+
+    index.add(setup_home_zone(sm, config))
+
+    for zone_config in config.get(CONFIG_ZONES) or []:
+        name = zone_config["name"]
+        zone = Zone(sm, name, zone_config[ATTR_LATITUDE],
+                    zone_config[ATTR_LONGITUDE],
+                    zone_config.get(ATTR_RADIUS, DEFAULT_ZONE_RADIUS))
+        zone.entity_id = "zone." + name.replace(' ', '', 99).lower()
+        if zone.entity_id in index:
+            # Would silently replace the home zone or an earlier zone.
+            raise ValueError(f"Zone {name!r} has the same entity ID, "
+                             f"{zone.entity_id}, as another zone. Zones "
+                             f"can't be named after the home zone or each "
+                             f"other.")
+        zone.push_state()
+        index.add(zone)
+
+    return index
+
 
 def in_zone(zone: Zone, latitude: float, longitude: float,
             radius: int = 0) -> bool:
@@ -70,15 +407,41 @@ def in_zone(zone: Zone, latitude: float, longitude: float,
     Determine if a device is inside a given zone. We do this by checking
     if the difference between the distance from the zone and the radius
     offset is less than the radius of the zone entity.
-    :param zone: The zone entity to check against
+    :param zone: The zone state or PreparedZone to check against
     :param latitude: Latitude of device
     :param longitude: Longitude of device
     :param radius: Radius offset
     :return: Boolean depending on if a device is inside a zone.
     """
-    zone_distance = inverse_vincenty(
+    if isinstance(zone, PreparedZone):
+        zone_distance = zone.distance(float(latitude), float(longitude))
+    else:
+        zone_distance = inverse_vincenty(
+            (float(zone.attrs[ATTR_LATITUDE]),
+             float(zone.attrs[ATTR_LONGITUDE])),
+            (float(latitude), float(longitude))
+        )
+
+    return zone_distance * 1000 - radius < zone.attrs[ATTR_RADIUS]
+
+
+def in_zone_batch(zone: Zone, latitudes, longitudes, radius: int = 0):
+    """
+    Vectorised form of in_zone for checking a whole fleet against one zone.
+    :param zone: The zone entity to check against
+    :param latitudes: Array of device latitudes
+    :param longitudes: Array of device longitudes
+    :param radius: Radius offset
+    :return: Boolean array, False where the distance did not converge.
+    """
+    import numpy as np
+    from libtracker.geodesic import inverse_vincenty_batch
+
+    points = np.stack([np.asarray(latitudes, dtype=np.float64),
+                       np.asarray(longitudes, dtype=np.float64)], axis=-1)
+    zone_distance = inverse_vincenty_batch(
         (float(zone.attrs[ATTR_LATITUDE]), float(zone.attrs[ATTR_LONGITUDE])),
-        (float(latitude), float(longitude))
+        points
     ) * 1000  # km -> m
 
     return zone_distance - radius < zone.attrs[ATTR_RADIUS]
@@ -101,15 +464,23 @@ def inverse_vincenty(theta_1: Tuple[float, float],
     if theta_1[0] == theta_2[0] and theta_1[1] == theta_2[1]:
         return 0.00
 
-    flattening = 1 / 298.257223563  # f = (a - b) / a
+    u1 = math.atan((1 - FLATTENING) * math.tan(math.radians(theta_1[0])))
+    return _vincenty(math.sin(u1), math.cos(u1), theta_2[0],
+                     math.radians(theta_2[1] - theta_1[1]))
 
-    u1 = math.atan((1 - flattening) * math.tan(math.radians(theta_1[0])))
-    u2 = math.atan((1 - flattening) * math.tan(math.radians(theta_2[0])))
-    l = math.radians(theta_2[1] - theta_1[1])
+
+def _vincenty(sin_u1: float, cos_u1: float, latitude: float,
+              l: float) -> Optional[float]:
+    """
+    Iterate inverse Vincenty from the reduced latitude terms of the first
+    point, the latitude of the second and the difference in longitude in
+    radians.
+    """
+    flattening = FLATTENING
+
+    u2 = math.atan((1 - flattening) * math.tan(math.radians(latitude)))
     _lambda = l
 
-    sin_u1 = math.sin(u1)
-    cos_u1 = math.cos(u1)
     sin_u2 = math.sin(u2)
     cos_u2 = math.cos(u2)
 
@@ -152,8 +523,13 @@ def inverse_vincenty(theta_1: Tuple[float, float],
             break
 
     else:
+        if metrics.enabled:
+            VINCENTY_NON_CONVERGENCE.inc()
         return None
 
+    if metrics.enabled:
+        VINCENTY_ITERATIONS.observe(i + 1)
+
     u_sq = cos_alpha_sq * (
             EARTH_SEMI_MAJOR_AXIS ** 2 - EARTH_SEMI_MINOR_AXIS ** 2
     ) / (EARTH_SEMI_MINOR_AXIS ** 2)
@@ -12,7 +12,8 @@ setup(
     install_requires=(
         "pyicloud",
         "requests",
-        "click"
+        "click",
+        "numpy"
     ),
     author="Euan Mills",
     author_email="euab.mills@gmail.com"
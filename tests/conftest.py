@@ -0,0 +1,42 @@
+import pytest
+
+import libtracker.scanner
+
+
+class FakeDeviceManager:
+    """ Find My device list whose devices are all parked at home. """
+    def __init__(self, n_devices: int, home: tuple) -> None:
+        self._devices = [
+            {"id": f"device-{i}", "name": f"Device {i}", "batteryLevel": 0.5,
+             "location": {"latitude": home[0], "longitude": home[1],
+                          "horizontalAccuracy": 65.0, "timeStamp": 0}}
+            for i in range(n_devices)
+        ]
+
+    def refresh(self, locate: bool = True) -> None:
+        pass
+
+    def __iter__(self):
+        return iter(self._devices)
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+
+class FakePyiCloudService:
+    """ Stand-in for PyiCloudService which never touches the network. """
+    requires_2fa = False
+
+    n_devices = 2
+    home = (51.5, -0.1)
+
+    def __init__(self, username: str, password: str) -> None:
+        self.devices = FakeDeviceManager(self.n_devices, self.home)
+
+
+@pytest.fixture
+def fake_icloud(monkeypatch):
+    """ Have scanners log in to FakePyiCloudService. """
+    monkeypatch.setattr(libtracker.scanner, "PyiCloudService",
+                        FakePyiCloudService)
+    return FakePyiCloudService
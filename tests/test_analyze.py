@@ -0,0 +1,44 @@
+import os
+
+import numpy as np
+import pytest
+
+from libtracker.analyze import analyze
+from libtracker.history import LocationHistory
+
+DTYPE = [("timestamp", "<f8"), ("latitude", "<f8"), ("longitude", "<f8")]
+
+
+def _save(path, timestamps: list) -> str:
+    records = np.array([(t, 51.5, -0.12) for t in timestamps], dtype=DTYPE)
+    np.save(path, records)
+    return str(path)
+
+
+def test_sorted_input_is_the_same_for_any_chunk_size(tmp_path):
+    path = _save(tmp_path / "phone.npy", [0, 50, 100, 150])
+    for chunk_size in (1, 2, 4):
+        stats = analyze([path], [], workers=1, chunk_size=chunk_size)
+        assert stats["phone"].points == 4
+        assert (stats["phone"].first[0], stats["phone"].last[0]) == (0, 150)
+
+
+def test_overlapping_spans_are_rejected(tmp_path):
+    path = _save(tmp_path / "phone.npy", [0, 100, 50, 150])
+    with pytest.raises(ValueError, match="phone"):
+        analyze([path], [], workers=1, chunk_size=2)
+
+
+def test_history_files_are_opened_read_only(tmp_path):
+    path = str(tmp_path / "phone.hist")
+    history = LocationHistory(8, path)
+    for t in (0, 50, 100):
+        history.append(t, 51.5, -0.12, None, None)
+    del history
+    os.chmod(path, 0o444)
+
+    stats = analyze([path], [], workers=1)
+    assert stats["phone"].points == 3
+    with pytest.raises(ValueError):
+        LocationHistory.open(path, readonly=True).append(150, 51.5, -0.12,
+                                                         None, None)
@@ -0,0 +1,87 @@
+import http.client
+import json
+import threading
+import time
+
+import pytest
+
+from libtracker import api
+from libtracker.api import start_api_server
+from libtracker.state import StateMachine
+
+
+@pytest.fixture
+def server():
+    sm = StateMachine()
+    for i in range(3):
+        sm.set(f"device.d{i}", "away", {"latitude": i, "longitude": 0})
+    server = start_api_server(sm, 0)
+    yield sm, server
+    server.shutdown()
+    server.server_close()
+
+
+def _get(server, path: str, headers: dict = None):
+    connection = http.client.HTTPConnection("127.0.0.1",
+                                            server.server_address[1])
+    connection.request("GET", path, headers=headers or {})
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response.status, response.getheader("ETag"), body
+
+
+def test_etag_and_delta(server):
+    sm, server = server
+    status, etag, body = _get(server, "/states")
+    version = json.loads(body)["version"]
+    assert status == 200
+    assert etag == f'"{version}"'
+    assert version.startswith(api.BOOT_ID)
+    assert _get(server, "/states", {"If-None-Match": etag})[0] == 304
+
+    sm.set("device.d1", "home", {"latitude": 1, "longitude": 0})
+    assert _get(server, "/states", {"If-None-Match": etag})[0] == 200
+    delta = json.loads(_get(server, f"/states?since={version}")[2])
+    assert not delta["full"]
+    assert [s["entity_id"] for s in delta["states"]] == ["device.d1"]
+
+
+def test_versions_from_another_process_are_not_reused(server, monkeypatch):
+    sm, server = server
+    _, etag, body = _get(server, "/states")
+    version = json.loads(body)["version"]
+
+    # Restart: a new process whose state table has reached the same version.
+    monkeypatch.setattr(api, "BOOT_ID", "restarted")
+    assert _get(server, "/states", {"If-None-Match": etag})[0] == 200
+    reply = json.loads(_get(server, f"/states?since={version}")[2])
+    assert reply["full"]
+    assert len(reply["states"]) == 3
+
+
+def test_bad_since(server):
+    _, server = server
+    assert _get(server, "/states?since=x")[0] == 400
+    assert _get(server, "/states?since=0")[0] == 200
+
+
+def test_stream_resumes_from_last_event_id(server):
+    sm, server = server
+    version = json.loads(_get(server, "/states")[2])["version"]
+    connection = http.client.HTTPConnection("127.0.0.1",
+                                            server.server_address[1])
+    connection.request("GET", "/stream", headers={"Last-Event-ID": version})
+    response = connection.getresponse()
+
+    def write():
+        time.sleep(0.1)
+        sm.set("device.d0", "home", {"latitude": 0, "longitude": 0})
+
+    threading.Thread(target=write).start()
+    lines = [response.fp.readline().decode().rstrip() for _ in range(3)]
+    connection.close()
+
+    assert lines[0] == f"id: {api.BOOT_ID}-{sm.version}"
+    data = json.loads(lines[2][len("data: "):])
+    assert [s["entity_id"] for s in data["states"]] == ["device.d0"]
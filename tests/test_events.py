@@ -0,0 +1,109 @@
+from libtracker.events import GeofenceTracker, ZoneEvent, EVENT_ENTER
+from libtracker.scanner import Device
+from libtracker.state import StateMachine
+from libtracker.zone import (
+    setup_zones,
+    DEFAULT_ZONE_RADIUS,
+    METRES_PER_DEGREE_LAT,
+    ZONE_RADIUS_OFFSET,
+)
+
+HOME = (51.5, -0.12)
+CONFIG = {"home_name": "Home", "latitude": HOME[0], "longitude": HOME[1],
+          "distance_cache_size": 0}
+
+
+def _setup():
+    sm = StateMachine()
+    zones = setup_zones(sm, CONFIG)
+    tracker = GeofenceTracker(sm, zones, dwell=None, clock=lambda: 0.0)
+    tracker.start()
+    device = Device(sm, None, "phone", CONFIG, zones)
+    return sm, tracker, device
+
+
+def _north_of_home(metres: float) -> tuple:
+    return HOME[0] + metres / METRES_PER_DEGREE_LAT, HOME[1]
+
+
+def test_enter_matches_device_state_at_the_edge():
+    sm, tracker, device = _setup()
+    events = []
+    tracker.subscribe(events.append)
+    try:
+        device.mark_seen("phone", None, _north_of_home(2000), None, None,
+                         1000.0)
+        # Past the radius, but within the offset the scanner allows.
+        device.mark_seen("phone", None, _north_of_home(
+            DEFAULT_ZONE_RADIUS + ZONE_RADIUS_OFFSET / 2), None, None, 1060.0)
+    finally:
+        tracker.stop()
+
+    assert sm.get("device.phone").state == "home"
+    assert [(e.type, e.zone) for e in events] == [(EVENT_ENTER, "zone.home")]
+
+
+def test_events_carry_the_location_time():
+    sm, tracker, device = _setup()
+    events = []
+    tracker.subscribe(events.append)
+    try:
+        device.mark_seen("phone", None, _north_of_home(2000), None, None,
+                         1000.0)
+        device.mark_seen("phone", None, HOME, None, None, 1060.0)
+        # Seen again without moving: the event keeps the arrival time.
+        device.mark_seen("phone", None, HOME, None, None, 1120.0)
+    finally:
+        tracker.stop()
+
+    assert sm.get("device.phone").attrs["timestamp"] == 1060.0
+    assert [e.timestamp for e in events] == [1060.0]
+
+
+def test_debounce_is_timed_in_fix_time():
+    sm = StateMachine()
+    zones = setup_zones(sm, CONFIG)
+    clock = [5000.0]
+    tracker = GeofenceTracker(sm, zones, debounce=60, dwell=None,
+                              clock=lambda: clock[0])
+    # Fixes arrive an hour after they were recorded.
+    tracker.update("device.phone", *_north_of_home(2000), 1400.0)
+    clock[0] = 5060.0
+    tracker.update("device.phone", *HOME, 1460.0)
+    clock[0] = 5100.0
+    assert tracker.tick() == []
+
+    clock[0] = 5120.0
+    assert [(e.type, e.timestamp) for e in tracker.tick()] == \
+        [(EVENT_ENTER, 1460.0)]
+
+
+class _Scanner:
+    def __init__(self, devices: list, notifications: bool = True) -> None:
+        self.devices = {device.name: device for device in devices}
+        self.notifications = notifications
+
+
+def _notified(monkeypatch, scanners: list, device: str) -> list:
+    from libtracker import LibtrackerRunner, notify
+
+    runner = LibtrackerRunner(CONFIG)
+    runner.running_scanners = scanners
+    sent = []
+    monkeypatch.setattr(notify, "queue_notification",
+                        lambda name, config: sent.append(name))
+    runner._notify_home(ZoneEvent(EVENT_ENTER, device, "zone.home", 1000.0,
+                                  *HOME))
+    return sent
+
+
+def test_home_notification_uses_the_device_name(monkeypatch):
+    phone = Device(StateMachine(), None, "JohnsiPhone", CONFIG)
+    assert _notified(monkeypatch, [_Scanner([phone])],
+                     "device.johnsiphone") == ["JohnsiPhone"]
+
+
+def test_replayed_devices_are_not_notified(monkeypatch):
+    phone = Device(StateMachine(), None, "JohnsiPhone", CONFIG)
+    assert _notified(monkeypatch, [_Scanner([phone], notifications=False)],
+                     "device.johnsiphone") == []
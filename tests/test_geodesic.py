@@ -0,0 +1,32 @@
+import numpy as np
+
+from libtracker.geodesic import inverse_vincenty_batch, inverse_vincenty_matrix
+from libtracker.zone import inverse_vincenty
+
+HOME = (51.5007, -0.1246)
+PARIS = (48.8584, 2.2945)
+
+
+def test_batch_matches_scalar():
+    points = [HOME, PARIS, (40.6892, -74.0445)]
+    result = inverse_vincenty_batch(points, HOME)
+    assert result.shape == (3,)
+    for point, distance in zip(points, result):
+        assert distance == inverse_vincenty(point, HOME)
+
+
+def test_empty_list():
+    result = inverse_vincenty_batch([], HOME)
+    assert isinstance(result, np.ndarray)
+    assert result.shape == (0,)
+
+
+def test_zero_length_array():
+    assert inverse_vincenty_batch(np.empty((0, 2)), HOME).shape == (0,)
+    assert inverse_vincenty_batch(np.empty((0, 2)),
+                                  np.empty((0, 2))).shape == (0,)
+
+
+def test_empty_matrix():
+    assert inverse_vincenty_matrix([], [HOME, PARIS]).shape == (0, 2)
+    assert inverse_vincenty_matrix([HOME, PARIS], []).shape == (2, 0)
@@ -0,0 +1,211 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+import requests
+
+from libtracker.notify import NotificationDispatcher
+
+CONFIG = {"telegram_users": ["1"], "telegram_token": "TOKEN"}
+
+
+class _StubTelegram(ThreadingHTTPServer):
+    """ Local stand-in for the Telegram API which records every request. """
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), _Handler)
+        # (status, body) to answer with, in order. 200 once exhausted.
+        self.responses = []
+        # (monotonic time, path, form fields)
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def wait_for(self, count: int, timeout: float = 5) -> list:
+        deadline = time.monotonic() + timeout
+        while len(self.requests) < count and time.monotonic() < deadline:
+            time.sleep(0.005)
+        return self.requests
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        fields = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        with self.server.lock:
+            self.server.requests.append((time.monotonic(), self.path, fields))
+            status, reply = self.server.responses.pop(0) \
+                if self.server.responses else (200, {"ok": True})
+        payload = json.dumps(reply).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = _StubTelegram()
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={"poll_interval": 0.01}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _dispatcher(stub, config=CONFIG, **kwargs) -> NotificationDispatcher:
+    kwargs.setdefault("backoff", 0.05)
+    kwargs.setdefault("min_interval", 0)
+    return NotificationDispatcher(config, api_url=stub.url, **kwargs)
+
+
+def test_sends_message(stub):
+    dispatcher = _dispatcher(stub)
+    dispatcher.start()
+    assert dispatcher.notify("phone")
+    (_, path, fields), = stub.wait_for(1)
+    dispatcher.stop(1)
+
+    assert path == "/botTOKEN/sendMessage"
+    assert fields == {"chat_id": "1",
+                      "text": "Device: phone has just returned home"}
+
+
+def test_retries_with_backoff(stub):
+    stub.responses = [(500, {}), (502, {})]
+    dispatcher = _dispatcher(stub)
+    dispatcher.start()
+    dispatcher.notify("phone")
+    sent = stub.wait_for(3)
+    time.sleep(0.1)
+    dispatcher.stop(1)
+
+    assert len(stub.requests) == 3
+    times = [t for t, _, _ in sent]
+    # Waits backoff, then twice backoff.
+    assert times[1] - times[0] >= 0.05
+    assert times[2] - times[1] >= 0.1
+
+
+def test_gives_up_after_max_retries(stub, caplog):
+    stub.responses = [(500, {})] * 10
+    dispatcher = _dispatcher(stub, backoff=0.01, max_retries=2)
+    dispatcher.start()
+    with caplog.at_level(logging.WARNING, "libtracker.notify"):
+        dispatcher.notify("phone")
+        stub.wait_for(3)
+        time.sleep(0.1)
+        dispatcher.stop(1)
+
+    assert len(stub.requests) == 3
+    assert "Could not notify" in caplog.text
+
+
+def test_429_honours_retry_after(stub):
+    stub.responses = [(429, {"ok": False, "error_code": 429,
+                             "parameters": {"retry_after": 0.3}})]
+    dispatcher = _dispatcher(stub, backoff=0.01)
+    dispatcher.start()
+    dispatcher.notify("phone")
+    sent = stub.wait_for(2)
+    dispatcher.stop(1)
+
+    assert len(sent) == 2
+    assert sent[1][0] - sent[0][0] >= 0.3
+
+
+def test_client_error_is_not_retried(stub, caplog):
+    stub.responses = [(400, {"ok": False, "error_code": 400,
+                             "description": "Bad Request: chat not found"})]
+    dispatcher = _dispatcher(stub)
+    dispatcher.start()
+    with caplog.at_level(logging.WARNING, "libtracker.notify"):
+        dispatcher.notify("phone")
+        stub.wait_for(1)
+        time.sleep(0.2)
+        dispatcher.stop(1)
+
+    assert len(stub.requests) == 1
+    assert "Could not notify" in caplog.text
+    assert "400" in caplog.text
+
+
+def test_rate_limits_each_chat(stub):
+    config = dict(CONFIG, telegram_users=["1", "2"])
+    dispatcher = _dispatcher(stub, config, min_interval=0.3)
+    dispatcher.start()
+    dispatcher.notify("phone")
+    dispatcher.notify("watch")
+    sent = stub.wait_for(4)
+    dispatcher.stop(1)
+
+    by_chat = {}
+    for t, _, fields in sent:
+        by_chat.setdefault(fields["chat_id"], []).append(t)
+    for times in by_chat.values():
+        assert len(times) == 2
+        # Measured on arrival, so allow for request latency.
+        assert times[1] - times[0] >= 0.25
+    # A message to one chat doesn't wait for the interval of another.
+    assert by_chat["2"][0] - by_chat["1"][0] < 0.3
+
+
+def test_coalesces_queued_events(stub):
+    dispatcher = _dispatcher(stub)
+    assert dispatcher.notify("phone")
+    assert not dispatcher.notify("phone")
+    assert dispatcher.notify("watch")
+    dispatcher.start()
+    stub.wait_for(2)
+    time.sleep(0.1)
+
+    # Once sent, the device can be queued again.
+    assert dispatcher.notify("phone")
+    stub.wait_for(3)
+    dispatcher.stop(1)
+
+    texts = [fields["text"] for _, _, fields in stub.requests]
+    assert texts == ["Device: phone has just returned home",
+                     "Device: watch has just returned home",
+                     "Device: phone has just returned home"]
+
+
+def test_disabled_without_token(stub):
+    dispatcher = _dispatcher(stub, {"telegram_users": ["1"]})
+    assert not dispatcher.enabled
+    assert not dispatcher.notify("phone")
+
+
+class _Session(requests.Session):
+    closed = False
+
+    def close(self) -> None:
+        self.closed = True
+        super().close()
+
+
+def test_stop_leaves_callers_session_open(stub):
+    session = _Session()
+    dispatcher = _dispatcher(stub, session=session)
+    dispatcher.start()
+    dispatcher.stop(1)
+    assert not session.closed
+
+
+def test_stop_closes_own_session(stub, monkeypatch):
+    monkeypatch.setattr(requests, "Session", _Session)
+    dispatcher = _dispatcher(stub)
+    dispatcher.start()
+    dispatcher.stop(1)
+    assert dispatcher.session.closed
@@ -0,0 +1,99 @@
+import random
+
+from libtracker.proximity import ProximityTracker, ATTR_MEMBERS
+from libtracker.state import StateMachine
+from libtracker.zone import inverse_vincenty
+
+RADIUS = 30
+
+
+def _brute_groups(positions: dict) -> list:
+    """ Group by comparing every pair of devices. """
+    groups = {device: {device} for device in positions}
+    devices = list(positions)
+    for i, a in enumerate(devices):
+        for b in devices[i + 1:]:
+            if groups[a] is not groups[b] and \
+                    inverse_vincenty(positions[a], positions[b]) * 1000 \
+                    <= RADIUS:
+                merged = groups[a] | groups[b]
+                for device in merged:
+                    groups[device] = merged
+    return sorted(sorted(group) for group in
+                  {id(group): group for group in groups.values()}.values()
+                  if len(group) > 1)
+
+
+def _published(sm: StateMachine) -> list:
+    return sorted(state["attrs"][ATTR_MEMBERS] for state in sm.all()
+                  if state["entity_id"].startswith("proximity.")
+                  and state["attrs"][ATTR_MEMBERS])
+
+
+def test_groups_match_all_pairs():
+    rng = random.Random(0)
+    sm = StateMachine()
+    tracker = ProximityTracker(sm, RADIUS)
+    positions = {}
+    for step in range(600):
+        device = f"device.d{rng.randrange(20)}"
+        if rng.random() < 0.1 and device in positions:
+            tracker.remove(device)
+            del positions[device]
+            continue
+        if device in positions and rng.random() < 0.7:
+            # Jitter, which makes links at the edge of the radius flap.
+            latitude, longitude = positions[device]
+            position = (latitude + rng.gauss(0, 0.00005),
+                        longitude + rng.gauss(0, 0.00008))
+        else:
+            position = (51.5 + rng.uniform(0, 0.001),
+                        -0.12 + rng.uniform(0, 0.0015))
+        positions[device] = position
+        tracker.update(device, *position)
+
+        if step % 25 == 0:
+            expected = _brute_groups(positions)
+            assert sorted(sorted(g) for g in tracker.groups()) == expected
+            assert _published(sm) == expected
+
+
+def test_split_and_merge():
+    sm = StateMachine()
+    tracker = ProximityTracker(sm, RADIUS)
+    # A chain a - b - c, each 20 m from the next.
+    step = 20 / 111_000
+    for i, device in enumerate(("device.a", "device.b", "device.c")):
+        tracker.update(device, 51.5 + i * step, -0.12)
+    assert tracker.group_of("device.c") == {"device.a", "device.b",
+                                            "device.c"}
+
+    # b leaves, breaking the chain.
+    tracker.update("device.b", 51.6, -0.12)
+    assert tracker.groups() == []
+    assert sm.get("proximity.a").state == "0"
+
+    # b comes back next to c only.
+    tracker.update("device.b", 51.5 + 3 * step, -0.12)
+    assert tracker.group_of("device.b") == {"device.b", "device.c"}
+    assert sm.get("proximity.b").attrs[ATTR_MEMBERS] == ["device.b",
+                                                         "device.c"]
+
+    tracker.remove("device.c")
+    assert tracker.groups() == []
+    assert sm.get("proximity.b").state == "0"
+
+
+def test_restore():
+    sm = StateMachine()
+    tracker = ProximityTracker(sm, RADIUS)
+    for device, latitude in (("device.a", 51.5), ("device.b", 51.5001)):
+        # As a device writes its position before it is grouped.
+        sm.set(device, "away", {"latitude": latitude, "longitude": -0.12})
+        tracker.update(device, latitude, -0.12)
+
+    restored = ProximityTracker(sm, RADIUS)
+    restored.restore()
+    assert restored.groups() == [frozenset({"device.a", "device.b"})]
+    restored.update("device.b", 51.6, -0.12)
+    assert sm.get("proximity.a").state == "0"
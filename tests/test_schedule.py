@@ -0,0 +1,52 @@
+import pytest
+
+import libtracker.scanner
+from libtracker.schedule import ScanScheduler
+from libtracker.state import StateMachine
+
+
+class _Clock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_retry_backs_off_until_scheduled():
+    scheduler = ScanScheduler(15, 100, clock=_Clock())
+    assert [scheduler.retry("a") for _ in range(5)] == [15, 30, 60, 100, 100]
+
+    scheduler.schedule("a", 15)
+    assert scheduler.retry("a") == 15
+
+
+class _FailingService:
+    """ iCloud service whose device list can't be fetched. """
+    requires_2fa = False
+
+    def __init__(self, username: str, password: str) -> None:
+        pass
+
+    @property
+    def devices(self):
+        raise ConnectionError("iCloud is down")
+
+
+def test_failed_poll_is_rescheduled(monkeypatch):
+    monkeypatch.setattr(libtracker.scanner, "PyiCloudService",
+                        _FailingService)
+    scanner = libtracker.scanner.ICloudDeviceScanner(
+        StateMachine(), {"apple_username": "a", "apple_password": "x",
+                         "scan_adaptive": True})
+    clock = scanner.scheduler.clock = _Clock()
+    scanner.scheduler.schedule("device0")
+
+    with pytest.raises(ConnectionError):
+        scanner.update_due()
+    assert "device0" in scanner.scheduler
+
+    clock.now = 15
+    with pytest.raises(ConnectionError):
+        scanner.update_due()
+    assert scanner.scheduler.wait_time() == 30
@@ -0,0 +1,59 @@
+import queue
+import threading
+
+import pytest
+
+from libtracker.sharding import (
+    MSG_STATE,
+    ShardedICloudScanner,
+    _worker_main,
+    account_name,
+)
+from libtracker.state import StateMachine
+
+CONFIG = {"home_name": "Home", "latitude": 51.5, "longitude": -0.1}
+
+
+def _account(username: str, **kwargs) -> dict:
+    return dict(apple_username=username, apple_password="x", **kwargs)
+
+
+def test_account_name():
+    assert account_name(_account("alice@icloud.com")) == "alice"
+    assert account_name(_account("Bob.Smith@icloud.com")) == "bob_smith"
+    assert account_name(_account("bob@icloud.com", name="Work")) == "work"
+
+
+def test_duplicate_account_names_are_rejected():
+    accounts = [_account("alice@icloud.com"), _account("alice@gmail.com")]
+    with pytest.raises(RuntimeError, match="alice"):
+        ShardedICloudScanner(StateMachine(),
+                             dict(CONFIG, apple_accounts=accounts))
+
+    accounts[1]["name"] = "alice_gmail"
+    ShardedICloudScanner(StateMachine(), dict(CONFIG, apple_accounts=accounts))
+
+
+class _OneCycle(threading.Event):
+    """ Stop event which is set once a worker waits after its first scan. """
+    def wait(self, timeout=None) -> bool:
+        self.set()
+        return True
+
+
+def test_devices_with_the_same_name_are_kept_apart(fake_icloud):
+    # Both fake accounts have devices named "Device 0" and "Device 1".
+    accounts = [_account("alice@icloud.com"), _account("bob@icloud.com")]
+    out = queue.Queue()
+    stop = _OneCycle()
+
+    _worker_main(0, accounts, dict(CONFIG, apple_accounts=accounts), out,
+                 stop)
+
+    entity_ids = set()
+    while not out.empty():
+        kind, _, payload = out.get()
+        if kind == MSG_STATE:
+            entity_ids.update(entity_id for entity_id, _, _ in payload)
+    assert entity_ids == {"device.alice_device0", "device.alice_device1",
+                          "device.bob_device0", "device.bob_device1"}
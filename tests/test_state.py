@@ -0,0 +1,64 @@
+import sys
+import threading
+
+from libtracker.state import CompactStateMachine, StateMachine
+
+HOME = ("home", {"latitude": 1.0, "longitude": 1.0})
+AWAY = ("away", {"latitude": 2.0, "longitude": 2.0, "battery": 50})
+
+
+def test_compact_get_is_never_torn():
+    interval = sys.getswitchinterval()
+    # Switch threads as often as possible to catch a half done write.
+    sys.setswitchinterval(1e-6)
+    sm = CompactStateMachine()
+    sm.set("device.phone", *HOME)
+    stop = threading.Event()
+
+    def writer():
+        while not stop.is_set():
+            sm.set("device.phone", *HOME)
+            sm.set("device.phone", *AWAY)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        for _ in range(50000):
+            state = sm.get("device.phone")
+            assert (state.state, state.attrs) in (HOME, AWAY)
+    finally:
+        stop.set()
+        thread.join()
+        sys.setswitchinterval(interval)
+
+
+def test_discarded_batch_is_pushed_again():
+    from libtracker.entity import Entity
+
+    class Thing(Entity):
+        state = "on"
+
+    sm = StateMachine()
+    thing = Thing()
+    thing.sm, thing.entity_id = sm, "thing.one"
+    try:
+        with sm.batch():
+            thing.push_state()
+            raise ValueError
+    except ValueError:
+        pass
+    assert sm.get("thing.one") is None
+
+    thing.push_state()
+    assert sm.get("thing.one").state == "on"
+
+
+def test_rollback_callbacks_only_on_discard():
+    sm = StateMachine()
+    called = []
+    sm.on_rollback(lambda: called.append("outside"))
+    with sm.batch():
+        sm.set("thing.one", "on", {})
+        sm.on_rollback(lambda: called.append("committed"))
+    assert called == []
+    assert sm.get("thing.one").state == "on"
@@ -0,0 +1,61 @@
+import pytest
+
+from libtracker.state import StateMachine
+from libtracker.zone import setup_zones
+
+CONFIG = {
+    "latitude": 51.5,
+    "longitude": -0.12,
+    "home_name": "Home",
+    "zones": [
+        {"name": "Big", "latitude": 51.6, "longitude": -0.12, "radius": 500},
+        {"name": "Small", "latitude": 51.6, "longitude": -0.12,
+         "radius": 200},
+        {"name": "Small2", "latitude": 51.6005, "longitude": -0.12,
+         "radius": 200},
+    ],
+}
+
+
+def _containing(latitude, longitude):
+    index = setup_zones(StateMachine(), CONFIG)
+    return [zone.entity_id for zone in
+            index.zones_containing(latitude, longitude, 7)]
+
+
+def test_overlapping_zones_smallest_first():
+    assert _containing(51.6001, -0.12) == \
+        ["zone.small", "zone.small2", "zone.big"]
+
+
+def test_equal_radius_nearest_centre_first():
+    assert _containing(51.6004, -0.12) == \
+        ["zone.small2", "zone.small", "zone.big"]
+
+
+def test_order_is_stable():
+    for _ in range(20):
+        assert _containing(51.6002, -0.12)[0] == "zone.small"
+
+
+def test_zone_named_home_is_rejected():
+    config = dict(CONFIG, zones=[{"name": "Home", "latitude": 0,
+                                  "longitude": 0}])
+    with pytest.raises(ValueError, match="zone.home"):
+        setup_zones(StateMachine(), config)
+
+
+def test_duplicate_zone_names_are_rejected():
+    config = dict(CONFIG, zones=CONFIG["zones"] + [
+        {"name": "Big ", "latitude": 0, "longitude": 0}])
+    with pytest.raises(ValueError, match="zone.big"):
+        setup_zones(StateMachine(), config)
+
+
+def test_membership_ignores_rounded_cache():
+    index = setup_zones(StateMachine(), dict(CONFIG, zones=[],
+                                             distance_accuracy="exact"))
+    # Both points round to the same 4 decimal place cache key, but only the
+    # first is within the home zone's 100m radius plus the 7m offset.
+    assert index.zones_containing(51.500951, -0.12, 7)
+    assert not index.zones_containing(51.501049, -0.12, 7)